@@ -2,6 +2,37 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 
+import settings
+
+EARTH_RADIUS_KM = 6371.0088
+ANOMALY_COLUMNS = ['Name', 'Role', 'Type', 'Details', 'Timestamp', 'RiskScore']
+
+
+def haversine_km(lat1, long1, lat2, long2):
+    """
+    Great-circle distance in km between coordinates given in degrees.
+    Works element-wise on numpy arrays (or scalars, broadcast).
+    """
+    lat1, long1, lat2, long2 = map(np.radians, (lat1, long1, lat2, long2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def anomaly_frame(name=(), role=(), anomaly_type=None, details=(), timestamp=(), risk=None):
+    """
+    Builds an anomaly dataframe column-wise; scalar type/risk are broadcast.
+    """
+    frame = pd.DataFrame({
+        'Name': np.asarray(name, dtype=object),
+        'Role': np.asarray(role, dtype=object),
+        'Details': np.asarray(details, dtype=object),
+        'Timestamp': pd.to_datetime(np.asarray(timestamp)),
+    })
+    frame['Type'] = anomaly_type
+    frame['RiskScore'] = risk
+    return frame[ANOMALY_COLUMNS]
+
 class AnomalyDetector:
     def __init__(self):
         pass
@@ -9,121 +40,193 @@ class AnomalyDetector:
     def detect_multiple_checkins(self, logs_df, time_window_minutes=5):
         """
         Detects if a user has checked in multiple times within a short window.
+        The input frame is not modified.
         """
-        anomalies = []
         if logs_df.empty:
-            return pd.DataFrame()
-
-        # Ensure timestamp is datetime
-        logs_df['Timestamp'] = pd.to_datetime(logs_df['Timestamp'])
-        
-        # Sort by Name and Timestamp
-        logs_df = logs_df.sort_values(by=['Name', 'Timestamp'])
-        
-        # Calculate time difference between consecutive check-ins for the same user
-        logs_df['TimeDiff'] = logs_df.groupby('Name')['Timestamp'].diff()
-        
+            return anomaly_frame()
+
+        # Sort by Name and Timestamp on a private frame
+        logs = pd.DataFrame({
+            'Name': logs_df['Name'],
+            'Role': logs_df['Role'],
+            'Timestamp': pd.to_datetime(logs_df['Timestamp']),
+        }).sort_values(by=['Name', 'Timestamp'], kind='stable')
+
+        # Time since the previous check-in of the same user (NaT for a user's first one)
+        name = logs['Name'].to_numpy()
+        same_user = np.zeros(len(logs), dtype=bool)
+        same_user[1:] = name[1:] == name[:-1]
+        time_diff = logs['Timestamp'].diff().where(same_user)
+
         # Filter for short intervals
-        short_intervals = logs_df[logs_df['TimeDiff'] < timedelta(minutes=time_window_minutes)]
-        
-        if not short_intervals.empty:
-            for index, row in short_intervals.iterrows():
-                anomalies.append({
-                    'Name': row['Name'],
-                    'Role': row['Role'],
-                    'Type': 'Multiple Check-ins',
-                    'Details': f"Check-in within {row['TimeDiff'].seconds // 60} mins of previous",
-                    'Timestamp': row['Timestamp'],
-                    'RiskScore': 'Medium'
-                })
-                
-        return pd.DataFrame(anomalies)
+        short = (time_diff < timedelta(minutes=time_window_minutes)).to_numpy()
+        if not short.any():
+            return anomaly_frame()
+
+        minutes = (time_diff[short].dt.total_seconds() // 60).astype(int).astype(str)
+        return anomaly_frame(
+            logs['Name'][short], logs['Role'][short], 'Multiple Check-ins',
+            'Check-in within ' + minutes + ' mins of previous',
+            logs['Timestamp'][short], 'Medium')
 
     def detect_short_duration(self, report_df, min_duration_hours=4):
         """
         Detects if the total duration for the day is less than the expected minimum.
         """
-        anomalies = []
         if report_df.empty:
-            return pd.DataFrame()
+            return anomaly_frame()
 
         # Check duration
-        short_duration = report_df[report_df['Duration_hours'] < min_duration_hours]
-        
-        if not short_duration.empty:
-            for index, row in short_duration.iterrows():
-                anomalies.append({
-                    'Name': row['Name'],
-                    'Role': row['Role'],
-                    'Type': 'Short Duration',
-                    'Details': f"Total duration: {row['Duration_hours']} hours",
-                    'Timestamp': row['Date'], # Using Date as timestamp
-                    'RiskScore': 'High'
-                })
-                
-        return pd.DataFrame(anomalies)
+        short = (report_df['Duration_hours'] < min_duration_hours).to_numpy()
+        if not short.any():
+            return anomaly_frame()
+
+        short_duration = report_df[short]
+        return anomaly_frame(
+            short_duration['Name'], short_duration['Role'], 'Short Duration',
+            'Total duration: ' + short_duration['Duration_hours'].astype(str) + ' hours',
+            short_duration['Date'],  # Using Date as timestamp
+            'High')
 
     def detect_location_mismatch(self, logs_df, expected_lat, expected_long, threshold_km=1.0):
         """
         Detects if check-ins are far from the expected location.
-        Simple Haversine formula or approximation.
+        Great-circle (haversine) distance, computed for all rows at once.
         """
-        anomalies = []
         if logs_df.empty:
-            return pd.DataFrame()
+            return anomaly_frame()
             
         # Check if lat/long columns exist
         if 'Lat' not in logs_df.columns or 'Long' not in logs_df.columns:
-            return pd.DataFrame()
-
-        # Simple Euclidean distance approximation for POC (1 deg lat ~ 111km)
-        # For more accuracy, use Haversine
-        
-        for index, row in logs_df.iterrows():
-            try:
-                lat = float(row['Lat'])
-                long = float(row['Long'])
-                
-                # Approx distance
-                dist = np.sqrt((lat - expected_lat)**2 + (long - expected_long)**2) * 111
-                
-                if dist > threshold_km:
-                    anomalies.append({
-                        'Name': row['Name'],
-                        'Role': row['Role'],
-                        'Type': 'Location Mismatch',
-                        'Details': f"Distance: {dist:.2f} km from site",
-                        'Timestamp': row['Timestamp'],
-                        'RiskScore': 'High'
-                    })
-            except ValueError:
-                continue # Skip invalid lat/long
-                
-        return pd.DataFrame(anomalies)
-
-    def get_all_anomalies(self, logs_df, report_df, expected_location=None):
+            return anomaly_frame()
+
+        # Invalid or missing coordinates become NaN and never compare as too far
+        lat = pd.to_numeric(logs_df['Lat'], errors='coerce').to_numpy(dtype=np.float64)
+        long = pd.to_numeric(logs_df['Long'], errors='coerce').to_numpy(dtype=np.float64)
+        dist = haversine_km(lat, long, expected_lat, expected_long)
+
+        far = dist > threshold_km
+        if not far.any():
+            return anomaly_frame()
+
+        far_logs = logs_df[far]
+        return anomaly_frame(
+            far_logs['Name'], far_logs['Role'], 'Location Mismatch',
+            np.char.mod('Distance: %.2f km from site', dist[far]),
+            far_logs['Timestamp'], 'High')
+
+    def detect_site_mismatch(self, logs_df, site_registry, assignments=None):
         """
-        Aggregates all anomalies.
+        Detects check-ins outside every geofence of the sites the person is
+        assigned to (any registered site for unassigned people).
+        `assignments` maps a name (or user id) to a list of site ids.
         """
-        all_anomalies = []
-        
-        # 1. Multiple Check-ins
-        df1 = self.detect_multiple_checkins(logs_df)
-        if not df1.empty:
-            all_anomalies.append(df1)
-            
-        # 2. Short Duration
-        df2 = self.detect_short_duration(report_df)
-        if not df2.empty:
-            all_anomalies.append(df2)
-            
-        # 3. Location Mismatch
-        if expected_location:
-            df3 = self.detect_location_mismatch(logs_df, expected_location['lat'], expected_location['long'])
-            if not df3.empty:
-                all_anomalies.append(df3)
-                
-        if all_anomalies:
-            return pd.concat(all_anomalies, ignore_index=True)
+        if logs_df.empty or site_registry is None or len(site_registry) == 0:
+            return anomaly_frame()
+        if 'Lat' not in logs_df.columns or 'Long' not in logs_df.columns:
+            return anomaly_frame()
+
+        lat = pd.to_numeric(logs_df['Lat'], errors='coerce').to_numpy(dtype=np.float64)
+        long = pd.to_numeric(logs_df['Long'], errors='coerce').to_numpy(dtype=np.float64)
+        groups, group_site_ids = None, None
+        if assignments:
+            # one assignment lookup per person rather than per check-in,
+            # by user id first and then by name (like the online detector)
+            name_codes, names = pd.factorize(logs_df['Name'])
+            if 'UserId' in logs_df.columns:
+                id_codes, user_ids = pd.factorize(logs_df['UserId'])
+            else:
+                id_codes, user_ids = np.full(len(logs_df), -1), []
+            # pack both codes shifted by one so a missing id or name (-1) stays 0
+            width = len(names) + 1
+            packed = (id_codes.astype(np.int64) + 1) * width + (name_codes + 1)
+            groups, people = pd.factorize(packed)
+            group_site_ids = []
+            for person in people:
+                id_code, name_code = divmod(int(person), width)
+                site_ids = assignments.get(user_ids[id_code - 1]) if id_code else None
+                if not site_ids and name_code:
+                    site_ids = assignments.get(names[name_code - 1])
+                group_site_ids.append(site_ids)
+        inside, nearest = site_registry.check_many(lat, long, groups, group_site_ids)
+
+        outside = ~inside
+        if not outside.any():
+            return anomaly_frame()
+
+        outside_logs = logs_df[outside]
+        details = np.where(np.isinf(nearest[outside]), 'No registered site nearby',
+                           np.char.mod('Distance: %.2f km from nearest assigned site',
+                                       np.where(np.isinf(nearest[outside]), 0, nearest[outside])))
+        return anomaly_frame(
+            outside_logs['Name'], outside_logs['Role'], 'Location Mismatch',
+            details, outside_logs['Timestamp'], 'High')
+
+    def detect_impossible_travel(self, logs_df, max_speed_kmh=None, min_distance_km=None):
+        """
+        Detects consecutive check-ins of the same user that imply moving
+        faster than `max_speed_kmh` (e.g. proxy attendance at two campuses).
+        Jumps shorter than `min_distance_km` are ignored as GPS jitter.
+        Both default to the settings the online detector uses.
+        One sort, then shifted arrays across all users at once.
+        """
+        max_speed_kmh = settings.ANOMALY_MAX_SPEED_KMH if max_speed_kmh is None else max_speed_kmh
+        min_distance_km = settings.ANOMALY_MIN_TRAVEL_KM if min_distance_km is None else min_distance_km
+        if logs_df.empty or 'Lat' not in logs_df.columns or 'Long' not in logs_df.columns:
+            return anomaly_frame()
+
+        lat = pd.to_numeric(logs_df['Lat'], errors='coerce').to_numpy(dtype=np.float64)
+        long = pd.to_numeric(logs_df['Long'], errors='coerce').to_numpy(dtype=np.float64)
+        user_codes = pd.factorize(logs_df['Name'])[0]
+        timestamps = pd.to_datetime(logs_df['Timestamp']).to_numpy(dtype='datetime64[ns]')
+        # check-ins with a place, a time and a person
+        located = np.flatnonzero(~(np.isnan(lat) | np.isnan(long) | np.isnat(timestamps)) & (user_codes >= 0))
+        if len(located) < 2:
+            return anomaly_frame()
+
+        # Sort the located check-ins by user, then time
+        order = located[np.lexsort((timestamps[located], user_codes[located]))]
+        user, ts, lat, long = user_codes[order], timestamps[order], lat[order], long[order]
+
+        # Previous check-in of the same user
+        same_user = user[1:] == user[:-1]
+        dist = haversine_km(lat[:-1], long[:-1], lat[1:], long[1:])
+        hours = (ts[1:] - ts[:-1]) / np.timedelta64(1, 'h')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.where(hours > 0, dist / hours, np.inf)
+        flagged = np.flatnonzero(same_user & np.isfinite(hours) & (dist > min_distance_km) & (speed > max_speed_kmh))
+        if len(flagged) == 0:
+            return anomaly_frame()
+
+        rows = logs_df.iloc[order[flagged + 1]]
+        minutes = np.floor(hours[flagged] * 60).astype(int)
+        details = np.char.add(np.char.mod('Moved %.1f km in ', dist[flagged]),
+                              np.char.mod('%d mins', minutes))
+        return anomaly_frame(
+            rows['Name'], rows['Role'], 'Impossible Travel', details,
+            rows['Timestamp'], 'High')
+
+    def get_all_anomalies(self, logs_df, report_df, expected_location=None, site_registry=None, assignments=None):
+        """
+        Aggregates all anomalies. A site registry, when given, takes over the
+        location check from the single expected location.
+        """
+        frames = [
+            # 1. Multiple Check-ins
+            self.detect_multiple_checkins(logs_df),
+            # 2. Short Duration
+            self.detect_short_duration(report_df),
+        ]
+        # 3. Impossible travel between consecutive check-ins
+        frames.append(self.detect_impossible_travel(logs_df))
+        # 4. Location Mismatch
+        if site_registry is not None:
+            frames.append(self.detect_site_mismatch(logs_df, site_registry, assignments))
+        elif expected_location:
+            frames.append(self.detect_location_mismatch(logs_df, expected_location['lat'], expected_location['long']))
+
+        frames = [frame for frame in frames if not frame.empty]
+        if frames:
+            return pd.concat(frames, ignore_index=True)
         else:
-            return pd.DataFrame(columns=['Name', 'Role', 'Type', 'Details', 'Timestamp', 'RiskScore'])
+            return anomaly_frame()
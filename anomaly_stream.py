@@ -0,0 +1,441 @@
+"""
+Online anomaly detection over attendance events as they are written.
+
+`AnomalyDetector` recomputes everything from the full log history. The
+`OnlineAnomalyDetector` here keeps O(1) state per user (last check-in,
+first check-in of the day, last location and when it was seen) and checks each event against it
+when it is logged, so alerts reach `alerts_collection` in real time. Alerts
+carry a `dedup_key` (type, user, day) and are upserted, so the same alert is
+stored once whichever worker raises it.
+
+With several worker processes, a user's check-ins land in different
+workers. ANOMALY_SHARED_STATE keeps the per-user state in redis instead
+(`RedisUserStates`), so every worker checks an event against the user's
+whole history. The end-of-day duration check runs for everyone seen that
+day when the first event of the next day arrives: inline for the local
+state, in a background thread (one batched transaction per
+ANOMALY_CLOSE_BATCH_SIZE users) for the shared one, so that request does
+not wait on a scan of every user.
+
+Replay rebuilds the state from history (optionally emitting alerts):
+
+    python anomaly_stream.py --replay --source mongo --since 2024-01-01
+"""
+import argparse
+import json
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import geofence
+import settings
+from anomaly_detection import haversine_km
+
+
+def parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(str(value))
+
+
+def event_from_log(log):
+    """
+    normalise a mongo log document (name, role, user_id, timestamp, lat, long)
+    """
+    return {
+        'user_id': log.get('user_id'),
+        'name': log.get('name'),
+        'role': log.get('role'),
+        'timestamp': parse_timestamp(log['timestamp']),
+        'lat': log.get('lat'),
+        'long': log.get('long'),
+    }
+
+
+def _as_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if np.isnan(value) else value
+
+
+class _UserState:
+    __slots__ = ('user_id', 'name', 'role', 'day', 'first_in', 'last_time', 'last_lat', 'last_long',
+                 'last_loc_time')
+
+    def __init__(self, user_id, name, role):
+        self.user_id = user_id
+        self.name = name
+        self.role = role
+        self.day = None
+        self.first_in = None
+        self.last_time = None
+        self.last_lat = None
+        self.last_long = None
+        self.last_loc_time = None
+
+    def to_json(self):
+        return json.dumps({slot: getattr(self, slot) for slot in self.__slots__}, default=str)
+
+    @classmethod
+    def from_json(cls, value):
+        data = json.loads(value)
+        state = cls(data['user_id'], data['name'], data['role'])
+        state.day = datetime.fromisoformat(data['day']).date() if data['day'] else None
+        for slot in ('first_in', 'last_time', 'last_loc_time'):
+            setattr(state, slot, datetime.fromisoformat(data[slot]) if data[slot] else None)
+        state.last_lat, state.last_long = data['last_lat'], data['last_long']
+        return state
+
+
+class RedisUserStates:
+    """
+    per-user detector state in redis, one key per user. A batch of events
+    is checked inside a WATCH on its users' keys, so two workers never
+    update the same user from a stale state (the loser checks again).
+    """
+    def __init__(self, r, prefix='anomaly:state:', closed_prefix='anomaly:closed:', ttl_seconds=2 * 86400):
+        self.r = r
+        self.prefix = prefix
+        self.closed_prefix = closed_prefix
+        # yesterday's state is still needed for impossible travel across midnight
+        self.ttl_seconds = ttl_seconds
+
+    def update(self, user_keys, check):
+        """
+        check(states) with {user_key: state} of `user_keys` (missing ones
+        absent), then store the states it returns; returns what check returned
+        """
+        user_keys = sorted(user_keys)
+        keys = [self.prefix + user_key for user_key in user_keys]
+
+        def attempt(pipe):
+            states = {user_key: _UserState.from_json(value)
+                      for user_key, value in zip(user_keys, pipe.mget(keys)) if value is not None}
+            result, changed = check(states)
+            pipe.multi()
+            for user_key, state in changed.items():
+                pipe.set(self.prefix + user_key, state.to_json(), ex=self.ttl_seconds)
+            return result
+
+        return self.r.transaction(attempt, *keys, value_from_callable=True)
+
+    def user_keys(self):
+        return [key.decode()[len(self.prefix):] for key in self.r.scan_iter(match=self.prefix + '*', count=1000)]
+
+    def claim_day(self, day):
+        # one worker closes a day
+        return bool(self.r.set(f'{self.closed_prefix}{day}', 1, nx=True, ex=self.ttl_seconds))
+
+
+class MongoAlertSink:
+    """
+    writes alerts into the alerts collection, once per dedup_key
+    """
+    def __init__(self, collection):
+        self.collection = collection
+        self._indexed = False
+
+    def __call__(self, alerts):
+        from pymongo import UpdateOne
+
+        if not self._indexed:
+            # the sample alerts have no dedup_key, hence sparse
+            self.collection.create_index('dedup_key', unique=True, sparse=True)
+            self._indexed = True
+        ops = [UpdateOne({'dedup_key': alert['dedup_key']}, {'$setOnInsert': alert}, upsert=True)
+               for alert in alerts]
+        result = self.collection.bulk_write(ops, ordered=False)
+        # only the alerts that did not exist yet, with their new _id
+        return [dict(alerts[i], _id=_id) for i, _id in result.upserted_ids.items()]
+
+
+class OnlineAnomalyDetector:
+    def __init__(self, alert_sink=None, time_window_minutes=5, min_duration_hours=4,
+                 expected_location=None, threshold_km=1.0, site_registry=None, assignments=None,
+                 max_speed_kmh=150.0, min_travel_km=2.0, shared_states=None):
+        self.alert_sink = alert_sink
+        self.shared_states = shared_states
+        self.time_window = timedelta(minutes=time_window_minutes)
+        self.min_duration = timedelta(hours=min_duration_hours)
+        self.expected_location = expected_location
+        self.threshold_km = threshold_km
+        self.max_speed_kmh = max_speed_kmh
+        self.min_travel_km = min_travel_km
+        # multi-site geofences take over from the single expected location
+        self.site_registry = site_registry
+        self.assignments = assignments or {}
+        self._users = {}
+        self._raised = set()  # dedup keys already emitted by this process
+        self._raised_day = None
+        self._day = None  # latest day seen, for the end-of-day check
+        # called with the alerts of a day closed in the background (shared state)
+        self.on_alerts = None
+        self._lock = threading.Lock()
+
+    def _alert(self, alerts, state, user_key, alert_type, risk, description, when):
+        dedup_key = f'{alert_type}|{user_key}|{when.date()}'
+        # marked raised by process_many once the check is committed
+        if dedup_key in self._raised or any(alert['dedup_key'] == dedup_key for alert in alerts):
+            return
+        alerts.append({
+            'type': alert_type,
+            'user': state.name,
+            'user_id': state.user_id,
+            'role': state.role,
+            'description': description,
+            'risk_level': risk,
+            'time': when.strftime('%Y-%m-%d %H:%M:%S'),
+            'status': 'pending',
+            'reviewed_by': None,
+            'reviewed_at': None,
+            'dedup_key': dedup_key,
+        })
+
+    def _close_day(self, alerts, state, user_key):
+        # the day of `state` is over: was the user present long enough?
+        if state.first_in is None or state.last_time is None:
+            return
+        duration = state.last_time - state.first_in
+        if duration < self.min_duration:
+            hours = round(duration.total_seconds() / 3600, 2)
+            self._alert(alerts, state, user_key, 'Short Duration', 'High',
+                        f"User '{state.name}' was present for {hours} hours on {state.day}", state.last_time)
+        # checked once: the user's next check-in starts a new day
+        state.first_in = None
+
+    @staticmethod
+    def user_key(event):
+        return event.get('user_id') or f"{event['name']}@{event['role']}"
+
+    def _check(self, event, alerts, users):
+        user_key = self.user_key(event)
+        ts = event['timestamp']
+        state = users.get(user_key)
+        if state is None:
+            state = users[user_key] = _UserState(event.get('user_id'), event['name'], event['role'])
+
+        if self._raised_day != ts.date():
+            # dedup keys are per day, older ones can never match again
+            self._raised = {key for key in self._raised if key.endswith(str(ts.date()))}
+            self._raised_day = ts.date()
+
+        # 1. Multiple check-ins
+        if state.last_time is not None and timedelta(0) <= ts - state.last_time < self.time_window:
+            minutes = int((ts - state.last_time).total_seconds() // 60)
+            self._alert(alerts, state, user_key, 'Multiple Check-in', 'Medium',
+                        f"User '{state.name}' checked in again within {minutes} mins", ts)
+
+        # 2. Location mismatch
+        lat, long = _as_float(event.get('lat')), _as_float(event.get('long'))
+        if self.site_registry and lat is not None and long is not None:
+            allowed = self.assignments.get(state.user_id) or self.assignments.get(state.name)
+            site, dist = self.site_registry.locate(lat, long, allowed)
+            if site is None:
+                where = 'away from any registered site' if dist == float('inf') else f'{dist:.2f} km from the nearest assigned site'
+                self._alert(alerts, state, user_key, 'Location Mismatch', 'High',
+                            f"User '{state.name}' checked in {where}", ts)
+        elif self.expected_location and lat is not None and long is not None:
+            dist = float(haversine_km(lat, long, self.expected_location['lat'], self.expected_location['long']))
+            if dist > self.threshold_km:
+                self._alert(alerts, state, user_key, 'Location Mismatch', 'High',
+                            f"User '{state.name}' checked in {dist:.2f} km from site", ts)
+
+        # 3. Impossible travel since the previous located check-in
+        if lat is not None and long is not None and state.last_loc_time is not None and ts >= state.last_loc_time:
+            dist = float(haversine_km(state.last_lat, state.last_long, lat, long))
+            hours = (ts - state.last_loc_time).total_seconds() / 3600
+            if dist > self.min_travel_km and (hours <= 0 or dist / hours > self.max_speed_kmh):
+                self._alert(alerts, state, user_key, 'Impossible Travel', 'High',
+                            f"User '{state.name}' moved {dist:.1f} km in {int(hours * 60)} mins", ts)
+
+        # 4. Day boundary: first-in of the new day, duration check of the old one
+        if state.day != ts.date():
+            if state.day is not None and ts.date() > state.day:
+                self._close_day(alerts, state, user_key)
+            if state.day is None or ts.date() > state.day:
+                state.day = ts.date()
+                state.first_in = ts
+                state.last_time = None
+        if state.last_time is None or ts > state.last_time:
+            state.last_time = ts
+        if lat is not None and long is not None and (state.last_loc_time is None or ts >= state.last_loc_time):
+            state.last_lat, state.last_long, state.last_loc_time = lat, long, ts
+
+    def _check_all(self, events, users):
+        alerts = []
+        with self._lock:
+            for event in events:
+                self._check(event, alerts, users)
+        return alerts
+
+    def _emit(self, alerts, emit):
+        with self._lock:
+            self._raised.update(alert['dedup_key'] for alert in alerts)
+        if emit and alerts and self.alert_sink is not None:
+            try:
+                alerts = self.alert_sink(alerts)
+            except Exception as e:
+                print(f"Error writing alerts: {e}")
+        return alerts
+
+    def process_many(self, events, emit=True):
+        """
+        update the state with new events and return the alerts raised
+        (the end-of-day check of the previous day included, when these
+        events start a new day; with shared state it runs in the
+        background and its alerts go to `on_alerts`)
+        """
+        events = list(events)
+        if not events:
+            return []
+        if self.shared_states is None:
+            alerts = self._check_all(events, self._users)
+        else:
+            def check(states):
+                found = self._check_all(events, states)
+                return found, states
+            alerts = self.shared_states.update({self.user_key(event) for event in events}, check)
+
+        latest = max(event['timestamp'] for event in events).date()
+        previous, self._day = self._day, max(latest, self._day or latest)
+        if previous is not None and latest > previous:
+            if self.shared_states is None:
+                alerts += self.close_day(latest, emit=False)
+            else:
+                threading.Thread(target=self._close_day_in_background, args=(latest, emit),
+                                 name='anomaly-close-day', daemon=True).start()
+        return self._emit(alerts, emit)
+
+    def _close_day_in_background(self, before, emit):
+        try:
+            alerts = self.close_day(before, emit=emit)
+            if alerts and self.on_alerts is not None:
+                self.on_alerts(alerts)
+        except Exception as e:
+            print(f"Error closing the day: {e}")
+
+    def process(self, event, emit=True):
+        return self.process_many([event], emit=emit)
+
+    def close_day(self, before, emit=True, batch_size=settings.ANOMALY_CLOSE_BATCH_SIZE):
+        """
+        run the end-of-day duration check for every user whose last day
+        is before `before` and was not checked yet (shared state: one
+        transaction per `batch_size` users)
+        """
+        if self.shared_states is None:
+            alerts = []
+            with self._lock:
+                for user_key, state in self._users.items():
+                    if state.day is not None and state.day < before:
+                        self._close_day(alerts, state, user_key)
+            return self._emit(alerts, emit)
+        if not self.shared_states.claim_day(before):
+            return []
+        def check(states):
+            found, changed = [], {}
+            for user_key, state in states.items():
+                if state.day is not None and state.day < before:
+                    self._close_day(found, state, user_key)
+                    changed[user_key] = state
+            return found, changed
+
+        alerts = []
+        user_keys = self.shared_states.user_keys()
+        for start in range(0, len(user_keys), batch_size):
+            batch = user_keys[start:start + batch_size]
+            try:
+                alerts += self.shared_states.update(batch, check)
+            except Exception as e:
+                print(f"Error closing the day of {len(batch)} users: {e}")
+        return self._emit(alerts, emit)
+
+    def replay(self, events, emit=False):
+        """
+        rebuild the state from historical events, in timestamp order.
+        With emit=False nothing is written, only the state is restored.
+        """
+        with self._lock:
+            self._users.clear()
+            self._raised.clear()
+            self._raised_day = None
+            self._day = None
+        return self.process_many(sorted(events, key=lambda event: event['timestamp']), emit=emit)
+
+    def __len__(self):
+        return len(self._users)
+
+
+def mongo_events(logs_collection, since=None):
+    query = {'timestamp': {'$gte': str(since)}} if since is not None else {}
+    projection = {'_id': 0, 'user_id': 1, 'name': 1, 'role': 1, 'timestamp': 1, 'lat': 1, 'long': 1}
+    for log in logs_collection.find(query, projection).sort('timestamp', 1):
+        if log.get('name') and log.get('name') != 'Unknown' and log.get('timestamp'):
+            yield event_from_log(log)
+
+
+def redis_events(r, since=None):
+    from attendance_logs import load_logs
+
+    logs_df = load_logs(r)
+    if since is not None:
+        logs_df = logs_df[logs_df['Timestamp'] >= since]
+    for name, role, ts, lat, long in logs_df[['Name', 'Role', 'Timestamp', 'Lat', 'Long']].itertuples(index=False):
+        yield {'user_id': None, 'name': name, 'role': role, 'timestamp': ts.to_pydatetime(),
+               'lat': lat, 'long': long}
+
+
+def expected_location_from_settings():
+    if settings.SITE_LAT is None or settings.SITE_LONG is None:
+        return None
+    return {'lat': settings.SITE_LAT, 'long': settings.SITE_LONG}
+
+
+def make_detector(alerts_collection, site_registry=None, assignments=None, shared=None):
+    if site_registry is None:
+        site_registry, assignments = geofence.load_default_registry()
+    shared = settings.ANOMALY_SHARED_STATE if shared is None else shared
+    shared_states = None
+    if shared:
+        import db_clients
+        shared_states = RedisUserStates(db_clients.redis_client)
+    return OnlineAnomalyDetector(
+        alert_sink=MongoAlertSink(alerts_collection),
+        time_window_minutes=settings.ANOMALY_CHECKIN_WINDOW_MINUTES,
+        min_duration_hours=settings.ANOMALY_MIN_DURATION_HOURS,
+        expected_location=expected_location_from_settings(),
+        threshold_km=settings.ANOMALY_LOCATION_THRESHOLD_KM,
+        site_registry=site_registry,
+        assignments=assignments,
+        max_speed_kmh=settings.ANOMALY_MAX_SPEED_KMH,
+        min_travel_km=settings.ANOMALY_MIN_TRAVEL_KM,
+        shared_states=shared_states,
+    )
+
+
+def main():
+    import db_clients
+
+    parser = argparse.ArgumentParser(description='Replay attendance history through the online anomaly detector')
+    parser.add_argument('--replay', action='store_true', required=True)
+    parser.add_argument('--source', choices=['mongo', 'redis'], default='mongo')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='only replay logs from this date')
+    parser.add_argument('--emit', action='store_true', help='write the alerts found into alerts_collection')
+    args = parser.parse_args()
+
+    # a replay rebuilds the state of this process only
+    detector = make_detector(db_clients.collection('alerts'), shared=False)
+    if args.source == 'mongo':
+        events = list(mongo_events(db_clients.collection('logs'), args.since))
+    else:
+        events = list(redis_events(db_clients.get_redis(), args.since))
+    alerts = detector.replay(events, emit=args.emit)
+    print(f"Replayed {len(events)} events for {len(detector)} users, {len(alerts)} alerts"
+          f"{' written' if args.emit else ' found'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Per-person cooldown for attendance events.
+
+A recognised face produces an event on every frame; only the first event of
+a person within `cooldown` seconds is kept. Seen keys live in an in-memory
+LRU with expiry and, optionally, in redis (`SET NX EX`) so that several
+workers agree on who was already logged.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import db_clients
+import settings
+
+
+class CooldownFilter:
+    def __init__(self, cooldown=settings.ATTENDANCE_COOLDOWN_SECONDS,
+                 max_entries=settings.ATTENDANCE_COOLDOWN_MAX_ENTRIES,
+                 redis=None, prefix='attendance:cooldown:'):
+        self.cooldown = cooldown
+        self.max_entries = max_entries
+        self.redis = redis
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        # key -> expiry; every key gets the same cooldown, so insertion order is expiry order
+        self._expires = OrderedDict()
+
+    def _evict(self, now):
+        while self._expires:
+            key, expires = next(iter(self._expires.items()))
+            if expires > now and len(self._expires) <= self.max_entries:
+                break
+            self._expires.popitem(last=False)
+
+    def allow(self, key, now=None):
+        """
+        True if `key` has not been accepted within the cooldown, recording it
+        """
+        if self.cooldown <= 0:
+            return True
+        now = time.time() if now is None else now
+        # check and record in one hold of the lock, so two concurrent
+        # snapshots of the same person cannot both be accepted
+        with self._lock:
+            self._evict(now)
+            if key in self._expires:
+                return False
+            self._expires[key] = now + self.cooldown
+            self._evict(now)
+
+        if self.redis is not None:
+            try:
+                if not self.redis.set(self.prefix + key, 1, nx=True, ex=max(1, math.ceil(self.cooldown))):
+                    # another worker logged this person already (kept locally as well)
+                    return False
+            except Exception as e:
+                # fail open: losing the shared view must not lose attendance
+                print(f"Cooldown redis check failed: {e}")
+        return True
+
+    def release(self, key):
+        """
+        forget `key` (its log could not be written), so the next sighting is accepted
+        """
+        with self._lock:
+            self._expires.pop(key, None)
+        if self.redis is not None:
+            try:
+                self.redis.delete(self.prefix + key)
+            except Exception as e:
+                print(f"Cooldown redis release failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+
+    def __len__(self):
+        return len(self._expires)
+
+
+_default_filter = None
+_default_lock = threading.Lock()
+
+
+def make_cooldown_filter():
+    """
+    the process-wide filter configured from settings, so pages and cameras
+    that get re-created on every rerun keep their cooldown state
+    """
+    global _default_filter
+    with _default_lock:
+        if _default_filter is None:
+            redis = db_clients.redis_client if settings.ATTENDANCE_COOLDOWN_SHARED else None
+            _default_filter = CooldownFilter(redis=redis)
+        return _default_filter
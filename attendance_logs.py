@@ -0,0 +1,169 @@
+"""
+Shared access to the attendance logs kept in the redis list `attendance:logs`.
+
+The reporting pages used to LRANGE and re-parse the whole list on every
+Streamlit rerun. `load_logs` keeps the parsed dataframe per process and only
+fetches the entries pushed since the previous call; `invalidate_logs` drops
+the cache when the list is edited out of band.
+"""
+import csv
+import io
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+LOGS_KEY = 'attendance:logs'
+LOG_COLUMNS = ['Name', 'Role', 'Timestamp', 'Lat', 'Long']
+_LOG_DTYPES = {'Name': 'category', 'Role': 'category', 'Timestamp': str,
+               'Lat': np.float32, 'Long': np.float32, '_extra': str}
+# missing values only where a field can be missing: a person may well be called 'None'
+_NA_VALUES = {'Timestamp': ['', 'None', 'nan'], 'Lat': ['', 'None', 'nan'], 'Long': ['', 'None', 'nan'],
+              '_extra': ['']}
+
+
+def empty_logs():
+    return pd.DataFrame({
+        'Name': pd.Series(dtype='category'),
+        'Role': pd.Series(dtype='category'),
+        'Timestamp': pd.Series(dtype='datetime64[ns]'),
+        'Lat': pd.Series(dtype=np.float32),
+        'Long': pd.Series(dtype=np.float32),
+        'Date': pd.Series(dtype='datetime64[ns]'),
+    })
+
+
+def parse_logs(logs_list):
+    """
+    parse raw redis entries (name@role@timestamp[@lat@long]) into a typed
+    dataframe: categorical Name/Role, datetime64 Timestamp/Date and float32
+    Lat/Long. Legacy 3-field entries get NaN coordinates; entries with any
+    other number of fields or an unparsable timestamp are dropped.
+    """
+    if len(logs_list) == 0:
+        return empty_logs()
+
+    # one C-level split over the joined buffer instead of a python loop per entry.
+    # The spare '_extra' column catches entries with more than five fields.
+    buffer = io.BytesIO(b'\n'.join(logs_list))
+    read_kwargs = dict(sep='@', header=None, names=LOG_COLUMNS + ['_extra'], index_col=False,
+                       quoting=csv.QUOTE_NONE, on_bad_lines='skip',
+                       na_values=_NA_VALUES, keep_default_na=False)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', pd.errors.ParserWarning)
+        try:
+            logs_df = pd.read_csv(buffer, dtype=_LOG_DTYPES, **read_kwargs)
+        except ValueError:
+            # non numeric coordinates somewhere, coerce them to NaN instead
+            buffer.seek(0)
+            logs_df = pd.read_csv(buffer, dtype=dict(_LOG_DTYPES, Lat=str, Long=str), **read_kwargs)
+            for col in ['Lat', 'Long']:
+                logs_df[col] = pd.to_numeric(logs_df[col], errors='coerce').astype(np.float32)
+
+    logs_df['Timestamp'] = pd.to_datetime(logs_df['Timestamp'], format='ISO8601', errors='coerce')
+    # 4-field entries (lat without long) are malformed, as are entries without a timestamp
+    valid = (logs_df['Timestamp'].notna() & logs_df['_extra'].isna()
+             & (logs_df['Lat'].isna() | logs_df['Long'].notna()))
+    logs_df = logs_df.drop(columns='_extra')
+    if not valid.all():
+        logs_df = logs_df[valid].reset_index(drop=True)
+        for col in ['Name', 'Role']:
+            logs_df[col] = logs_df[col].cat.remove_unused_categories()
+    logs_df['Date'] = logs_df['Timestamp'].dt.normalize()
+    return logs_df
+
+
+def concat_logs(frames):
+    """
+    concatenate parsed log frames keeping Name/Role categorical
+    """
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return empty_logs()
+    logs_df = pd.concat(frames, ignore_index=True)
+    for col in ['Name', 'Role']:
+        if not isinstance(logs_df[col].dtype, pd.CategoricalDtype):
+            logs_df[col] = union_categoricals([frame[col] for frame in frames], ignore_order=True)
+    return logs_df
+
+
+def daily_report(logs_df):
+    """
+    one row per Date/Name/Role with the first (In_Time) and last (Out_Time)
+    check-in, the Duration between them and Duration_hours as a float
+    """
+    report_df = logs_df.groupby(by=['Date', 'Name', 'Role'], observed=True).agg(
+        In_Time=pd.NamedAgg('Timestamp', 'min'),
+        Out_Time=pd.NamedAgg('Timestamp', 'max')
+    ).reset_index()
+    report_df['Duration'] = report_df['Out_Time'] - report_df['In_Time']
+    report_df['Duration_hours'] = report_df['Duration'].dt.seconds / 3600
+    return report_df
+
+
+def fetch_new_entries(r, consumed, name=LOGS_KEY):
+    """
+    return (list length, entries pushed since `consumed` entries were read).
+    New logs are LPUSHed, so the unread entries are everything except the
+    last `consumed` ones. Both commands run in one MULTI block so a concurrent
+    push can never be skipped.
+    """
+    pipe = r.pipeline(transaction=True)
+    pipe.llen(name)
+    pipe.lrange(name, 0, -(consumed + 1))
+    total, entries = pipe.execute()
+    return total, entries
+
+
+class LogCache:
+    def __init__(self, name=LOGS_KEY):
+        self.name = name
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        self._frame = None
+        self._consumed = 0
+
+    def load(self, r):
+        with self._lock:
+            if self._frame is not None:
+                total, entries = fetch_new_entries(r, self._consumed, self.name)
+                if total < self._consumed:
+                    # the list was trimmed or rebuilt, start over
+                    self.invalidate()
+            if self._frame is None:
+                total, entries = fetch_new_entries(r, 0, self.name)
+                self._frame = parse_logs(entries)
+            elif entries:
+                # newest entries first, same order as LRANGE 0 -1
+                self._frame = concat_logs([parse_logs(entries), self._frame])
+            self._consumed = total
+            # shallow copy: callers may add columns without touching the cache
+            return self._frame.copy(deep=False)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def load_logs(r, name=LOGS_KEY):
+    """
+    parsed logs dataframe, cached per process and refreshed incrementally
+    """
+    with _caches_lock:
+        cache = _caches.setdefault(name, LogCache(name))
+    return cache.load(r)
+
+
+def invalidate_logs(name=None):
+    """
+    drop the cached logs of `name` (every list when None)
+    """
+    with _caches_lock:
+        caches = list(_caches.values()) if name is None else [_caches[name]] if name in _caches else []
+    for cache in caches:
+        with cache._lock:
+            cache.invalidate()
@@ -0,0 +1,105 @@
+"""
+Speed and precision of the anomaly detectors and the daily report.
+
+Runs on `synthetic_logs` data with injected anomalies. For every size it
+times the daily in/out report and each detector. It then scores each
+detector's flagged (name, day) pairs against the injected ground truth:
+
+    python -m benchmarks.bench_anomalies --sizes 10000 1000000 10000000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+import geofence
+import synthetic_logs
+from anomaly_detection import AnomalyDetector
+from attendance_logs import daily_report
+
+# detector -> (injected types that explain a flag, injected type it should find)
+EXPECTED = {
+    'Multiple Check-ins': ({'Multiple Check-in'}, 'Multiple Check-in'),
+    'Short Duration': ({'Short Duration'}, 'Short Duration'),
+    # a hop to another campus is also outside the assigned one
+    'Location Mismatch': ({'Location Mismatch', 'Impossible Travel'}, 'Location Mismatch'),
+    'Impossible Travel': ({'Impossible Travel'}, 'Impossible Travel'),
+}
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def score(found, truth_df, anomaly_type):
+    explained, target = EXPECTED[anomaly_type]
+    flagged = set(zip(found['Name'].astype(str), pd.to_datetime(found['Timestamp']).dt.normalize()))
+    truth = truth_df[truth_df['Type'].isin(explained)]
+    explaining = set(zip(truth['Name'], truth['Date']))
+    wanted = truth[truth['Type'] == target]
+    wanted = set(zip(wanted['Name'], wanted['Date']))
+    precision = len(flagged & explaining) / len(flagged) if flagged else 1.0
+    recall = len(flagged & wanted) / len(wanted) if wanted else 1.0
+    return {'flagged': len(flagged), 'precision': round(precision, 4), 'recall': round(recall, 4)}
+
+
+def run(n, days, sites, events_per_day, anomaly_rate, seed):
+    users = max(int(np.ceil(n / (days * 0.9 * events_per_day))), 1)
+    gen_s, (logs_df, truth_df, site_list, assignments) = timed(
+        synthetic_logs.generate, users, days, sites, events_per_day,
+        anomaly_rate=anomaly_rate, seed=seed)
+    detector = AnomalyDetector()
+    row = {'rows': len(logs_df), 'users': users, 'days': days, 'sites': sites,
+           'injected': len(truth_df), 'generate_s': round(gen_s, 2)}
+
+    seconds, report_df = timed(daily_report, logs_df)
+    row['daily_report_s'] = round(seconds, 3)
+
+    checks = {
+        'Multiple Check-ins': lambda: detector.detect_multiple_checkins(logs_df),
+        'Short Duration': lambda: detector.detect_short_duration(report_df),
+        'Impossible Travel': lambda: detector.detect_impossible_travel(logs_df),
+    }
+    if sites == 1:
+        site = site_list[0]
+        checks['Location Mismatch'] = lambda: detector.detect_location_mismatch(logs_df, site['lat'], site['long'])
+    else:
+        registry = geofence.SiteRegistry(geofence.Site(**site) for site in site_list)
+        checks['Location Mismatch'] = lambda: detector.detect_site_mismatch(logs_df, registry, assignments)
+
+    for anomaly_type, check in checks.items():
+        seconds, found = timed(check)
+        key = anomaly_type.lower().replace(' ', '_').replace('-', '_')
+        row[f'{key}_s'] = round(seconds, 3)
+        row[key] = score(found, truth_df, anomaly_type)
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000])
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--sites', type=int, default=3)
+    parser.add_argument('--events-per-day', type=int, default=4)
+    parser.add_argument('--anomaly-rate', type=float, default=0.02)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for n in args.sizes:
+        row = run(n, args.days, args.sites, args.events_per_day, args.anomaly_rate, args.seed)
+        results.append(row)
+        print(json.dumps(row))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""
+End-to-end timings of the recognition and logging paths, offline.
+
+Redis and MongoDB are in-process stand-ins (fakeredis, mongomock) unless
+`--redis-url` / `--mongo-uri` point at local servers. The app's own code
+runs against them: face_rec / camera (which need insightface and the model
+files, as the app does). Faces come from cached embeddings: a stand-in for
+the face model returns the same faces, taken from the gallery plus noise,
+for every snapshot. Pass `--image` to run the real model on a photo.
+
+For every gallery size:
+- the gallery load (`face_rec.retrive_data` from the redis hash and
+  `camera.retrive_data` from the users collection, up to `--mongo-max` users)
+- the per-face match (`camera.ml_search_algorithm`, the snapshot path, and
+  the normalised matrix product of the batch path)
+- the whole `process_snapshot`
+
+Once, independent of the gallery:
+- the log write throughput (`camera.save_logs`, `RealTimePred.saveLogs_redis`)
+- the report (`attendance_logs.load_logs` + `daily_report`)
+
+    python -m benchmarks.bench_end_to_end --sizes 1000 10000 100000 --json results/HEAD.json
+    python -m benchmarks.bench_end_to_end --compare results/base.json results/HEAD.json
+
+A local server's `academy:register` / `attendance:logs` keys and `users` /
+`logs` collections are emptied: point it at a scratch database.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import db_clients
+import settings
+import synthetic_logs
+from gallery_audit import EMBEDDING_DIM, REGISTER_KEY
+
+# fields compared by --compare: timings (lower is better) and throughputs (higher is better)
+TIME_SUFFIXES = ('_s', '_ms')
+RATE_SUFFIX = '_per_s'
+
+
+class CachedFaces:
+    """
+    stands in for FaceAnalysis: the same faces (bbox and embedding) for every frame
+    """
+    def __init__(self, faces):
+        self.faces = faces
+
+    def get(self, frame, max_num=0):
+        return [dict(face) for face in self.faces]
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def latency_ms(func, repeat):
+    """
+    mean / p50 / p95 / max in milliseconds of `repeat` calls
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples = np.asarray(samples)
+    return {'mean_ms': round(float(samples.mean()), 3), 'p50_ms': round(float(np.percentile(samples, 50)), 3),
+            'p95_ms': round(float(np.percentile(samples, 95)), 3), 'max_ms': round(float(samples.max()), 3)}
+
+
+def make_gallery(n, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((n, EMBEDDING_DIM), dtype=np.float32)
+    names = [f'Person{i:07d}' for i in range(n)]
+    return names, embeddings
+
+
+def query_faces(embeddings, faces, seed=1):
+    """
+    `faces` known faces (gallery rows plus noise) and one unknown, with boxes in a 640x480 frame
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeddings), size=min(faces, len(embeddings)), replace=False)
+    vectors = [embeddings[row] + 0.3 * rng.standard_normal(EMBEDDING_DIM, dtype=np.float32) for row in rows]
+    vectors.append(rng.standard_normal(EMBEDDING_DIM, dtype=np.float32))
+    boxes = []
+    for k in range(len(vectors)):
+        x, y = 20 + (k % 6) * 100, 20 + (k // 6) * 120
+        boxes.append(np.array([x, y, x + 80, y + 100], dtype=np.float32))
+    return [{'bbox': box, 'embedding': vector, 'det_score': 0.9} for box, vector in zip(boxes, vectors)]
+
+
+def fill_stores(r, users_collection, names, embeddings, mongo_max):
+    r.delete(REGISTER_KEY)
+    for start in range(0, len(names), 10000):
+        chunk = slice(start, start + 10000)
+        r.hset(REGISTER_KEY, mapping={f'{name}@Student': vector.tobytes()
+                                      for name, vector in zip(names[chunk], embeddings[chunk])})
+    users_collection.delete_many({})
+    if len(names) <= mongo_max:
+        for start in range(0, len(names), 10000):
+            users_collection.insert_many([
+                {'user_id': f'STU-{i:07d}', 'name': names[i], 'role': 'Student', 'embedding': embeddings[i].tolist()}
+                for i in range(start, min(start + 10000, len(names)))])
+
+
+def run_gallery(n, args, face_rec, camera, pred, image_bytes):
+    import pandas as pd
+    from attendance_cooldown import CooldownFilter
+
+    names, embeddings = make_gallery(n, args.seed)
+    r = db_clients.get_redis()
+    row = {'gallery': n}
+    row['fill_s'] = round(timed(fill_stores, r, camera.users_collection, names, embeddings, args.mongo_max)[0], 3)
+
+    # gallery loads
+    seconds, redis_df = timed(face_rec.retrive_data, name=REGISTER_KEY)
+    row['retrive_data_redis_s'] = round(seconds, 3)
+    del redis_df
+    if n <= args.mongo_max:
+        row['retrive_data_mongo_s'] = round(timed(camera.retrive_data, name=REGISTER_KEY)[0], 3)
+    else:
+        row['retrive_data_mongo_s'] = None  # above --mongo-max
+
+    # the gallery a snapshot matches against, whatever the load path
+    pred.redis_face_db = pd.DataFrame({'user_id': [f'STU-{i:07d}' for i in range(n)], 'Name': names,
+                                       'Role': 'Student', 'facial_features': list(embeddings)})
+    faces = query_faces(embeddings, args.faces, args.seed + 1)
+    repeat = max(3, args.repeat if n < 100000 else args.repeat // 10)
+
+    # per-face matching
+    query = faces[0]['embedding']
+    row['match_dataframe'] = latency_ms(lambda: camera.ml_search_algorithm(
+        pred.redis_face_db, 'facial_features', query, ['Name', 'Role'], thresh=0.5), repeat)
+    row['gallery_matrix_s'] = round(timed(pred.gallery_matrix)[0], 3)
+    matrix = pred.gallery_matrix()
+    row['match_matrix'] = latency_ms(lambda: (matrix @ (query / np.linalg.norm(query))).argmax(), repeat)
+
+    # the whole snapshot; no cooldown, so every snapshot writes its logs
+    if image_bytes is None:
+        camera.faceapp = CachedFaces(faces)
+    pred.cooldown = CooldownFilter(cooldown=0)
+    _, people, _ = pred.process_snapshot(snapshot_bytes(image_bytes), 17.6868, 83.2185)
+    row['snapshot_faces'] = len(faces) if image_bytes is None else None
+    row['snapshot_recognised'] = len(people)
+    row['process_snapshot'] = latency_ms(
+        lambda: pred.process_snapshot(snapshot_bytes(image_bytes), 17.6868, 83.2185), repeat)
+    return row
+
+
+_noise_frame = None
+
+
+def snapshot_bytes(image_bytes):
+    # a 640x480 noise JPEG when the cached faces stand in for the model
+    global _noise_frame
+    if image_bytes is not None:
+        return image_bytes
+    if _noise_frame is None:
+        import cv2
+        frame = np.random.default_rng(0).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+        _noise_frame = cv2.imencode('.jpg', frame)[1].tobytes()
+    return _noise_frame
+
+
+def run_logs(args, face_rec, camera):
+    import attendance_logs
+
+    logs_df, _, _, _ = synthetic_logs.generate(users=max(1, args.logs // 100), days=30, sites=1,
+                                               events_per_day=4, seed=args.seed)
+    logs_df = logs_df.iloc[:args.logs]
+    row = {'logs': len(logs_df)}
+
+    # mongo: save_logs in snapshot-sized batches (insert + online anomaly checks)
+    docs = synthetic_logs.to_mongo_docs(logs_df)
+    camera.logs_collection.delete_many({})
+    batch = args.log_batch
+    seconds = timed(lambda: [camera.save_logs([dict(doc) for doc in docs[i:i + batch]])
+                             for i in range(0, len(docs), batch)])[0]
+    row['save_logs_s'] = round(seconds, 3)
+    row['save_logs_per_s'] = round(len(docs) / seconds, 1)
+
+    # redis: the Streamlit write path, one saveLogs_redis per batch
+    r = db_clients.get_redis()
+    r.delete(attendance_logs.LOGS_KEY)
+    pred = face_rec.RealTimePred()
+    names, roles = logs_df['Name'].tolist(), logs_df['Role'].tolist()
+    stamps = logs_df['Timestamp'].astype(str).tolist()
+
+    def push_redis():
+        for i in range(0, len(names), batch):
+            # distinct names per batch: saveLogs_redis keeps one entry per name
+            pred.logs = dict(name=[f'{name}#{i}' for name in names[i:i + batch]], role=roles[i:i + batch],
+                             current_time=stamps[i:i + batch], lat=[17.6868] * len(names[i:i + batch]),
+                             long=[83.2185] * len(names[i:i + batch]))
+            pred.saveLogs_redis()
+    seconds = timed(push_redis)[0]
+    row['save_logs_redis_s'] = round(seconds, 3)
+    row['save_logs_redis_per_s'] = round(len(names) / seconds, 1)
+
+    # report: the synthetic entries as the report pages read them
+    r.delete(attendance_logs.LOGS_KEY)
+    entries = synthetic_logs.to_redis_entries(logs_df)
+    for i in range(0, len(entries), 10000):
+        r.rpush(attendance_logs.LOGS_KEY, *entries[i:i + 10000])
+    attendance_logs.invalidate_logs()
+    seconds, parsed = timed(attendance_logs.load_logs, r)
+    row['load_logs_s'] = round(seconds, 3)
+    row['daily_report_s'] = round(timed(attendance_logs.daily_report, parsed)[0], 3)
+    return row
+
+
+def environment(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'backend': 'local' if args.redis_url or args.mongo_uri else 'stand-in', 'args': vars(args)}
+
+
+def connect(args):
+    """
+    the stand-ins (or local servers) installed in db_clients before the app modules load
+    """
+    if args.redis_url:
+        import redis
+        redis_client = redis.Redis.from_url(args.redis_url)
+    else:
+        import fakeredis
+        redis_client = fakeredis.FakeRedis()
+    if args.mongo_uri:
+        import pymongo
+        mongo_client = pymongo.MongoClient(args.mongo_uri)
+    else:
+        import mongomock
+        mongo_client = mongomock.MongoClient()
+    settings.MONGO_DB = args.mongo_db
+    db_clients.use(redis=redis_client, mongo=mongo_client)
+
+
+def flatten(row, prefix=''):
+    flat = {}
+    for key, value in row.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(base_path, new_path, tolerance):
+    """
+    print the timings of two result files side by side, flagging the slower ones
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{base['environment'].get('commit')} -> {new['environment'].get('commit')}")
+    regressions = 0
+    for section in ('galleries', 'logs'):
+        old_rows = base[section] if section == 'galleries' else [base[section]]
+        new_rows = new[section] if section == 'galleries' else [new[section]]
+        key = 'gallery' if section == 'galleries' else 'logs'
+        old_by_key = {row[key]: flatten(row) for row in old_rows}
+        for row in new_rows:
+            old = old_by_key.get(row[key])
+            if old is None:
+                continue
+            for name, value in flatten(row).items():
+                before = old.get(name)
+                if not name.endswith(TIME_SUFFIXES) or not value or not before:
+                    continue
+                ratio = value / before
+                slower = ratio < 1 / tolerance if name.endswith(RATE_SUFFIX) else ratio > tolerance
+                flag = '  SLOWER' if slower else ''
+                regressions += bool(flag)
+                print(f"{key}={row[key]:<9} {name:<32} {before:>12.3f} {value:>12.3f}  x{ratio:.2f}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='gallery sizes (1000000 needs about 8 GB of memory)')
+    parser.add_argument('--faces', type=int, default=5, help='known faces per snapshot (plus one unknown)')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--image', help='run the real face model on this photo instead of cached faces')
+    parser.add_argument('--mongo-max', type=int, default=100000,
+                        help='largest gallery also loaded into the users collection')
+    parser.add_argument('--logs', type=int, default=100000, help='log rows for the write and report timings')
+    parser.add_argument('--log-batch', type=int, default=40, help='logs per write (a classroom snapshot)')
+    parser.add_argument('--redis-url', help='a local redis instead of the in-process stand-in')
+    parser.add_argument('--mongo-uri', help='a local mongod instead of the in-process stand-in')
+    parser.add_argument('--mongo-db', default='face_attendance_bench')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two result files instead of running')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='slowdown ratio flagged by --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.tolerance) else 0)
+
+    connect(args)
+    # the app modules, against the stand-ins; metrics off so the model stand-in is called directly
+    import metrics
+    metrics.ENABLED = False
+    sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'flask_app'))
+    import face_rec
+    import camera
+
+    image_bytes = None
+    if args.image:
+        with open(args.image, 'rb') as f:
+            image_bytes = f.read()
+    pred = camera.RealTimePred()
+
+    results = {'environment': environment(args), 'galleries': [], 'logs': None}
+    for n in args.sizes:
+        row = run_gallery(n, args, face_rec, camera, pred, image_bytes)
+        results['galleries'].append(row)
+        print(json.dumps(row))
+    results['logs'] = run_logs(args, face_rec, camera)
+    print(json.dumps(results['logs']))
+
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
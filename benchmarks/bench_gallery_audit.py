@@ -0,0 +1,68 @@
+"""
+Speed of the duplicate enrolment scan and of the enrolment-time check.
+
+Random unit embeddings stand in for the gallery, with a few planted
+near-duplicates (the same face enrolled twice plus a little noise):
+
+    python -m benchmarks.bench_gallery_audit --sizes 10000 100000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from gallery_audit import EMBEDDING_DIM, GalleryIndex, find_duplicate_pairs
+
+
+def make_gallery(n, duplicates=50, noise=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal((n, EMBEDDING_DIM), dtype=np.float32)
+    # plant near-duplicates: row dst becomes a noisy copy of row src
+    src = rng.choice(n // 2, size=min(duplicates, n // 2), replace=False)
+    dst = src + n // 2
+    x[dst] = x[src] + noise * np.linalg.norm(x[src], axis=1, keepdims=True) * \
+        rng.standard_normal((len(src), EMBEDDING_DIM), dtype=np.float32) / np.sqrt(EMBEDDING_DIM)
+    return x, set(zip(src.tolist(), dst.tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--block-size', type=int, default=4096)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for n in args.sizes:
+        x, planted = make_gallery(n)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        rows, cols, sims = find_duplicate_pairs(x, args.threshold, args.block_size)
+        scan_s = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        found = set(zip(rows.tolist(), cols.tolist()))
+
+        index = GalleryIndex([str(i) for i in range(n)], x)
+        start = time.perf_counter()
+        for i in range(20):
+            index.match(x[i])
+        check_ms = (time.perf_counter() - start) / 20 * 1000
+
+        row = {'users': n, 'scan_s': round(scan_s, 2), 'scan_peak_mb': round(peak / 2**20, 1),
+               'pairs': len(found), 'planted_found': len(planted & found), 'planted': len(planted),
+               'enrol_check_ms': round(check_ms, 2)}
+        results.append(row)
+        print(row)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Parse time and memory of the attendance log parser.
+
+Compares `attendance_logs.parse_logs` against the per-entry parser the
+reporting pages used before, on synthetic redis entries (10% legacy
+3-field records):
+
+    python -m benchmarks.bench_log_parser --sizes 1000000 10000000
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from attendance_logs import parse_logs
+
+
+def legacy_parse_logs(logs_list):
+    # verbatim copy of the parser previously duplicated in pages/3-5
+    convert_byte_to_string = lambda x: x.decode('utf-8')
+    logs_list_string = list(map(convert_byte_to_string, logs_list))
+    split_string = lambda x: x.split('@')
+    logs_nested_list = list(map(split_string, logs_list_string))
+
+    processed_logs = []
+    for log in logs_nested_list:
+        if len(log) == 3:
+            processed_logs.append(log + [None, None])
+        elif len(log) == 5:
+            processed_logs.append(log)
+        else:
+            continue
+
+    logs_df = pd.DataFrame(processed_logs, columns=['Name', 'Role', 'Timestamp', 'Lat', 'Long'])
+    logs_df['Timestamp'] = pd.to_datetime(logs_df['Timestamp'])
+    logs_df['Date'] = logs_df['Timestamp'].dt.date
+    return logs_df
+
+
+def make_entries(n, n_users=2000, seed=0):
+    """
+    n synthetic redis entries: name@role@timestamp@lat@long
+    """
+    rng = np.random.default_rng(seed)
+    name_role = [f"User{u:05d}@{'Teacher' if u % 10 == 0 else 'Student'}" for u in range(n_users)]
+    users = rng.integers(0, n_users, n).tolist()
+    start = np.datetime64('2024-01-01T08:00:00', 'us')
+    offsets = np.sort(rng.integers(0, 90 * 86400 * 10**6, n)).astype('timedelta64[us]')
+    stamps = np.char.replace(np.datetime_as_string(start + offsets), 'T', ' ').tolist()
+    lat = np.round(17.6868 + rng.normal(0, 0.01, n), 6).tolist()
+    long = np.round(83.2185 + rng.normal(0, 0.01, n), 6).tolist()
+    full = (rng.random(n) >= 0.1).tolist()
+    return [(f'{name_role[u]}@{ts}@{la}@{lo}' if f else f'{name_role[u]}@{ts}').encode()
+            for u, ts, la, lo, f in zip(users, stamps, lat, long, full)]
+
+
+def measure(parser, entries):
+    gc.collect()
+    start = time.perf_counter()
+    frame = parser(entries)
+    elapsed = time.perf_counter() - start
+    frame_bytes = int(frame.memory_usage(deep=True).sum())
+    del frame
+
+    gc.collect()
+    tracemalloc.start()
+    parser(entries)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': round(elapsed, 3), 'frame_mb': round(frame_bytes / 2**20, 1),
+            'peak_mb': round(peak / 2**20, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000000, 10000000])
+    parser.add_argument('--skip-legacy', action='store_true', help='only time the vectorized parser')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = []
+    for n in args.sizes:
+        entries = make_entries(n)
+        parsers = [('vectorized', parse_logs)]
+        if not args.skip_legacy:
+            parsers.append(('legacy', legacy_parse_logs))
+        for label, fn in parsers:
+            row = dict(rows=n, parser=label, **measure(fn, entries))
+            results.append(row)
+            print(f"{n:>10,} rows  {label:<10}  {row['seconds']:>8.3f} s  "
+                  f"frame {row['frame_mb']:>8.1f} MB  peak {row['peak_mb']:>8.1f} MB")
+        del entries
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
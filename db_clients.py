@@ -0,0 +1,128 @@
+"""
+Redis and MongoDB clients shared by every module.
+
+Clients are built lazily from `settings` (pool sizes, timeouts, retries) and
+cached per process. A forked worker never reuses its parent's sockets: the
+cache is dropped in the child and the next access builds fresh clients.
+Modules keep module-level handles through the `redis_client` and
+`collection()` proxies, which resolve the current process' client on every
+attribute access.
+"""
+import os
+import threading
+
+import settings
+
+_lock = threading.Lock()
+_clients = {}
+_pid = os.getpid()
+
+
+def _reset_after_fork():
+    global _lock, _clients, _pid
+    _lock = threading.Lock()
+    _clients = {}
+    _pid = os.getpid()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get(key, factory):
+    if _pid != os.getpid():
+        _reset_after_fork()
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory()
+    return client
+
+
+def _make_redis():
+    import redis
+    from redis.backoff import ExponentialBackoff
+    from redis.retry import Retry
+
+    pool = redis.BlockingConnectionPool(
+        host=settings.REDIS_HOST,
+        port=settings.REDIS_PORT,
+        password=settings.REDIS_PASSWORD,
+        db=settings.REDIS_DB,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+        retry=Retry(ExponentialBackoff(base=settings.REDIS_RETRY_BACKOFF), settings.REDIS_RETRIES),
+        retry_on_error=[redis.exceptions.ConnectionError, redis.exceptions.TimeoutError],
+    )
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def _make_mongo():
+    import pymongo
+
+    return pymongo.MongoClient(
+        settings.MONGO_URI,
+        maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+        minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+        waitQueueTimeoutMS=settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+        connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        retryWrites=settings.MONGO_RETRY_WRITES,
+        retryReads=settings.MONGO_RETRY_READS,
+        connect=False,  # no background threads until the first operation
+    )
+
+
+def get_redis():
+    return _get('redis', _make_redis)
+
+
+def get_mongo():
+    return _get('mongo', _make_mongo)
+
+
+def get_mongo_db():
+    return get_mongo()[settings.MONGO_DB]
+
+
+class _ClientProxy:
+    """
+    forwards attribute access to the client of the current process
+    """
+    def __init__(self, resolve):
+        object.__setattr__(self, '_resolve', resolve)
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __repr__(self):
+        return f'<proxy of {self._resolve()!r}>'
+
+
+def use(redis=None, mongo=None):
+    """
+    install ready-made clients for this process (local stand-ins for
+    benchmarks); every proxy resolves to them from now on
+    """
+    if _pid != os.getpid():
+        _reset_after_fork()
+    with _lock:
+        if redis is not None:
+            _clients['redis'] = redis
+        if mongo is not None:
+            _clients['mongo'] = mongo
+
+
+redis_client = _ClientProxy(get_redis)
+
+
+def collection(name):
+    return _ClientProxy(lambda: get_mongo_db()[name])
@@ -0,0 +1,545 @@
+"""
+Offline-first storage for sites with a patchy uplink (EDGE_MODE).
+
+Attendance logs and registrations are written to a local SQLite database
+(WAL mode) and return at once; a background syncer uploads them to the
+central Redis / MongoDB in batches. Recognition reads a local copy of the
+gallery, refreshed from the central store every EDGE_GALLERY_REFRESH
+seconds, so neither path waits on the WAN.
+
+    r = edge_store.get_store().redis()            # hgetall/hlen/hset/lpush
+    users = edge_store.get_store().collection('users')  # find/update_one/insert_many
+
+Every upload is idempotent, a batch that is sent again after a lost reply
+changes nothing:
+
+- logs pushed to a redis list: a per-database watermark (the last outbox
+  id pushed) is advanced in the same MULTI as the LPUSH
+- documents inserted into MongoDB: the `_id` is an ObjectId made when the
+  log was written locally, uploaded with an upsert
+- registrations: HSET / upsert on the person's key, the last one wins
+
+Uploaded rows are kept EDGE_KEEP_SYNCED_HOURS, then deleted, and the
+database file is compacted.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+import db_clients
+import settings
+
+EMBEDDING_BYTES = 512 * np.dtype(np.float32).itemsize
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    target TEXT NOT NULL,
+    key TEXT,
+    payload TEXT,
+    data BLOB,
+    created_at REAL NOT NULL,
+    synced_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    UNIQUE (kind, target, key)
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (id) WHERE synced_at IS NULL;
+CREATE TABLE IF NOT EXISTS gallery (
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    name TEXT,
+    role TEXT,
+    user_id TEXT,
+    embedding BLOB NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (source, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+"""
+
+# outbox kinds, by the central store they go to
+BACKENDS = {
+    'redis_list': 'redis',  # LPUSH target, data
+    'redis_hash': 'redis',  # HSET target key data
+    'mongo_insert': 'mongo',  # insert payload into collection target, _id = key
+    'mongo_upsert': 'mongo',  # upsert payload (+ embedding in data) on key into collection target
+}
+
+
+def _split_key(key):
+    name, _, role = key.partition('@')
+    return name, role
+
+
+class EdgeStore:
+    def __init__(self, path=settings.EDGE_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._backends = set()  # the central stores this process writes to / reads from
+        self._hooks = {}  # target -> callback(docs) once they are uploaded
+        self._syncer_pid = None
+        self._wake = threading.Event()
+        self.synced = 0
+        self.last_sync = None
+        self.last_error = None
+        self._gallery_refreshed = {}
+        self._last_compact = time.time()
+        self.node_id = self._meta('node_id') or self._init_node_id()
+
+    # --- sqlite ---
+
+    def _conn(self):
+        # one connection per thread and process: WAL lets readers run beside the writer
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            # before the first table exists, so deleted rows can be given back to the file system
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('PRAGMA journal_mode=WAL')
+            # durable across a crash of the app; a power cut may lose the last commits
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _write(self, statements):
+        """
+        run [(sql, params or [params...])] in one transaction, returns the row counts
+        """
+        with self._transaction() as conn:
+            return [(conn.executemany(sql, params) if isinstance(params, list) else conn.execute(sql, params)).rowcount
+                    for sql, params in statements]
+
+    def _meta(self, name):
+        row = self._conn().execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def _init_node_id(self):
+        # identifies this database (not the host) in the central watermarks
+        self._write([('INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)', ('node_id', uuid.uuid4().hex))])
+        return self._meta('node_id')
+
+    # --- local writes ---
+
+    def push_list(self, target, entries):
+        now = time.time()
+        self._write([('INSERT INTO outbox (kind, target, data, created_at) VALUES (?, ?, ?, ?)',
+                      [('redis_list', target, entry if isinstance(entry, bytes) else str(entry).encode(), now)
+                       for entry in entries])])
+        self._use('redis')
+
+    def insert_docs(self, target, docs):
+        from bson import ObjectId
+
+        now = time.time()
+        rows = []
+        for doc in docs:
+            # made here, so a retried upload is an upsert of the same document
+            doc.setdefault('_id', ObjectId())
+            payload = {k: v for k, v in doc.items() if k != '_id'}
+            rows.append(('mongo_insert', target, str(doc['_id']), json.dumps(payload, default=str), now))
+        self._write([('INSERT OR IGNORE INTO outbox (kind, target, key, payload, created_at) VALUES (?, ?, ?, ?, ?)',
+                      rows)])
+        self._use('mongo')
+
+    def put_person(self, source, kind, target, key, embedding, name, role, user_id=None, payload=None):
+        """
+        a registration: into the local gallery at once, into the outbox for
+        the central store (replacing a registration of the same key not sent yet).
+        True if the key was not in the gallery yet.
+        """
+        now = time.time()
+        embedding = np.asarray(embedding, dtype=np.float32).tobytes()
+        payload = None if payload is None else json.dumps(payload, default=str)
+        with self._transaction() as conn:
+            added = conn.execute('SELECT 1 FROM gallery WHERE source = ? AND key = ?', (source, key)).fetchone() is None
+            conn.execute('INSERT OR REPLACE INTO gallery (source, key, name, role, user_id, embedding, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?, ?)', (source, key, name, role, user_id, embedding, now))
+            conn.execute('INSERT OR REPLACE INTO outbox (kind, target, key, payload, data, created_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (kind, target, key, payload, embedding, now))
+        self._use(BACKENDS[kind])
+        return added
+
+    # --- local gallery ---
+
+    def gallery(self, source, since=None):
+        """
+        [(key, name, role, user_id, embedding bytes, updated_at)] of a gallery
+        source ('redis:<hash>' or 'mongo:<collection>'), written locally at
+        or after `since` if given; pulled from the central store first if
+        this database never had it
+        """
+        # a read does not start the syncer: the gunicorn master reads the
+        # gallery when it preloads, and must not upload (or fork a running thread)
+        self._backends.add(source.split(':', 1)[0])
+        refreshed = self._meta(f'gallery:{source}')
+        self._gallery_refreshed.setdefault(source, float(refreshed or 0))
+        if refreshed is None:
+            try:
+                self.refresh_gallery(source)
+            except Exception as e:
+                print(f"Error loading the gallery from the central store: {e}")
+        return self._conn().execute('SELECT key, name, role, user_id, embedding, updated_at FROM gallery '
+                                    'WHERE source = ? AND updated_at >= ?', (source, since or 0)).fetchall()
+
+    def gallery_size(self, source):
+        return self._conn().execute('SELECT COUNT(*) FROM gallery WHERE source = ?', (source,)).fetchone()[0]
+
+    def _pull_gallery(self, source):
+        backend, target = source.split(':', 1)
+        if backend == 'redis':
+            rows = []
+            for key, value in db_clients.get_redis().hgetall(target).items():
+                key = key.decode()
+                if len(value) == EMBEDDING_BYTES:
+                    rows.append((key, *_split_key(key), None, value))
+            return rows
+        import gallery_audit
+
+        rows = []
+        fields = {'_id': 0, 'user_id': 1, 'name': 1, 'role': 1, 'embedding': 1}
+        for doc in db_clients.get_mongo_db()[target].find({'embedding': {'$exists': True}}, fields):
+            if len(doc['embedding']) == 512:
+                rows.append((gallery_audit.mongo_gallery_key(doc), doc.get('name'), doc.get('role'),
+                             doc.get('user_id'), np.asarray(doc['embedding'], dtype=np.float32).tobytes()))
+        return rows
+
+    def refresh_gallery(self, source):
+        """
+        replace the local gallery with the central one; people registered
+        here and not uploaded yet are kept
+        """
+        rows = self._pull_gallery(source)
+        now = time.time()
+        kind = 'redis_hash' if source.startswith('redis:') else 'mongo_upsert'
+        target = source.split(':', 1)[1]
+        self._write([
+            ('DELETE FROM gallery WHERE source = ? AND key NOT IN '
+             '(SELECT key FROM outbox WHERE kind = ? AND target = ? AND synced_at IS NULL)', (source, kind, target)),
+            ('INSERT OR IGNORE INTO gallery (source, key, name, role, user_id, embedding, updated_at) '
+             'VALUES (?, ?, ?, ?, ?, ?, ?)', [(source, *row, now) for row in rows]),
+            ('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (f'gallery:{source}', str(now))),
+        ])
+        self._gallery_refreshed[source] = now
+        return len(rows)
+
+    # --- upload ---
+
+    def on_synced(self, target, callback):
+        """
+        call `callback(docs)` with the documents inserted into collection
+        `target` once they are uploaded
+        """
+        self._hooks[target] = callback
+
+    def _upload(self, kind, target, rows):
+        if kind == 'redis_list':
+            # the LPUSH and the watermark move together, rows at or below it were pushed already
+            mark = f'edge:synced:{self.node_id}:{target}'
+
+            def push(pipe):
+                done = int(pipe.get(mark) or 0)
+                entries = [row['data'] for row in rows if row['id'] > done]
+                pipe.multi()
+                if entries:
+                    pipe.lpush(target, *entries)
+                pipe.set(mark, rows[-1]['id'])
+            db_clients.get_redis().transaction(push, mark)
+        elif kind == 'redis_hash':
+            db_clients.get_redis().hset(target, mapping={row['key']: row['data'] for row in rows})
+        elif kind == 'mongo_insert':
+            from bson import ObjectId
+            from pymongo import UpdateOne
+
+            docs = [json.loads(row['payload']) for row in rows]
+            db_clients.get_mongo_db()[target].bulk_write(
+                [UpdateOne({'_id': ObjectId(row['key'])}, {'$setOnInsert': doc}, upsert=True)
+                 for row, doc in zip(rows, docs)], ordered=False)
+            hook = self._hooks.get(target)
+            if hook is not None:
+                try:
+                    hook(docs)
+                except Exception as e:
+                    print(f"Error after uploading {target}: {e}")
+        elif kind == 'mongo_upsert':
+            from pymongo import UpdateOne
+
+            ops = []
+            for row in rows:
+                doc = json.loads(row['payload'])
+                doc['embedding'] = np.frombuffer(row['data'], dtype=np.float32).tolist()
+                doc['created_at'] = datetime.fromtimestamp(row['created_at'])
+                query = {'user_id': doc['user_id']} if doc.get('user_id') else {'name': doc['name'], 'role': doc['role']}
+                ops.append(UpdateOne(query, {'$set': doc}, upsert=True))
+            db_clients.get_mongo_db()[target].bulk_write(ops, ordered=False)
+
+    def _pending(self, backends, limit):
+        kinds = [kind for kind, backend in BACKENDS.items() if backend in backends]
+        marks = ','.join('?' * len(kinds))
+        return self._conn().execute(
+            f'SELECT id, kind, target, key, payload, data, created_at FROM outbox '
+            f'WHERE synced_at IS NULL AND kind IN ({marks}) ORDER BY id LIMIT ?', (*kinds, limit)).fetchall()
+
+    def sync_once(self, backends=None, batch_size=settings.EDGE_SYNC_BATCH_SIZE):
+        """
+        upload everything pending for `backends` (those of this process by
+        default); returns the number of rows uploaded, raises on the first
+        failed batch (it is retried from the same row next time)
+        """
+        backends = self._backends if backends is None else set(backends)
+        uploaded = 0
+        while backends:
+            rows = self._pending(backends, batch_size)
+            if not rows:
+                break
+            # consecutive rows of one kind and target go in one request, in outbox order
+            groups = []
+            for row in rows:
+                if groups and (groups[-1][0], groups[-1][1]) == (row['kind'], row['target']):
+                    groups[-1][2].append(row)
+                else:
+                    groups.append((row['kind'], row['target'], [row]))
+            for kind, target, group in groups:
+                ids = [(row['id'],) for row in group]
+                try:
+                    self._upload(kind, target, group)
+                except Exception as e:
+                    self._write([('UPDATE outbox SET attempts = attempts + 1, error = ? WHERE id = ?',
+                                  [(str(e), row_id) for row_id, in ids])])
+                    raise
+                now = time.time()
+                self._write([('UPDATE outbox SET synced_at = ?, error = NULL WHERE id = ?',
+                              [(now, row_id) for row_id, in ids])])
+                uploaded += len(group)
+                with self._lock:
+                    self.synced += len(group)
+            if len(rows) < batch_size:
+                break
+        return uploaded
+
+    def compact(self, keep_hours=settings.EDGE_KEEP_SYNCED_HOURS):
+        """
+        delete rows uploaded more than `keep_hours` ago and shrink the file
+        """
+        deleted, = self._write([('DELETE FROM outbox WHERE synced_at < ?', (time.time() - keep_hours * 3600,))])
+        conn = self._conn()
+        conn.execute('PRAGMA incremental_vacuum')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return deleted
+
+    # --- background syncer ---
+
+    def _use(self, backend):
+        self._backends.add(backend)
+        self.start()
+
+    def start(self):
+        """
+        start the syncer of this process (a write starts it as well): uploads
+        what an earlier run left pending and keeps the galleries read here fresh
+        """
+        self._ensure_syncer()
+        self._wake.set()
+
+    def _take_lease(self, ttl):
+        # one process uploads a backend at a time (gunicorn workers share the database)
+        now = time.time()
+        owner = f'{os.getpid()}@{self.node_id}'
+        taken = []
+        for backend in sorted(self._backends):
+            name = f'sync_lease:{backend}'
+            changed, = self._write([(
+                'INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value '
+                'WHERE CAST(substr(meta.value, 1, instr(meta.value, \' \') - 1) AS REAL) < ? '
+                'OR substr(meta.value, instr(meta.value, \' \') + 1) = ?',
+                (name, f'{now + ttl} {owner}', now, owner))])
+            if changed:
+                taken.append(backend)
+        return set(taken)
+
+    def _ensure_syncer(self):
+        with self._lock:
+            if self._syncer_pid != os.getpid():
+                self._syncer_pid = os.getpid()
+                self._wake = threading.Event()
+                threading.Thread(target=self._run, name='edge-sync', daemon=True).start()
+
+    def _run(self, interval=settings.EDGE_SYNC_INTERVAL, max_backoff=settings.EDGE_SYNC_MAX_BACKOFF):
+        delay = interval
+        while True:
+            if delay > interval:
+                # backing off: new writes do not wake the syncer
+                time.sleep(delay)
+            else:
+                self._wake.wait(delay)
+            self._wake.clear()
+            try:
+                backends = self._take_lease(ttl=max(30.0, 3 * max_backoff))
+                if backends:
+                    self.sync_once(backends)
+                    self.last_sync = time.time()
+                    self.last_error = None
+                    now = time.time()
+                    for source in [s for s in self._gallery_refreshed if s.split(':', 1)[0] in backends]:
+                        if now - self._gallery_refreshed[source] >= settings.EDGE_GALLERY_REFRESH:
+                            self.refresh_gallery(source)
+                    if now - self._last_compact >= settings.EDGE_COMPACT_INTERVAL:
+                        self._last_compact = now
+                        self.compact()
+                delay = interval
+            except Exception as e:
+                # central store unreachable: everything stays queued locally, retry later
+                self.last_error = str(e)
+                print(f"Error syncing the edge store: {e}")
+                delay = min(max_backoff, max(interval, delay) * 2)
+            # the gallery timestamps of this process follow the database's
+            for source in list(self._gallery_refreshed):
+                self._gallery_refreshed[source] = float(self._meta(f'gallery:{source}') or 0)
+
+    def stats(self):
+        conn = self._conn()
+        pending, oldest = conn.execute(
+            'SELECT COUNT(*), MIN(created_at) FROM outbox WHERE synced_at IS NULL').fetchone()
+        failing = conn.execute(
+            'SELECT error FROM outbox WHERE synced_at IS NULL AND error IS NOT NULL ORDER BY id LIMIT 1').fetchone()
+        return {
+            'pending': pending,
+            'oldest_pending_s': round(time.time() - oldest, 1) if oldest else None,
+            'synced': self.synced,
+            'last_sync': datetime.fromtimestamp(self.last_sync).isoformat(timespec='seconds') if self.last_sync else None,
+            'error': self.last_error or (failing[0] if failing else None),
+        }
+
+    # --- storage facades ---
+
+    def redis(self):
+        return EdgeRedis(self)
+
+    def collection(self, name):
+        return EdgeCollection(self, name)
+
+
+class EdgeRedis:
+    """
+    the redis calls of the recognition pages, served by the edge store
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def hgetall(self, name):
+        return {key.encode(): bytes(embedding) for key, _, _, _, embedding, _ in self.store.gallery(f'redis:{name}')}
+
+    def hlen(self, name):
+        return self.store.gallery_size(f'redis:{name}')
+
+    def hset(self, name, key, value):
+        person, role = _split_key(key)
+        added = self.store.put_person(f'redis:{name}', 'redis_hash', name, key,
+                                      np.frombuffer(value, dtype=np.float32), person, role)
+        return int(added)
+
+    def lpush(self, name, *values):
+        self.store.push_list(name, values)
+        return len(values)
+
+
+class _UpdateResult:
+    def __init__(self, upserted_id):
+        self.upserted_id = upserted_id
+
+
+class EdgeCollection:
+    """
+    the MongoDB calls of the recognition path, served by the edge store:
+    writes go through the outbox, reads (find, count_documents) see the
+    local gallery of the collection
+    """
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def insert_many(self, docs, ordered=True):
+        self.store.insert_docs(self.name, docs)
+
+    def update_one(self, filter, update, upsert=False):
+        import gallery_audit
+
+        doc = dict(update['$set'])
+        key = gallery_audit.mongo_gallery_key(doc)
+        embedding = doc.pop('embedding')
+        doc.pop('created_at', None)  # the time of the outbox row
+        added = self.store.put_person(f'mongo:{self.name}', 'mongo_upsert', self.name, key, embedding,
+                                      doc.get('name'), doc.get('role'), doc.get('user_id'), payload=doc)
+        return _UpdateResult(key if added else None)
+
+    def find(self, filter=None, projection=None):
+        # the only filter honoured: {'created_at': {'$gte': datetime}}, the time of the local write
+        since = ((filter or {}).get('created_at') or {}).get('$gte')
+        since = since.timestamp() if since is not None else None
+        for key, name, role, user_id, embedding, updated_at in self.store.gallery(f'mongo:{self.name}', since):
+            yield {'user_id': user_id, 'name': name, 'role': role,
+                   'embedding': np.frombuffer(embedding, dtype=np.float32),
+                   'created_at': datetime.fromtimestamp(updated_at)}
+
+    def count_documents(self, filter=None):
+        return self.store.gallery_size(f'mongo:{self.name}')
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = EdgeStore()
+        return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Status of the edge store, or upload it now')
+    parser.add_argument('--sync', choices=['redis', 'mongo', 'all'], help='upload what is pending for this store')
+    parser.add_argument('--refresh', metavar='SOURCE', help="pull a gallery ('redis:academy:register', 'mongo:users')")
+    parser.add_argument('--compact', action='store_true', help='delete old uploaded rows and shrink the file')
+    args = parser.parse_args()
+
+    store = EdgeStore()
+    if args.sync:
+        backends = {'redis', 'mongo'} if args.sync == 'all' else {args.sync}
+        print(f"Uploaded {store.sync_once(backends)} rows")
+    if args.refresh:
+        print(f"Pulled {store.refresh_gallery(args.refresh)} faces into {args.refresh}")
+    if args.compact:
+        print(f"Deleted {store.compact()} uploaded rows")
+    print(json.dumps(store.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
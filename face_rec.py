@@ -2,7 +2,13 @@ import numpy as np
 import pandas as pd
 import cv2
 
-import redis
+import db_clients
+import edge_store
+import gallery_audit
+import metrics
+import profiling
+import settings
+from attendance_cooldown import make_cooldown_filter
 
 # insight face
 from insightface.app import FaceAnalysis
@@ -17,17 +23,17 @@ import os
 
 
 # Connect to Redis Client
-hostname = 'redis-13246.c267.us-east-1-4.ec2.cloud.redislabs.com'
-portnumber = 13246
-password = 'aRkbqXJx1Dea2K6TbebfBUeJJrDJ6TZJ'
-
-r = redis.StrictRedis(host=hostname,
-                    port=portnumber,
-                    password=password)
+# pooled, fork-safe client configured through settings / environment variables
+r = db_clients.redis_client
+# edge mode: the gallery, the logs and registrations go through the local edge store
+# (the report pages still read the logs from r)
+store = edge_store.get_store().redis() if settings.EDGE_MODE else r
+if settings.EDGE_MODE:
+    edge_store.get_store().start()
 
 # Retrive Data from database
 def retrive_data(name):
-    retrive_dict= r.hgetall(name)
+    retrive_dict= store.hgetall(name)
     retrive_series = pd.Series(retrive_dict)
     retrive_series = retrive_series.apply(lambda x: np.frombuffer(x,dtype=np.float32))
     index = retrive_series.index
@@ -42,6 +48,10 @@ def retrive_data(name):
 # configure face analysis
 faceapp = FaceAnalysis(name='buffalo_sc',root='insightface_model', providers = ['CPUExecutionProvider'])
 faceapp.prepare(ctx_id = 0, det_size=(640,640), det_thresh = 0.5)
+# pipeline metrics of this process on METRICS_PORT (when METRICS_ENABLED)
+metrics.start_server()
+# periodic stack samples of this long-running process (when PROFILE_SAMPLER_EVERY is set)
+profiling.start_periodic_sampler()
 
 # ML Search Algorithm
 def ml_search_algorithm(dataframe,feature_column,test_vector,
@@ -80,6 +90,8 @@ def ml_search_algorithm(dataframe,feature_column,test_vector,
 class RealTimePred:
     def __init__(self):
         self.logs = dict(name=[],role=[],current_time=[], lat=[], long=[])
+        # keep one event per person per cooldown instead of one per frame
+        self.cooldown = make_cooldown_filter()
         
     def reset_dict(self):
         self.logs = dict(name=[],role=[],current_time=[], lat=[], long=[])
@@ -105,48 +117,70 @@ class RealTimePred:
                 encoded_data.append(concat_string)
                 
         if len(encoded_data) >0:
-            r.lpush('attendance:logs',*encoded_data)
+            with metrics.timer('log_write', 'streamlit'):
+                store.lpush('attendance:logs',*encoded_data)
         
                     
         self.reset_dict()     
+        return len(encoded_data)
         
         
+    def log_person(self, person_name, person_role, current_time, lat=0.0, long=0.0):
+        """
+        keep an event for a known face, once per cooldown
+        (`current_time` is a datetime: a recording passes the time of the frame)
+        """
+        if person_name == 'Unknown':
+            return False
+        if not self.cooldown.allow(f'{person_name}@{person_role}', now=current_time.timestamp()):
+            return False
+        self.logs['name'].append(person_name)
+        self.logs['role'].append(person_role)
+        self.logs['current_time'].append(str(current_time))
+        self.logs['lat'].append(lat)
+        self.logs['long'].append(long)
+        return True
+
     def face_prediction(self,test_image, dataframe,feature_column,
-                            name_role=['Name','Role'],thresh=0.5, lat=0.0, long=0.0):
+                            name_role=['Name','Role'],thresh=0.5, lat=0.0, long=0.0, current_time=None):
         # step-1: find the time
-        current_time = str(datetime.now())
+        current_time = current_time or datetime.now()
+        
+        started = time.perf_counter()
+        metrics.inc('face_requests_total', pipeline='streamlit')
         
         # step-1: take the test image and apply to insight face
-        results = faceapp.get(test_image)
+        results = metrics.face_analysis(faceapp, test_image, 'streamlit')
+        metrics.inc('face_faces_total', len(results), pipeline='streamlit')
+        metrics.set_gauge('face_gallery_size', len(dataframe), pipeline='streamlit')
         test_copy = test_image.copy()
         # step-2: use for loop and extract each embedding and pass to ml_search_algorithm
 
         for res in results:
             x1, y1, x2, y2 = res['bbox'].astype(int)
             embeddings = res['embedding']
-            person_name, person_role = ml_search_algorithm(dataframe,
-                                                        feature_column,
-                                                        test_vector=embeddings,
-                                                        name_role=name_role,
-                                                        thresh=thresh)
+            with metrics.timer('match', 'streamlit'):
+                person_name, person_role = ml_search_algorithm(dataframe,
+                                                            feature_column,
+                                                            test_vector=embeddings,
+                                                            name_role=name_role,
+                                                            thresh=thresh)
             if person_name == 'Unknown':
                 color =(0,0,255) # bgr
+                metrics.inc('face_unknown_total', pipeline='streamlit')
             else:
                 color = (0,255,0)
 
-            cv2.rectangle(test_copy,(x1,y1),(x2,y2),color)
-
-            text_gen = person_name
-            cv2.putText(test_copy,text_gen,(x1,y1),cv2.FONT_HERSHEY_DUPLEX,0.7,color,2)
-            cv2.putText(test_copy,current_time,(x1,y2+10),cv2.FONT_HERSHEY_DUPLEX,0.7,color,2)
-            # save info in logs dict
-            self.logs['name'].append(person_name)
-            self.logs['role'].append(person_role)
-            self.logs['current_time'].append(current_time)
-            self.logs['lat'].append(lat)
-            self.logs['long'].append(long)
-            
+            with metrics.timer('annotate', 'streamlit'):
+                cv2.rectangle(test_copy,(x1,y1),(x2,y2),color)
 
+                text_gen = person_name
+                cv2.putText(test_copy,text_gen,(x1,y1),cv2.FONT_HERSHEY_DUPLEX,0.7,color,2)
+                cv2.putText(test_copy,str(current_time),(x1,y2+10),cv2.FONT_HERSHEY_DUPLEX,0.7,color,2)
+            # save info in logs dict (known faces, once per cooldown)
+            self.log_person(person_name, person_role, current_time, lat, long)
+            
+        metrics.observe(metrics.STAGE_METRIC, time.perf_counter() - started, stage='total', pipeline='streamlit')
         return test_copy
 
 
@@ -202,9 +236,22 @@ class RegistrationForm:
         x_mean = x_mean.astype(np.float32)
         x_mean_bytes = x_mean.tobytes()
         
-        # step-4: save this into redis database
+        # step-4: refuse a face already enrolled under another name
+        if settings.DUPLICATE_FACE_CHECK:
+            gallery = gallery_audit.redis_gallery_index(store)
+            matches = gallery.match(x_mean, exclude={key})
+            if matches:
+                # start the next attempt from fresh samples, not these ones
+                os.remove('face_embedding.txt')
+                self.reset()
+                # (key, similarity) of the person already enrolled
+                return 'duplicate', matches[0]
+        
+        # step-5: save this into redis database
         # redis hashes
-        r.hset(name='academy:register',key=key,value=x_mean_bytes)
+        store.hset(name='academy:register',key=key,value=x_mean_bytes)
+        if settings.DUPLICATE_FACE_CHECK:
+            gallery.add(key, x_mean)
         
         # 
         os.remove('face_embedding.txt')
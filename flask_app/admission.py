@@ -0,0 +1,132 @@
+"""
+Admission control in front of the inference endpoints.
+
+A gate lets at most `max_in_flight` requests of a worker run the face model
+at once. Up to `max_queue` more wait for a slot, for at most
+`queue_timeout` seconds. Anything beyond that is turned away at once, so
+an overloaded worker answers in milliseconds instead of letting every
+request queue up until the proxy gives up on it:
+
+- 429 when the wait queue is already full on arrival
+- 503 when the request waited `queue_timeout` without getting a slot
+
+Both carry a Retry-After estimated from the recent service time and the
+queue length.
+"""
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify
+
+import settings
+
+
+class AdmissionGate:
+    def __init__(self, name, max_in_flight=settings.ADMISSION_MAX_IN_FLIGHT,
+                 max_queue=settings.ADMISSION_MAX_QUEUE, queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0  # queue full (429)
+        self.timed_out = 0  # waited too long (503)
+        self.peak_waiting = 0
+        # moving average of the time a request holds its slot
+        self.service_time = 0.5
+
+    def acquire(self):
+        """
+        None once a slot is held, else the status code to answer with
+        """
+        if self.max_in_flight <= 0:
+            return None
+        with self._cond:
+            if self.in_flight < self.max_in_flight and not self.waiting:
+                self.in_flight += 1
+                self.admitted += 1
+                return None
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return 429
+            self.waiting += 1
+            self.queued += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.in_flight >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return 503
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            return None
+
+    def release(self, held_for):
+        if self.max_in_flight <= 0:
+            return
+        with self._cond:
+            self.in_flight -= 1
+            self.service_time = 0.8 * self.service_time + 0.2 * held_for
+            self._cond.notify()
+
+    def retry_after(self):
+        """
+        seconds until the requests ahead should have gone through
+        """
+        with self._cond:
+            ahead = self.in_flight + self.waiting
+            seconds = self.service_time * ahead / max(1, self.max_in_flight)
+        return max(1, math.ceil(seconds))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_in_flight': self.max_in_flight,
+                'max_queue': self.max_queue,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'peak_waiting': self.peak_waiting,
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'shed_429': self.rejected,
+                'shed_503': self.timed_out,
+                'service_time_s': round(self.service_time, 3),
+            }
+
+
+def admit(gate):
+    """
+    view decorator: run the view only with a slot of `gate`, shed the request otherwise
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            code = gate.acquire()
+            if code is not None:
+                retry_after = gate.retry_after()
+                response = jsonify({'status': 'error',
+                                    'message': f'Server is busy, please try again in {retry_after} s'})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, code
+            started = time.monotonic()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                gate.release(time.monotonic() - started)
+        return decorated_function
+    return decorator
+
+
+# one gate for everything that runs the face model: they share the same cores
+inference = AdmissionGate('inference')
@@ -1,5 +1,18 @@
 from flask import Flask, render_template, Response, request, jsonify, redirect, url_for, session
-from camera import RealTimePred, RegistrationCamera
+import os
+import sys
+# shared modules (log export, anomaly detection, ...) live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera import RealTimePred, RegistrationCamera, notifications_collection, generate_user_id
+import settings
+import worker_health
+import events
+import response_cache
+import notifier
+import admission
+import edge_store
+import metrics
+import profiling
 import pandas as pd
 import json
 from functools import wraps
@@ -25,6 +38,31 @@ def get_reg_camera():
         reg_camera = RegistrationCamera()
     return reg_camera
 
+def preload():
+    """
+    load the gallery before the server forks its workers (gunicorn.conf.py)
+    """
+    get_pred_camera()
+    get_reg_camera()
+
+def _health_details():
+    return {
+        'gallery_size': len(pred_camera.redis_face_db) if pred_camera is not None else None,
+        'cache': response_cache.cache.stats(),
+        'notifications': notifier.get_notifier().stats(),
+        'admission': admission.inference.stats(),
+        'edge': edge_store.get_store().stats() if settings.EDGE_MODE else None,
+        # picked up by /metrics in the other workers
+        'metrics': metrics.snapshot() if metrics.ENABLED else None,
+    }
+
+worker_health.health.details = _health_details
+
+@app.after_request
+def record_health(response):
+    worker_health.health.record(response.status_code)
+    return response
+
 # Authentication decorator
 def login_required(f):
     @wraps(f)
@@ -160,6 +198,7 @@ def video_feed_reg():
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/submit_registration', methods=['POST'])
+@admission.admit(admission.inference)
 def submit_registration():
     name = request.form.get('name')
     role = request.form.get('role')
@@ -178,14 +217,7 @@ def submit_registration():
         camera = get_reg_camera()
         
         # Generate a unique user_id
-        import uuid
-        user_id = str(uuid.uuid4())[:8].upper()
-        if role == 'Student':
-            user_id = f"STU-{user_id}"
-        elif role == 'Teacher':
-            user_id = f"TEA-{user_id}"
-        else:
-            user_id = f"USR-{user_id}"
+        user_id = generate_user_id(role)
             
         # Use the new register_user method with user_id
         result = camera.register_user(name, role, image_bytes, user_id=user_id)
@@ -230,12 +262,18 @@ def submit_registration():
             return jsonify({'status': 'error', 'message': 'Name cannot be empty'})
         elif result == 'file_false':
             return jsonify({'status': 'error', 'message': 'No face detected in image'})
+        elif isinstance(result, tuple) and result[0] == 'duplicate':
+            match_key, similarity = result[1]
+            return jsonify({'status': 'error',
+                            'message': f'This face is already registered as {match_key} (similarity {similarity:.2f})'})
         else:
             return jsonify({'status': 'error', 'message': 'Unknown error'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
 @app.route('/api/mark_attendance', methods=['POST'])
+@admission.admit(admission.inference)
+@profiling.profiled('mark_attendance')
 def mark_attendance():
     if 'image' not in request.files:
         return jsonify({'status': 'error', 'message': 'No image uploaded'})
@@ -250,21 +288,26 @@ def mark_attendance():
     try:
         image_bytes = file.read()
         camera = get_pred_camera()
-        annotated_image, detected_people = camera.process_snapshot(image_bytes, lat, long)
+        annotated_image, detected_people, logged_people = camera.process_snapshot(image_bytes, lat, long)
         
         if annotated_image is None:
              return jsonify({'status': 'error', 'message': 'Failed to process image'})
              
         # Convert annotated image to base64 for display
         import base64
-        image_b64 = base64.b64encode(annotated_image).decode('utf-8')
+        with metrics.timer('base64', 'snapshot'):
+            image_b64 = base64.b64encode(annotated_image).decode('utf-8')
         
-        if detected_people:
-            msg = f"Attendance marked for: {', '.join(detected_people)}"
+        if logged_people:
+            msg = f"Attendance marked for: {', '.join(logged_people)}"
             status = 'success'
-            # Send notification to each detected person
-            for person in detected_people:
+            # Send notification to each person logged by this snapshot
+            for person in logged_people:
                 send_notification(person, f"Your attendance has been marked successfully at {lat}, {long}", "success")
+        elif detected_people:
+            # recognised again within the cooldown: nothing new was written
+            msg = f"Attendance already marked for: {', '.join(detected_people)}"
+            status = 'warning'
         else:
             msg = "No registered face detected"
             status = 'warning'
@@ -276,36 +319,137 @@ def mark_attendance():
             'status': status,
             'message': msg,
             'image': image_b64,
-            'detected': detected_people
+            'detected': detected_people,
+            'logged': logged_people
         })
         
     except Exception as e:
         print(f"Error in mark_attendance: {e}")
         return jsonify({'status': 'error', 'message': str(e)})
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+def batch_images():
+    """
+    (filename, bytes) of the uploaded images: several `images` files, and/or
+    zip archives in `archive`. Raises ValueError past the batch limits.
+    """
+    import zipfile
+    
+    images = []
+    total = 0
+    def add(filename, data):
+        nonlocal total
+        total += len(data)
+        if len(images) >= settings.BATCH_MAX_IMAGES or total > settings.BATCH_MAX_BYTES:
+            raise ValueError(f'Batch limited to {settings.BATCH_MAX_IMAGES} images and {settings.BATCH_MAX_BYTES} bytes')
+        images.append((filename, data))
+    
+    for file in request.files.getlist('images'):
+        if file.filename:
+            add(file.filename, file.read())
+    for file in request.files.getlist('archive'):
+        with zipfile.ZipFile(file.stream) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                # check the declared size before inflating anything
+                if total + info.file_size > settings.BATCH_MAX_BYTES:
+                    raise ValueError(f'Batch limited to {settings.BATCH_MAX_BYTES} bytes')
+                add(info.filename, archive.read(info))
+    return images
+
+@app.route('/api/mark_attendance_batch', methods=['POST'])
+@admission.admit(admission.inference)
+def mark_attendance_batch():
+    # many frames per call: ?annotate=1 also returns the annotated images
+    lat = request.form.get('lat', 0.0, type=float)
+    long = request.form.get('long', 0.0, type=float)
+    annotate = request.args.get('annotate', type=int) == 1
+    try:
+        images = batch_images()
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if not images:
+        return jsonify({'status': 'error', 'message': 'No images uploaded'}), 400
+    
+    try:
+        camera = get_pred_camera()
+        results, logged = camera.process_batch(images, lat, long, annotate=annotate)
+        if annotate:
+            import base64
+            for result in results:
+                if 'image' in result:
+                    result['image'] = base64.b64encode(result['image']).decode('utf-8')
+        
+        # Send notification to each person logged by this batch
+        for person in logged:
+            send_notification(person, f"Your attendance has been marked successfully at {lat}, {long}", "success")
+        
+        detected = sorted({name for result in results for name in result['detected']})
+        return jsonify({
+            # as /api/mark_attendance: success only when something new was written
+            'status': 'success' if logged else 'warning',
+            'message': f"Attendance marked for: {', '.join(logged)}" if logged else (
+                f"Attendance already marked for: {', '.join(detected)}" if detected else 'No registered face detected'),
+            'images': len(images),
+            'detected': detected,
+            'logged': logged,
+            'results': results
+        })
+    except Exception as e:
+        print(f"Error in mark_attendance_batch: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def count_stats():
+    from camera import users_collection, logs_collection, alerts_collection
+    
+    # Total Students (Registered Users)
+    total_students = users_collection.count_documents({})
+    
+    # Present Today
+    today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    today_str = str(today_start.date())
+    present_today = logs_collection.count_documents({"timestamp": {"$regex": f"^{today_str}"}})
+    
+    # Anomalies: alerts raised by the online detector still waiting for review
+    anomalies = alerts_collection.count_documents({"status": "pending"})
+    
+    return {
+        'total_students': total_students,
+        'present_today': present_today,
+        'anomalies': anomalies
+    }
+
+# fields the alerts page displays
+ALERT_FIELDS = {'type': 1, 'user': 1, 'description': 1, 'risk_level': 1, 'time': 1,
+                'status': 1, 'reviewed_by': 1}
+
+def page_limit():
+    # ?limit=, capped so a page always stays small
+    limit = request.args.get('limit', settings.PAGE_SIZE, type=int)
+    return max(1, min(limit, settings.PAGE_SIZE_MAX))
+
+# the live pages keep these counters in memory, loaded on demand
+events.bus.stats.loader = count_stats
+
+@app.route('/api/stream')
+@login_required
+def api_stream():
+    # Server-Sent Events: counters on connect, then stats changes and alerts as they are written
+    subscriber = events.bus.subscribe()
+    return Response(events.stream(subscriber), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/api/stats')
+@profiling.profiled('stats')
 def api_stats():
     # Fetch stats for dashboard
     try:
-        from camera import users_collection, logs_collection
-        from datetime import datetime
-        
-        # Total Students (Registered Users)
-        total_students = users_collection.count_documents({})
-        
-        # Present Today
-        today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_str = str(today_start.date())
-        present_today = logs_collection.count_documents({"timestamp": {"$regex": f"^{today_str}"}})
-        
-        # Anomalies (Mock for now)
-        anomalies = 3 
-        
-        return jsonify({
-            'total_students': total_students,
-            'present_today': present_today,
-            'anomalies': anomalies
-        })
+        # present_today depends on the date, so the day is part of the key
+        return jsonify(response_cache.cache.get_or_set(
+            'stats', count_stats, settings.CACHE_TTL_STATS,
+            tags=('users', 'logs', 'alerts'), key=str(datetime.now().date())))
     except Exception as e:
         print(f"Error fetching stats: {e}")
         return jsonify({
@@ -354,21 +498,56 @@ def download_report():
         print(f"Error generating report: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/export_logs', methods=['GET', 'POST'])
+@teacher_required
+def export_logs():
+    # POST appends the logs written since the last export as date partitions,
+    # GET lists the partitions available for analytics
+    try:
+        import log_export
+        if request.method == 'POST':
+            from camera import logs_collection
+            fmt = request.args.get('format', 'parquet')
+            result = log_export.export_from_mongo(logs_collection, log_export.EXPORT_DIR, fmt)
+            return jsonify({'status': 'success', 'rows': result['rows'], 'partitions': result['partitions']})
+        return jsonify({'partitions': log_export.list_partitions(log_export.EXPORT_DIR)})
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        print(f"Error exporting logs: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/api/get_alerts')
 @login_required
 def get_alerts():
+    # newest first, one page at a time: ?limit=50&before=<_id of the last alert shown>
+    from bson.objectid import ObjectId
+
+    before = request.args.get('before')
+    if before and not ObjectId.is_valid(before):
+        # a bad cursor is the client's mistake, not an empty last page
+        return jsonify({'error': 'Invalid cursor'}), 400
     try:
         from camera import alerts_collection
-        from bson import json_util
-        import json as json_lib
         
-        alerts = list(alerts_collection.find({}))
-        # Convert ObjectId to string for JSON serialization
-        alerts_json = json_lib.loads(json_util.dumps(alerts))
-        return jsonify(alerts_json)
+        limit = page_limit()
+        
+        def load_alerts():
+            query = {'_id': {'$lt': ObjectId(before)}} if before else {}
+            alerts = list(alerts_collection.find(query, ALERT_FIELDS).sort('_id', -1).limit(limit + 1))
+            for alert in alerts:
+                alert['_id'] = str(alert['_id'])
+            # the extra document only tells whether there is another page
+            has_more = len(alerts) > limit
+            alerts = alerts[:limit]
+            return {'alerts': alerts, 'next_cursor': alerts[-1]['_id'] if has_more else None}
+        
+        page = response_cache.cache.get_or_set('alerts', load_alerts, settings.CACHE_TTL_ALERTS,
+                                               tags=('alerts',), key=f'{before}:{limit}')
+        return jsonify(page)
     except Exception as e:
         print(f"Error fetching alerts: {e}")
-        return jsonify([])
+        return jsonify({'alerts': [], 'next_cursor': None})
 
 @app.route('/api/approve_alert', methods=['POST'])
 @login_required
@@ -403,7 +582,9 @@ def approve_alert():
         if result.modified_count > 0:
             # Notify the user involved in the alert
             alert_doc = alerts_collection.find_one({'_id': ObjectId(alert_id)})
+            response_cache.invalidate('alerts')
             if alert_doc:
+                events.alert_updated(alert_doc, alerts_collection.count_documents({"status": "pending"}))
                 send_notification(alert_doc.get('user'), f"Your alert '{alert_doc.get('type')}' has been {action} by {username}", "info")
             
             return jsonify({ 'success': True, 'message': f'Alert {action} by {username}'})
@@ -417,13 +598,19 @@ def approve_alert():
 @app.route('/api/my_attendance')
 @login_required
 def api_my_attendance():
+    from bson.objectid import ObjectId
+
+    # ?before=<timestamp>|<_id>, from next_cursor of the previous page
+    before = request.args.get('before')
+    if before and ('|' not in before or not ObjectId.is_valid(before.rsplit('|', 1)[1])):
+        return jsonify({'error': 'Invalid cursor'}), 400
     try:
         from camera import logs_collection, student_accounts_collection
         
         username = session.get('username')
         
         # Find the student's real name from their account
-        student = student_accounts_collection.find_one({"username": username})
+        student = student_accounts_collection.find_one({"username": username}, {"name": 1})
         if not student:
             # Fallback for demo users or if account not found
             name_to_search = username
@@ -432,54 +619,68 @@ def api_my_attendance():
             
         print(f"Searching attendance for name: {name_to_search} (username: {username})")
         
-        # Find logs for this name
-        user_logs = list(logs_collection.find({"name": name_to_search}))
-        
-        # Calculate statistics
-        total_days = 30  # Assume 30 days in month
-        present_days = len(set([log['timestamp'].split()[0] for log in user_logs]))
-        
-        # Current month attendance
-        now = datetime.now()
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        this_month_logs = [log for log in user_logs if log['timestamp'] >= str(month_start)]
-        this_month_count = len(set([log['timestamp'].split()[0] for log in this_month_logs]))
-        
-        percentage = round((present_days / total_days) * 100, 1) if total_days > 0 else 0
+        # Newest first, one page at a time: ?limit=50&before=<next_cursor of the previous page>
+        limit = page_limit()
+        query = {"name": name_to_search}
+        if before:
+            # keyset on (timestamp, _id): timestamps alone may repeat
+            before_time, before_id = before.rsplit('|', 1)
+            query['$or'] = [{"timestamp": {"$lt": before_time}},
+                            {"timestamp": before_time, "_id": {"$lt": ObjectId(before_id)}}]
+        user_logs = list(logs_collection.find(query, {"timestamp": 1, "lat": 1, "long": 1})
+                         .sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1))
+        has_more = len(user_logs) > limit
+        user_logs = user_logs[:limit]
         
         # Format logs for display
         formatted_logs = []
         for log in user_logs:
             formatted_logs.append({
                 "timestamp": log.get('timestamp'),
-                "lat": log.get('lat', 0),
-                "long": log.get('long', 0)
+                "lat": log.get('lat') or 0,
+                "long": log.get('long') or 0
             })
-            
-        return jsonify({
+        last = user_logs[-1] if has_more else None
+        page = {
             'records': formatted_logs,
-            'stats': {
+            'next_cursor': f"{last['timestamp']}|{last['_id']}" if last else None
+        }
+        
+        # Calculate statistics (first page only), counting distinct days in mongo
+        if not before:
+            total_days = 30  # Assume 30 days in month
+            month_start = str(datetime.now().date().replace(day=1))
+            counts = list(logs_collection.aggregate([
+                {"$match": {"name": name_to_search}},
+                {"$group": {"_id": {"$substrBytes": ["$timestamp", 0, 10]}}},
+                {"$group": {
+                    "_id": None,
+                    "present_days": {"$sum": 1},
+                    "this_month": {"$sum": {"$cond": [{"$gte": ["$_id", month_start]}, 1, 0]}},
+                }},
+            ]))
+            present_days = counts[0]['present_days'] if counts else 0
+            this_month_count = counts[0]['this_month'] if counts else 0
+            percentage = round((present_days / total_days) * 100, 1) if total_days > 0 else 0
+            page['stats'] = {
                 'total_days': total_days,
                 'present_days': present_days,
                 'percentage': percentage,
                 'this_month': this_month_count
             }
-        })
+        
+        return jsonify(page)
     except Exception as e:
         print(f"Error fetching attendance: {e}")
-        return jsonify({'records': [], 'stats': {'total_days': 0, 'present_days': 0, 'percentage': 0, 'this_month': 0}})
+        return jsonify({'records': [], 'next_cursor': None,
+                        'stats': {'total_days': 0, 'present_days': 0, 'percentage': 0, 'this_month': 0}})
 
 # --- New Skill Andhra Pradesh Enhancements ---
 
 def send_notification(username, message, type='info'):
+    # queued, written in batches by the notifier thread
     try:
-        notifications_collection.insert_one({
-            "username": username,
-            "message": message,
-            "type": type,
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "read": False
-        })
+        notifier.send(username, message, type)
     except Exception as e:
         print(f"Error sending notification: {e}")
 
@@ -493,9 +694,15 @@ def notifications_page():
 def get_notifications():
     try:
         username = session.get('username')
-        notifs = list(notifications_collection.find({"username": username}).sort("time", -1).limit(20))
-        for n in notifs:
-            n['_id'] = str(n['_id'])
+        
+        def load_notifications():
+            notifs = list(notifications_collection.find({"username": username}).sort("time", -1).limit(20))
+            for n in notifs:
+                n['_id'] = str(n['_id'])
+            return notifs
+        
+        notifs = response_cache.cache.get_or_set('notifications', load_notifications, settings.CACHE_TTL_NOTIFICATIONS,
+                                                 tags=(f'notifications:{username}',), key=username)
         return jsonify(notifs)
     except Exception as e:
         return jsonify([])
@@ -519,5 +726,45 @@ def sync_portal():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/healthz')
+def healthz():
+    # this worker only; ?deep=1 also pings the databases
+    status = worker_health.health.snapshot()
+    status.pop('metrics', None)  # served by /metrics
+    code = 200
+    if request.args.get('deep'):
+        import db_clients
+        for name, ping in [('mongo', lambda: db_clients.get_mongo().admin.command('ping')),
+                           ('redis', lambda: db_clients.get_redis().ping())]:
+            try:
+                ping()
+                status[name] = 'ok'
+            except Exception as e:
+                status[name] = f'error: {e}'
+                code = 503
+    return jsonify(status), code
+
+@app.route('/healthz/workers')
+def healthz_workers():
+    # last status reported by every worker of the pool
+    worker_health.health.write()
+    workers = worker_health.read_all()
+    for status in workers:
+        status.pop('metrics', None)
+    return jsonify({'workers': workers, 'alive': sum(1 for w in workers if w['alive'])})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text format, one series per live worker (as of its last health write);
+    # a sum would drop whenever a worker is replaced, a per-worker series just ends
+    if not metrics.ENABLED:
+        return Response('metrics are disabled (METRICS_ENABLED)\n', status=404, mimetype='text/plain')
+    worker_health.health.write()
+    snapshots = [metrics.with_labels(status['metrics'], worker=status['pid'])
+                 for status in worker_health.read_all() if status['alive'] and status.get('metrics')]
+    return Response(metrics.render(metrics.merge(snapshots)), content_type=metrics.CONTENT_TYPE)
+
 if __name__ == '__main__':
+    if settings.EDGE_MODE:
+        edge_store.get_store().start()
     app.run(host='0.0.0.0', port=5000, debug=True)
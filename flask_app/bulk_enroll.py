@@ -0,0 +1,305 @@
+"""
+Bulk enrolment from a directory of photos:
+
+    python flask_app/bulk_enroll.py photos/ --role Student
+    python flask_app/bulk_enroll.py manifest.csv
+
+A directory holds one folder per person, named `Name` or `Name@Role`. A CSV
+manifest has the columns `name`, `image` (relative to the manifest) and
+optionally `role` and `user_id`, one row per photo.
+
+The embeddings are computed by a pool of processes, each with its own
+FaceAnalysis model. A photo with no face or with several faces is
+rejected. A person's embedding is the mean of their accepted photos, like
+the Streamlit registration. The users are upserted like
+RegistrationCamera.register_user (by `user_id`, with a new id from
+`generate_user_id`), in bulk writes of `--batch-size` users.
+
+Every written batch is recorded in a state file, and a re-run skips the
+people already recorded there. A person imported before keeps their id,
+because the user documents remember the folder or manifest entry they came
+from (`import_source`).
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+from pymongo import UpdateOne
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settings
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+_faceapp = None
+
+
+def _init_worker():
+    # one model per process, one inference thread each: the pool covers the cores
+    global _faceapp
+    from insightface.app import FaceAnalysis
+
+    kwargs = {}
+    try:
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1
+        options.inter_op_num_threads = 1
+        kwargs['sess_options'] = options
+    except ImportError:
+        pass
+    _faceapp = FaceAnalysis(name='buffalo_sc', root='insightface_model', providers=['CPUExecutionProvider'],
+                            **kwargs)
+    _faceapp.prepare(ctx_id=0, det_size=(640, 640), det_thresh=0.5)
+
+
+def embed_image(path):
+    """
+    (status, embedding) of one photo; status is 'ok', 'unreadable', 'no_face' or 'multiple_faces'
+    """
+    frame = cv2.imread(path, cv2.IMREAD_COLOR)
+    if frame is None:
+        return 'unreadable', None
+    # same downscale as register_user
+    height, width = frame.shape[:2]
+    if width > 640:
+        scale = 640 / width
+        frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+    results = _faceapp.get(frame)
+    if not results:
+        return 'no_face', None
+    if len(results) > 1:
+        return 'multiple_faces', None
+    return 'ok', results[0]['embedding'].astype(np.float32)
+
+
+def load_people(source, default_role='Student'):
+    """
+    [{'source', 'name', 'role', 'user_id', 'images'}] from a photo directory or a CSV manifest
+    """
+    people = []
+    if os.path.isdir(source):
+        for folder in sorted(os.listdir(source)):
+            folder_path = os.path.join(source, folder)
+            if not os.path.isdir(folder_path) or folder.startswith('.'):
+                continue
+            name, _, role = folder.partition('@')
+            images = [os.path.join(folder_path, file_name) for file_name in sorted(os.listdir(folder_path))
+                      if file_name.lower().endswith(IMAGE_EXTENSIONS)]
+            people.append({'source': folder, 'name': name.strip(), 'role': role.strip() or default_role,
+                           'user_id': None, 'images': images})
+        return people
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    by_source = {}
+    with open(source, newline='') as f:
+        for row in csv.DictReader(f):
+            name = (row.get('name') or '').strip()
+            role = (row.get('role') or '').strip() or default_role
+            user_id = (row.get('user_id') or '').strip() or None
+            key = user_id or f'{name}@{role}'
+            if key not in by_source:
+                by_source[key] = {'source': key, 'name': name, 'role': role, 'user_id': user_id, 'images': []}
+                people.append(by_source[key])
+            by_source[key]['images'].append(os.path.join(base_dir, row['image']))
+    return people
+
+
+def default_state_path(source):
+    if os.path.isdir(source):
+        return os.path.join(source, '.bulk_enroll.jsonl')
+    return f'{source}.state.jsonl'
+
+
+def read_state(path):
+    """
+    the last recorded outcome of every source
+    """
+    state = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by the interruption
+                    continue
+                state[entry['source']] = entry
+    return state
+
+
+class BulkEnroller:
+    def __init__(self, users_collection, state_path, batch_size=settings.BULK_ENROLL_BATCH_SIZE,
+                 duplicate_check=settings.DUPLICATE_FACE_CHECK):
+        self.users = users_collection
+        self.state_path = state_path
+        self.batch_size = batch_size
+        self.gallery = None
+        if duplicate_check:
+            import gallery_audit
+            self.gallery = gallery_audit.mongo_gallery_index(users_collection)
+        self._ops = []
+        self._entries = []
+        self.counts = {'enrolled': 0, 'new': 0, 'rejected': 0, 'duplicate': 0}
+
+    def known_ids(self, people):
+        """
+        user ids given to these sources by an earlier run
+        """
+        sources = [person['source'] for person in people]
+        known = {}
+        for doc in self.users.find({'import_source': {'$in': sources}}, {'_id': 0, 'import_source': 1, 'user_id': 1}):
+            known[doc['import_source']] = doc.get('user_id')
+        return known
+
+    def add(self, person, user_id, embeddings, rejects):
+        entry = {'source': person['source'], 'user_id': user_id, 'photos': len(embeddings), 'rejects': rejects}
+        if not person['name'] or not embeddings:
+            entry['status'] = 'rejected'
+            entry['reason'] = 'name_false' if not person['name'] else 'file_false'
+            self._record([entry])
+            return entry
+
+        embedding = np.mean(embeddings, axis=0).astype(np.float32)
+        if self.gallery is not None:
+            # against the stored gallery and everybody imported so far
+            matches = self.gallery.match(embedding, exclude={user_id})
+            if matches:
+                entry['status'] = 'duplicate'
+                entry['duplicate_of'] = [matches[0][0], round(float(matches[0][1]), 4)]
+                self._record([entry])
+                return entry
+            self.gallery.add(user_id, embedding)
+
+        user_doc = {
+            "user_id": user_id,
+            "name": person['name'],
+            "role": person['role'],
+            "embedding": embedding.tolist(),
+            "import_source": person['source'],
+            "created_at": datetime.now(),
+        }
+        self._ops.append(UpdateOne({"user_id": user_id}, {"$set": user_doc}, upsert=True))
+        entry['status'] = 'enrolled'
+        self._entries.append(entry)
+        if len(self._ops) >= self.batch_size:
+            self.flush()
+        return entry
+
+    def flush(self):
+        if not self._ops:
+            return
+        import events
+        import response_cache
+
+        result = self.users.bulk_write(self._ops, ordered=False)
+        # recorded only once written: an interrupted batch is redone on resume
+        self._record(self._entries)
+        response_cache.invalidate('users')
+        for _ in range(result.upserted_count):
+            events.user_registered()
+        self.counts['new'] += result.upserted_count
+        self._ops, self._entries = [], []
+
+    def _record(self, entries):
+        with open(self.state_path, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+                self.counts[entry['status']] += 1
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def enroll(source, default_role='Student', workers=settings.BULK_ENROLL_WORKERS,
+           batch_size=settings.BULK_ENROLL_BATCH_SIZE, state_path=None, retry_rejected=False):
+    """
+    enrol everybody in `source` not recorded in the state file; returns the run statistics
+    """
+    from camera import users_collection, generate_user_id
+
+    state_path = state_path or default_state_path(source)
+    state = read_state(state_path)
+    everybody = load_people(source, default_role)
+    people = [person for person in everybody
+              if person['source'] not in state
+              or (retry_rejected and state[person['source']]['status'] != 'enrolled')]
+    enroller = BulkEnroller(users_collection, state_path, batch_size)
+    known = enroller.known_ids(people)
+
+    # one flat list of photos, handed out to the pool in order
+    paths = [path for person in people for path in person['images']]
+    owners = [i for i, person in enumerate(people) for _ in person['images']]
+    workers = workers or os.cpu_count() or 1
+    stats = {'people': len(people), 'skipped': len(everybody) - len(people), 'images': len(paths)}
+    began = time.perf_counter()
+
+    def finish(i, embeddings, rejects):
+        person = people[i]
+        user_id = person['user_id'] or known.get(person['source']) or generate_user_id(person['role'])
+        entry = enroller.add(person, user_id, embeddings, rejects)
+        if entry['status'] != 'enrolled':
+            print(f"{person['source']}: {entry['status']} {entry.get('reason') or entry.get('duplicate_of') or ''}")
+
+    # people without a single photo never reach the pool
+    for i, person in enumerate(people):
+        if not person['images']:
+            finish(i, [], {})
+
+    if paths:
+        # spawned, not forked: every worker loads its own model
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+            current, embeddings, rejects = None, [], {}
+            done = 0
+            for owner, (status, embedding) in zip(owners, pool.map(embed_image, paths, chunksize=4)):
+                if owner != current:
+                    if current is not None:
+                        finish(current, embeddings, rejects)
+                    current, embeddings, rejects = owner, [], {}
+                if status == 'ok':
+                    embeddings.append(embedding)
+                else:
+                    rejects[status] = rejects.get(status, 0) + 1
+                done += 1
+                if done % 500 == 0:
+                    print(f"{done}/{len(paths)} photos, {done / (time.perf_counter() - began):.1f} photos/s")
+            if current is not None:
+                finish(current, embeddings, rejects)
+    enroller.flush()
+
+    elapsed = time.perf_counter() - began
+    stats.update(enroller.counts)
+    stats['seconds'] = round(elapsed, 2)
+    stats['images_per_second'] = round(len(paths) / elapsed, 2) if elapsed else 0.0
+    stats['state'] = state_path
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enrol people in bulk from a photo directory or CSV manifest')
+    parser.add_argument('source', help='directory with one folder per person, or a CSV manifest')
+    parser.add_argument('--role', default='Student', help='role of the people whose folder or row has none')
+    parser.add_argument('--workers', type=int, default=settings.BULK_ENROLL_WORKERS,
+                        help='FaceAnalysis processes (0: one per CPU core)')
+    parser.add_argument('--batch-size', type=int, default=settings.BULK_ENROLL_BATCH_SIZE)
+    parser.add_argument('--state', help='progress file (default: next to the source)')
+    parser.add_argument('--retry-rejected', action='store_true',
+                        help='try again the people rejected or flagged as duplicates by an earlier run')
+    args = parser.parse_args()
+
+    stats = enroll(args.source, args.role, args.workers, args.batch_size, args.state, args.retry_rejected)
+    print(f"{stats['enrolled']} enrolled ({stats['new']} new), {stats['rejected']} rejected, "
+          f"{stats['duplicate']} duplicates, {stats['skipped']} already done; "
+          f"{stats['images']} photos in {stats['seconds']} s ({stats['images_per_second']} photos/s)")
+
+
+if __name__ == '__main__':
+    main()
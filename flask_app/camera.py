@@ -1,55 +1,121 @@
 import numpy as np
 import pandas as pd
 import cv2
-import pymongo
 from insightface.app import FaceAnalysis
 from sklearn.metrics import pairwise
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
+import sys
+
+# shared modules (db clients, settings, ...) live in the project root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import db_clients
+import edge_store
+import settings
+import anomaly_stream
+import geofence
+import gallery_audit
+import events
+import response_cache
+import notifier
+import metrics
+from attendance_cooldown import make_cooldown_filter
 
 # Connect to MongoDB Client
-# Default to localhost
-mongo_client = pymongo.MongoClient("mongodb://localhost:27017/")
-db = mongo_client["face_attendance_db"]
-users_collection = db["users"]
-logs_collection = db["logs"]
-alerts_collection = db["alerts"]
-notifications_collection = db["notifications"]
-student_accounts_collection = db["student_accounts"]
-teacher_accounts_collection = db["teacher_accounts"]
-
-# Initialize sample alerts if collection is empty
-if alerts_collection.count_documents({}) == 0:
-    sample_alerts = [
-        {
-            "type": "Multiple Check-in",
-            "user": "Revanth",
-            "description": "User 'Revanth' checked in 3 times in 5 mins",
-            "risk_level": "Medium",
-            "time": "2023-12-18 10:45:00",
-            "status": "pending",
-            "reviewed_by": None,
-            "reviewed_at": None
-        },
-        {
-            "type": "Location Mismatch",
-            "user": "Surya",
-            "description": "User 'Surya' checked in 5km away",
-            "risk_level": "High",
-            "time": "2023-12-18 09:12:00",
-            "status": "pending",
-            "reviewed_by": None,
-            "reviewed_at": None
-        }
-    ]
-    alerts_collection.insert_many(sample_alerts)
+# the collections resolve a per-process client on use, so they stay valid in forked workers
+users_collection = db_clients.collection("users")
+logs_collection = db_clients.collection("logs")
+alerts_collection = db_clients.collection("alerts")
+notifications_collection = db_clients.collection("notifications")
+student_accounts_collection = db_clients.collection("student_accounts")
+teacher_accounts_collection = db_clients.collection("teacher_accounts")
+sites_collection = db_clients.collection("sites")
+# Edge mode: the gallery, the logs and registrations go through the local edge store
+if settings.EDGE_MODE:
+    gallery_collection = edge_store.get_store().collection("users")
+    log_collection = edge_store.get_store().collection("logs")
+else:
+    gallery_collection = users_collection
+    log_collection = logs_collection
+
+def _prepare_collections():
+    # Initialize sample alerts if collection is empty
+    if alerts_collection.count_documents({}) == 0:
+        sample_alerts = [
+            {
+                "type": "Multiple Check-in",
+                "user": "Revanth",
+                "description": "User 'Revanth' checked in 3 times in 5 mins",
+                "risk_level": "Medium",
+                "time": "2023-12-18 10:45:00",
+                "status": "pending",
+                "reviewed_by": None,
+                "reviewed_at": None
+            },
+            {
+                "type": "Location Mismatch",
+                "user": "Surya",
+                "description": "User 'Surya' checked in 5km away",
+                "risk_level": "High",
+                "time": "2023-12-18 09:12:00",
+                "status": "pending",
+                "reviewed_by": None,
+                "reviewed_at": None
+            }
+        ]
+        alerts_collection.insert_many(sample_alerts)
+
+    # The duplicate-face check reads the users registered since its last look
+    users_collection.create_index("created_at")
+    # Per-student attendance pages read a name's logs newest first
+    logs_collection.create_index([("name", 1), ("timestamp", -1), ("_id", -1)])
+    # Notifications: per-user listing and automatic expiry
+    notifier.ensure_indexes(notifications_collection)
+
+try:
+    _prepare_collections()
+except Exception as e:
+    # an edge site must start without its uplink; the central store is set up on a later start
+    if not settings.EDGE_MODE:
+        raise
+    print(f"Error preparing MongoDB collections: {e}")
+
+# Online anomaly detection on every saved log, created per worker on first use
+_anomaly_detector = None
+_anomaly_detector_lock = threading.Lock()
+
+def get_anomaly_detector():
+    global _anomaly_detector
+    with _anomaly_detector_lock:
+        if _anomaly_detector is None:
+            site_registry, assignments = geofence.load_default_registry()
+            if site_registry is None:
+                try:
+                    site_registry, assignments = geofence.load_registry_from_mongo(sites_collection, users_collection)
+                except Exception as e:
+                    print(f"Error loading sites: {e}")
+            detector = anomaly_stream.make_detector(alerts_collection, site_registry, assignments)
+            if settings.ANOMALY_WARM_START and detector.shared_states is None:
+                # rebuild per-user state from today's logs without re-raising alerts
+                # (shared state lives in redis and outlives the workers)
+                today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+                try:
+                    detector.replay(anomaly_stream.mongo_events(logs_collection, since=today))
+                except Exception as e:
+                    print(f"Error replaying today's logs: {e}")
+            # the previous day's duration alerts, when a shared day is closed in the background
+            detector.on_alerts = publish_alerts
+            _anomaly_detector = detector
+        return _anomaly_detector
 
 # Retrieve Data from database
 def retrive_data(name):
     # In MongoDB, 'name' argument is unused as we query the collection directly
     # We fetch all users with embeddings
-    cursor = users_collection.find({}, {"name": 1, "role": 1, "embedding": 1})
+    cursor = gallery_collection.find({}, {"name": 1, "role": 1, "embedding": 1})
     
     data = []
     for doc in cursor:
@@ -70,7 +136,18 @@ def retrive_data(name):
 
 # Configure face analysis
 # Assuming running from root directory, so 'insightface_model' is accessible
-faceapp = FaceAnalysis(name='buffalo_sc', root='insightface_model', providers=['CPUExecutionProvider'])
+def _session_kwargs():
+    # a fixed thread count per session, so pre-forked workers do not oversubscribe the cores
+    if not settings.ORT_INTRA_OP_THREADS:
+        return {}
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = settings.ORT_INTRA_OP_THREADS
+    options.inter_op_num_threads = 1
+    return {'sess_options': options}
+
+faceapp = FaceAnalysis(name='buffalo_sc', root='insightface_model', providers=['CPUExecutionProvider'],
+                       **_session_kwargs())
 faceapp.prepare(ctx_id=0, det_size=(640, 640), det_thresh=0.5)
 
 # ML Search Algorithm
@@ -99,6 +176,62 @@ def ml_search_algorithm(dataframe, feature_column, test_vector, name_role=['Name
         
     return person_name, person_role, user_id
 
+def save_logs(logs):
+    if not logs:
+        return False
+
+    # Insert many documents
+    try:
+        log_collection.insert_many(logs)
+        print(f"Saved {len(logs)} logs to {'the edge store' if settings.EDGE_MODE else 'MongoDB'}")
+    except Exception as e:
+        print(f"Error saving logs to MongoDB: {e}")
+        return False
+    response_cache.invalidate('logs')
+    events.logs_saved(len(logs))
+    if not settings.EDGE_MODE:
+        check_logs(logs)
+    return True
+
+def check_logs(logs):
+    # check the new events against per-user state and raise alerts in real time
+    log_events = [anomaly_stream.event_from_log(log) for log in logs]
+    publish_alerts(get_anomaly_detector().process_many(log_events))
+
+def publish_alerts(alerts):
+    if alerts:
+        response_cache.invalidate('alerts')
+    events.alerts_raised(alerts)
+
+# Edge mode: alerts need the central store, logs are checked once the syncer uploaded them
+if settings.EDGE_MODE:
+    edge_store.get_store().on_synced("logs", check_logs)
+
+# Decode + detect pool for batch attendance, created per worker on first use
+_batch_pool = None
+_batch_pool_pid = None
+_batch_pool_lock = threading.Lock()
+
+def get_batch_pool():
+    global _batch_pool, _batch_pool_pid
+    with _batch_pool_lock:
+        if _batch_pool is None or _batch_pool_pid != os.getpid():
+            _batch_pool = ThreadPoolExecutor(max_workers=settings.BATCH_WORKERS, thread_name_prefix='batch')
+            _batch_pool_pid = os.getpid()
+        return _batch_pool
+
+def detect_faces(image_bytes):
+    # decode, downscale and run detection + embedding; cv2 and onnxruntime release the GIL
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if frame is None:
+        return None, []
+    height, width = frame.shape[:2]
+    if width > 640:
+        scale = 640 / width
+        frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+    return frame, faceapp.get(frame)
+
 class RealTimePred:
     def __init__(self):
         self.logs = [] # List of dicts for MongoDB
@@ -106,6 +239,8 @@ class RealTimePred:
         # self.camera = cv2.VideoCapture(0) # Removed for client-side capture
         self.waitTime = 30 # seconds
         self.setTime = time.time()
+        # one log per person per cooldown, however many snapshots hit
+        self.cooldown = make_cooldown_filter()
 
     # def __del__(self):
     #     self.camera.release()
@@ -114,16 +249,7 @@ class RealTimePred:
         self.logs = []
         
     def saveLogs_mongo(self):
-        if not self.logs:
-            return
-
-        # Insert many documents
-        try:
-            logs_collection.insert_many(self.logs)
-            print(f"Saved {len(self.logs)} logs to MongoDB")
-        except Exception as e:
-            print(f"Error saving logs to MongoDB: {e}")
-                    
+        save_logs(self.logs)
         self.reset_dict()     
         
     def get_frame(self, lat=0.0, long=0.0):
@@ -131,43 +257,64 @@ class RealTimePred:
         return b''
 
     def process_snapshot(self, image_bytes, lat, long):
+        """
+        (annotated jpeg, people recognised, people logged): a person seen
+        again within the cooldown is recognised but not logged again
+        """
+        started = time.perf_counter()
+        metrics.inc('face_requests_total', pipeline='snapshot')
         # Convert bytes to numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        with metrics.timer('decode', 'snapshot'):
+            nparr = np.frombuffer(image_bytes, np.uint8)
+            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
         
         if frame is None:
-            return None, "Failed to decode image"
+            return None, "Failed to decode image", []
 
         # Optimization: Resize image if too large
-        height, width = frame.shape[:2]
-        if width > 640:
-            scale = 640 / width
-            frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+        with metrics.timer('resize', 'snapshot'):
+            height, width = frame.shape[:2]
+            if width > 640:
+                scale = 640 / width
+                frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
 
         current_time = str(datetime.now())
-        results = faceapp.get(frame)
+        results = metrics.face_analysis(faceapp, frame, 'snapshot')
+        metrics.inc('face_faces_total', len(results), pipeline='snapshot')
+        metrics.set_gauge('face_gallery_size', len(self.redis_face_db), pipeline='snapshot')
         
         detected_people = []
+        logged_people = []
+        # per call: the gthread workers run snapshots of one camera concurrently
+        logs = []
+        logged_keys = []
         
         for res in results:
             x1, y1, x2, y2 = res['bbox'].astype(int)
             embeddings = res['embedding']
-            person_name, person_role, user_id = ml_search_algorithm(self.redis_face_db,
-                                                        'facial_features',
-                                                        test_vector=embeddings,
-                                                        name_role=['Name', 'Role'],
-                                                        thresh=0.5)
+            with metrics.timer('match', 'snapshot'):
+                person_name, person_role, user_id = ml_search_algorithm(self.redis_face_db,
+                                                            'facial_features',
+                                                            test_vector=embeddings,
+                                                            name_role=['Name', 'Role'],
+                                                            thresh=0.5)
             if person_name == 'Unknown':
                 color = (0, 0, 255)
+                metrics.inc('face_unknown_total', pipeline='snapshot')
             else:
                 color = (0, 255, 0)
                 detected_people.append(person_name)
 
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color)
-            cv2.putText(frame, person_name, (x1, y1), cv2.FONT_HERSHEY_DUPLEX, 0.7, color, 2)
-            cv2.putText(frame, current_time, (x1, y2+10), cv2.FONT_HERSHEY_DUPLEX, 0.7, color, 2)
+            with metrics.timer('annotate', 'snapshot'):
+                cv2.rectangle(frame, (x1, y1), (x2, y2), color)
+                cv2.putText(frame, person_name, (x1, y1), cv2.FONT_HERSHEY_DUPLEX, 0.7, color, 2)
+                cv2.putText(frame, current_time, (x1, y2+10), cv2.FONT_HERSHEY_DUPLEX, 0.7, color, 2)
             
-            # Log data
+            # Log data (known faces, once per cooldown)
+            key = user_id or f'{person_name}@{person_role}'
+            if person_name == 'Unknown' or not self.cooldown.allow(key):
+                continue
+            logged_keys.append(key)
             log_entry = {
                 "user_id": user_id,
                 "name": person_name,
@@ -176,13 +323,118 @@ class RealTimePred:
                 "lat": lat,
                 "long": long
             }
-            self.logs.append(log_entry)
+            logs.append(log_entry)
+            logged_people.append(person_name)
 
         # Save logs immediately for snapshots
-        self.saveLogs_mongo()
+        with metrics.timer('log_write', 'snapshot'):
+            if logs and not save_logs(logs):
+                # not written: the next snapshot of these people may log them
+                for key in logged_keys:
+                    self.cooldown.release(key)
+                logged_people = []
+
+        with metrics.timer('encode', 'snapshot'):
+            ret, jpeg = cv2.imencode('.jpg', frame)
+        metrics.observe(metrics.STAGE_METRIC, time.perf_counter() - started, stage='total', pipeline='snapshot')
+        return jpeg.tobytes(), detected_people, logged_people
+
+    def gallery_matrix(self):
+        # L2-normalised gallery, built once per loaded gallery
+        if getattr(self, '_gallery', None) is None or self._gallery[0] is not self.redis_face_db:
+            features = self.redis_face_db['facial_features'].tolist() if not self.redis_face_db.empty else []
+            matrix = gallery_audit.normalize(features) if features else np.empty((0, gallery_audit.EMBEDDING_DIM), np.float32)
+            self._gallery = (self.redis_face_db, matrix)
+        return self._gallery[1]
 
-        ret, jpeg = cv2.imencode('.jpg', frame)
-        return jpeg.tobytes(), detected_people
+    def process_batch(self, images, lat, long, thresh=0.5, annotate=False):
+        """
+        attendance from many images at once. `images` is a list of
+        (filename, bytes). Images are decoded and detected in parallel, all
+        faces are matched against the gallery in one matrix product, each
+        person is logged once for the batch (best match) and the logs are
+        written in one insert. Returns (per-image results, logged people).
+        """
+        started = time.perf_counter()
+        current_time = str(datetime.now())
+        with metrics.timer('detect', 'batch'):
+            detections = list(get_batch_pool().map(lambda item: detect_faces(item[1]), images))
+
+        # every face of every image against the whole gallery
+        faces = [(index, res) for index, (frame, results) in enumerate(detections) for res in results]
+        gallery = self.gallery_matrix()
+        best, best_score = np.full(len(faces), -1), np.zeros(len(faces))
+        with metrics.timer('match', 'batch'):
+            if faces and len(gallery):
+                scores = gallery_audit.normalize([res['embedding'] for _, res in faces]) @ gallery.T
+                best = scores.argmax(axis=1)
+                best_score = scores[np.arange(len(faces)), best]
+                best[best_score < thresh] = -1
+        metrics.inc('face_requests_total', len(images), pipeline='batch')
+        metrics.inc('face_faces_total', len(faces), pipeline='batch')
+        metrics.inc('face_unknown_total', int((best < 0).sum()), pipeline='batch')
+        metrics.set_gauge('face_gallery_size', len(gallery), pipeline='batch')
+
+        results = [{'index': index, 'filename': filename, 'faces': len(detections[index][1]), 'detected': []}
+                   for index, (filename, _) in enumerate(images)]
+        # best sighting of each person across the batch
+        people = {}
+        for (index, res), match, score in zip(faces, best, best_score):
+            if match < 0:
+                name, role, user_id = 'Unknown', 'Unknown', None
+            else:
+                row = self.redis_face_db.iloc[match]
+                name, role, user_id = row['Name'], row['Role'], row.get('user_id')
+                results[index]['detected'].append(name)
+                key = user_id or f'{name}@{role}'
+                if key not in people or score > people[key][0]:
+                    people[key] = (float(score), name, role, user_id, index)
+            if annotate:
+                frame = detections[index][0]
+                color = (0, 0, 255) if match < 0 else (0, 255, 0)
+                x1, y1, x2, y2 = res['bbox'].astype(int)
+                cv2.rectangle(frame, (x1, y1), (x2, y2), color)
+                cv2.putText(frame, name, (x1, y1), cv2.FONT_HERSHEY_DUPLEX, 0.7, color, 2)
+
+        for result, (frame, _) in zip(results, detections):
+            if frame is None:
+                result['status'] = 'error'
+                result['message'] = 'Failed to decode image'
+            else:
+                result['status'] = 'success' if result['detected'] else 'warning'
+                if annotate:
+                    result['image'] = cv2.imencode('.jpg', frame)[1].tobytes()
+
+        # Log data (known faces, once per cooldown), in a single insert
+        logged_keys = [key for key in people if self.cooldown.allow(key)]
+        logs = [{
+            "user_id": people[key][3],
+            "name": people[key][1],
+            "role": people[key][2],
+            "timestamp": current_time,
+            "lat": lat,
+            "long": long
+        } for key in logged_keys]
+        with metrics.timer('log_write', 'batch'):
+            if logs and not save_logs(logs):
+                # not written: the next batch may log these people
+                for key in logged_keys:
+                    self.cooldown.release(key)
+                logs = []
+        metrics.observe(metrics.STAGE_METRIC, time.perf_counter() - started, stage='total', pipeline='batch')
+        return results, [log['name'] for log in logs]
+
+def generate_user_id(role):
+    """
+    a new random user id, prefixed by role (STU-/TEA-/USR-)
+    """
+    import uuid
+    user_id = str(uuid.uuid4())[:8].upper()
+    if role == 'Student':
+        return f"STU-{user_id}"
+    elif role == 'Teacher':
+        return f"TEA-{user_id}"
+    return f"USR-{user_id}"
 
 class RegistrationCamera:
     def __init__(self):
@@ -198,6 +450,10 @@ class RegistrationCamera:
         return b''
 
     def register_user(self, name, role, image_bytes, user_id=None):
+        """
+        True once registered, else 'name_false', 'file_false', False, or
+        ('duplicate', (key, similarity)) of the person already enrolled
+        """
         if not name or not name.strip():
             return 'name_false'
             
@@ -220,6 +476,20 @@ class RegistrationCamera:
             return 'file_false'
             
         embedding = results[0]['embedding']
+        key = user_id or f"{name}@{role}"
+
+        # Refuse a face already enrolled under another identity
+        gallery = None
+        if settings.DUPLICATE_FACE_CHECK:
+            try:
+                gallery = gallery_audit.mongo_gallery_index(gallery_collection)
+                matches = gallery.match(embedding, exclude={key})
+            except Exception as e:
+                print(f"Error checking duplicate faces: {e}")
+                matches = []
+            if matches:
+                # with the result: the camera is shared by concurrent requests
+                return 'duplicate', matches[0]
         
         try:
             # Convert to list for MongoDB
@@ -235,17 +505,22 @@ class RegistrationCamera:
             
             # Update if user_id exists, otherwise update by name/role (legacy)
             if user_id:
-                users_collection.update_one(
+                result = gallery_collection.update_one(
                     {"user_id": user_id},
                     {"$set": user_doc},
                     upsert=True
                 )
             else:
-                users_collection.update_one(
+                result = gallery_collection.update_one(
                     {"name": name, "role": role},
                     {"$set": user_doc},
                     upsert=True
                 )
+            if gallery is not None:
+                gallery.add(key, embedding)
+            response_cache.invalidate('users')
+            if result.upserted_id is not None:
+                events.user_registered()
             
             return True
         except Exception as e:
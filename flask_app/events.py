@@ -0,0 +1,213 @@
+"""
+Local publish/subscribe behind the live dashboard and alerts pages.
+
+Writes (saved logs, registrations, alert changes) publish small events.
+Every open `/api/stream` connection has its own bounded queue and receives
+them as Server-Sent Events. The dashboard counters live in memory and are
+updated from the same events, so an open page costs no database query
+while nothing happens; they are loaded from MongoDB only when a page
+connects and the copy is missing, older than EVENTS_STATS_MAX_AGE or from
+another day.
+
+With EVENTS_SHARED the events travel over a redis channel instead, so the
+pages served by one gunicorn worker also see the writes made in the others.
+"""
+import json
+import os
+import queue
+import threading
+import time
+from datetime import date
+
+import settings
+
+STAT_FIELDS = ('total_students', 'present_today', 'anomalies')
+
+
+class StatsState:
+    """
+    dashboard counters, changed by 'stats' events ({'inc': {...}} / {'set': {...}})
+    """
+    def __init__(self, loader=None, max_age=settings.EVENTS_STATS_MAX_AGE):
+        self.loader = loader
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._values = None
+        self._loaded_at = 0.0
+        self._day = None
+
+    def snapshot(self):
+        with self._lock:
+            stale = (self._values is None or self._day != date.today()
+                     or (self.max_age and time.time() - self._loaded_at > self.max_age))
+            if stale and self.loader is not None:
+                self._values = dict(self.loader())
+                self._loaded_at = time.time()
+                self._day = date.today()
+            return dict(self._values or {})
+
+    def apply(self, change):
+        """
+        apply a change and return the new value of the fields it touched
+        """
+        with self._lock:
+            if self._values is None:
+                # nobody has looked at the counters in this process yet
+                return {}
+            changed = {}
+            if self._day != date.today():
+                # the first write of a new day
+                self._day = date.today()
+                self._values['present_today'] = 0
+                changed['present_today'] = 0
+            for field, amount in change.get('inc', {}).items():
+                self._values[field] = self._values.get(field, 0) + amount
+                changed[field] = self._values[field]
+            for field, value in change.get('set', {}).items():
+                self._values[field] = value
+                changed[field] = value
+            return changed
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+
+
+class EventBus:
+    def __init__(self, stats, max_queue=settings.EVENTS_QUEUE_SIZE,
+                 shared=None, channel=settings.EVENTS_CHANNEL):
+        self.stats = stats
+        self.max_queue = max_queue
+        self.shared = bool(settings.EVENTS_SHARED) if shared is None else shared
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._listener_pid = None
+
+    def subscribe(self):
+        if self.shared:
+            self._ensure_listener()
+        subscriber = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def publish(self, event, data):
+        if self.shared:
+            import db_clients
+            try:
+                db_clients.get_redis().publish(self.channel, json.dumps([event, data], default=str))
+                return
+            except Exception as e:
+                print(f"Error publishing event: {e}")
+        self.deliver(event, data)
+
+    def deliver(self, event, data):
+        """
+        fan an event out to the subscribers of this process
+        """
+        if event == 'stats':
+            data = self.stats.apply(data)
+            if not data:
+                return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                # a stalled client loses its oldest events, never blocks the writer
+                try:
+                    subscriber.get_nowait()
+                    subscriber.put_nowait((event, data))
+                except (queue.Empty, queue.Full):
+                    pass
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+        threading.Thread(target=self._listen, name='events-listener', daemon=True).start()
+
+    def _listen(self):
+        import db_clients
+
+        while True:
+            try:
+                pubsub = db_clients.get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    event, data = json.loads(message['data'])
+                    self.deliver(event, data)
+            except Exception as e:
+                print(f"Error listening for events: {e}")
+                # the counters may have missed changes while disconnected
+                self.stats.invalidate()
+                time.sleep(1)
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def stream(subscriber, heartbeat=settings.EVENTS_HEARTBEAT_SECONDS,
+           max_seconds=settings.EVENTS_STREAM_MAX_SECONDS):
+    """
+    SSE body for one connection: the current counters, then every event.
+    Closes after `max_seconds` (the browser reconnects) so graceful worker
+    restarts are never held up by an open page.
+    """
+    deadline = time.monotonic() + max_seconds
+    try:
+        yield 'retry: 3000\n\n'
+        yield sse('stats', bus.stats.snapshot())
+        while time.monotonic() < deadline:
+            try:
+                event, data = subscriber.get(timeout=heartbeat)
+            except queue.Empty:
+                # keeps proxies from closing the connection, and finds dead clients
+                yield ': keepalive\n\n'
+                continue
+            yield sse(event, data)
+    finally:
+        bus.unsubscribe(subscriber)
+
+
+def _alert_json(alert):
+    alert = dict(alert)
+    if '_id' in alert:
+        alert['_id'] = str(alert['_id'])
+    return alert
+
+
+def logs_saved(count):
+    bus.publish('stats', {'inc': {'present_today': count}})
+
+
+def user_registered():
+    bus.publish('stats', {'inc': {'total_students': 1}})
+
+
+def alerts_raised(alerts):
+    if not alerts:
+        return
+    for alert in alerts:
+        bus.publish('alert', _alert_json(alert))
+    bus.publish('stats', {'inc': {'anomalies': sum(1 for alert in alerts if alert.get('status') == 'pending')}})
+
+
+def alert_updated(alert, pending_count=None):
+    bus.publish('alert_update', _alert_json(alert))
+    if pending_count is not None:
+        bus.publish('stats', {'set': {'anomalies': pending_count}})
+
+
+bus = EventBus(StatsState())
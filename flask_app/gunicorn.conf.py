@@ -0,0 +1,90 @@
+"""
+Pre-forked production server for the Flask app:
+
+    gunicorn -c flask_app/gunicorn.conf.py
+
+(run from the project root, where `insightface_model` lives). The master
+imports the app once, so the FaceAnalysis weights and the face gallery are
+loaded a single time, then forks the workers, which share those pages
+copy-on-write. Database clients are rebuilt in every child (db_clients).
+
+Signals to the master: HUP starts fresh workers and retires the old ones
+gracefully, TERM drains in-flight requests for up to WEB_GRACEFUL_TIMEOUT
+seconds, TTIN/TTOU add or remove a worker. With the app preloaded, HUP does
+not pick up new code: use USR2 then QUIT on the old master for a
+zero-downtime upgrade.
+"""
+import gc
+import multiprocessing
+import os
+import sys
+
+FLASK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(FLASK_DIR))
+
+# one inference thread per worker: the workers already cover every core, and
+# onnxruntime thread pools created in the master do not survive a fork
+os.environ.setdefault('ORT_INTRA_OP_THREADS', '1')
+
+import settings  # noqa: E402  (needs the environment above)
+
+wsgi_app = 'app:app'
+pythonpath = FLASK_DIR
+bind = settings.WEB_BIND
+workers = settings.WEB_WORKERS or multiprocessing.cpu_count()
+# a user's check-ins are spread over the workers: check them against one state in redis
+if settings.ANOMALY_SHARED_STATE is None:
+    settings.ANOMALY_SHARED_STATE = workers > 1
+# and relay the live page events between them, or a page misses the others' writes
+if settings.EVENTS_SHARED is None:
+    settings.EVENTS_SHARED = workers > 1
+# threads, so the open live pages (/api/stream) do not each block a whole worker
+worker_class = 'gthread'
+threads = settings.WEB_THREADS
+preload_app = True
+timeout = settings.WEB_TIMEOUT
+graceful_timeout = settings.WEB_GRACEFUL_TIMEOUT
+max_requests = settings.WEB_MAX_REQUESTS
+max_requests_jitter = settings.WEB_MAX_REQUESTS_JITTER
+accesslog = '-'
+
+
+def when_ready(server):
+    # the app module is already imported (preload_app); warm what it loads lazily
+    import app
+    import worker_health
+
+    app.preload()
+    worker_health.clear()
+    # move everything loaded so far out of the collector's reach, so a
+    # collection in a worker never writes to (and un-shares) those pages
+    gc.collect()
+    gc.freeze()
+    server.log.info(f"Preloaded model and gallery in master {os.getpid()}")
+    if workers > 1 and not app.events.bus.shared:
+        server.log.warning(f"EVENTS_SHARED is off with {workers} workers: live pages only "
+                           "see the writes of the worker that serves them")
+
+
+def post_fork(server, worker):
+    server.log.info(f"Worker {worker.pid} forked")
+    if settings.EDGE_MODE:
+        # the workers upload, and check the uploaded logs where the alerts are published
+        import edge_store
+
+        edge_store.get_store().start()
+
+
+def child_exit(server, worker):
+    import worker_health
+
+    worker_health.remove(worker.pid)
+
+
+def worker_abort(worker):
+    # timed out (SIGABRT): say where it was stuck before it is replaced
+    import traceback
+
+    frames = sys._current_frames()
+    worker.log.warning(f"Worker {worker.pid} aborted:\n" + ''.join(
+        ''.join(traceback.format_stack(frame)) for frame in frames.values()))
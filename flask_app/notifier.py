@@ -0,0 +1,183 @@
+"""
+Background writer for the user notifications.
+
+`send()` only puts the notification on a queue, so a request that notifies
+forty recognised people does not wait for forty inserts. A thread of the
+worker collects whatever is queued, for at most NOTIFY_FLUSH_INTERVAL
+seconds or NOTIFY_BATCH_SIZE notifications, and writes it with one
+insert_many. At exit an atexit hook tells the writer to write the batch
+it holds and stop, then writes whatever is still queued; when the queue
+is full, `send()` writes synchronously instead of dropping the notification.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import settings
+import response_cache
+
+# put on the queue at exit: the writer writes what it has collected and stops
+_STOP = object()
+
+
+class Notifier:
+    def __init__(self, collection, flush_interval=settings.NOTIFY_FLUSH_INTERVAL,
+                 batch_size=settings.NOTIFY_BATCH_SIZE, max_queue=settings.NOTIFY_QUEUE_SIZE):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writer = None
+        self._writer_pid = None
+        self._closed_pid = None
+        self.sent = 0
+        self.batches = 0
+        self.errors = 0
+
+    def send(self, username, message, type='info'):
+        now = datetime.now()
+        doc = {
+            "username": username,
+            "message": message,
+            "type": type,
+            "time": now.strftime("%Y-%m-%d %H:%M:%S"),
+            # expiry (TTL index), the string above is what the pages show
+            "created_at": now,
+            "read": False
+        }
+        if self._closed_pid == os.getpid():
+            # shutting down: nothing collects the queue any more
+            self.write([doc])
+            return
+        try:
+            self._ensure_writer().put_nowait(doc)
+        except queue.Full:
+            # the writer is behind (database down or slow): this request pays for its own insert
+            self.write([doc])
+
+    def _ensure_writer(self):
+        # one queue and writer thread per process; a forked worker starts its own
+        with self._lock:
+            if self._writer_pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.max_queue)
+                self._writer_pid = os.getpid()
+                self._writer = threading.Thread(target=self._run, args=(self._queue,), name='notifier', daemon=True)
+                self._writer.start()
+            return self._queue
+
+    def _take(self, pending, first_wait):
+        """
+        the next batch: waits up to `first_wait` for a first notification,
+        then up to flush_interval for more; ends with _STOP when that was taken
+        """
+        try:
+            batch = [pending.get(timeout=first_wait)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(pending.get(timeout=remaining) if remaining > 0 else pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, pending):
+        while True:
+            batch = self._take(pending, first_wait=None)
+            stop = batch[-1] is _STOP
+            if stop:
+                batch.pop()
+            if batch:
+                self.write(batch)
+            if stop:
+                return
+
+    def write(self, docs):
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except Exception as e:
+            print(f"Error sending notifications: {e}")
+            with self._lock:
+                self.errors += 1
+            return False
+        with self._lock:
+            self.sent += len(docs)
+            self.batches += 1
+        for username in {doc['username'] for doc in docs}:
+            response_cache.invalidate(f'notifications:{username}')
+        return True
+
+    def flush(self):
+        """
+        write everything still queued in this process
+        """
+        with self._lock:
+            pending = self._queue if self._writer_pid == os.getpid() else None
+        while pending is not None:
+            batch = self._take(pending, first_wait=0.01)
+            if not batch:
+                break
+            batch = [doc for doc in batch if doc is not _STOP]
+            if batch:
+                self.write(batch)
+
+    def close(self, timeout=5.0):
+        """
+        at exit: let the writer write the batch it is collecting and stop,
+        then write what is left in the queue
+        """
+        with self._lock:
+            if self._writer_pid != os.getpid():
+                return
+            self._closed_pid = os.getpid()
+            pending, writer = self._queue, self._writer
+        try:
+            pending.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        else:
+            writer.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            queued = self._queue.qsize() if self._queue is not None and self._writer_pid == os.getpid() else 0
+            return {'queued': queued, 'sent': self.sent, 'batches': self.batches, 'errors': self.errors}
+
+
+def ensure_indexes(collection, ttl_days=settings.NOTIFICATIONS_TTL_DAYS):
+    # the notification pages read a user's latest first
+    collection.create_index([("username", 1), ("time", -1)])
+    if ttl_days > 0:
+        collection.create_index("created_at", expireAfterSeconds=int(ttl_days * 86400))
+        try:
+            # notifications written before the TTL existed only have the display string
+            collection.update_many({"created_at": {"$exists": False}}, [{"$set": {"created_at": {
+                "$dateFromString": {"dateString": "$time", "format": "%Y-%m-%d %H:%M:%S", "onError": "$$NOW"}}}}])
+        except Exception as e:
+            print(f"Error back-filling notification expiry: {e}")
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            from camera import notifications_collection
+            _notifier = Notifier(notifications_collection)
+            atexit.register(_notifier.close)
+        return _notifier
+
+
+def send(username, message, type='info'):
+    get_notifier().send(username, message, type)
@@ -0,0 +1,166 @@
+"""
+TTL cache for the hot read endpoints (/api/stats, /api/get_alerts,
+/api/get_notifications).
+
+Every cached value is stored under its name plus the current version of
+each of its tags ('logs', 'alerts', 'notifications:<user>', ...). A write
+path calls `invalidate(tag)`, which bumps the tag version: the entries
+built on the old version are never read again and simply expire.
+
+The 'memory' backend is local to the worker (other workers see a write at
+the latest after the TTL); the 'redis' backend keeps values and tag
+versions in redis, so every worker sees an invalidation immediately.
+"""
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import settings
+
+
+class MemoryBackend:
+    def __init__(self, max_entries=settings.CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value), least recently used first
+        self._versions = Counter()
+
+    def versions(self, tags):
+        with self._lock:
+            return [self._versions[tag] for tag in tags]
+
+    def bump(self, tag):
+        with self._lock:
+            self._versions[tag] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    """
+    values as JSON under `<prefix>v:<key>`, tag versions as counters under `<prefix>t:<tag>`
+    """
+    def __init__(self, redis, prefix=settings.CACHE_PREFIX):
+        self.redis = redis
+        self.prefix = prefix
+
+    def versions(self, tags):
+        if not tags:
+            return []
+        return [int(version or 0) for version in self.redis.mget([f'{self.prefix}t:{tag}' for tag in tags])]
+
+    def bump(self, tag):
+        self.redis.incr(f'{self.prefix}t:{tag}')
+
+    def get(self, key):
+        value = self.redis.get(f'{self.prefix}v:{key}')
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        self.redis.set(f'{self.prefix}v:{key}', json.dumps(value, default=str), ex=max(1, int(round(ttl))))
+
+    def clear(self):
+        pass
+
+
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self.hits = Counter()
+        self.misses = Counter()
+        self.errors = 0
+
+    def get_or_set(self, name, compute, ttl, tags=(), key=None):
+        """
+        cached value of `name` (and `key`), computing it on a miss. The
+        value must be JSON serialisable. Backend failures fall back to
+        computing the value.
+        """
+        if self.backend is None or ttl <= 0:
+            return compute()
+        try:
+            versions = self.backend.versions(tags)
+            cache_key = ':'.join([name, str(key or '')] + [f'{tag}={version}' for tag, version in zip(tags, versions)])
+            value = self.backend.get(cache_key)
+        except Exception as e:
+            print(f"Error reading cache: {e}")
+            with self._lock:
+                self.errors += 1
+            return compute()
+
+        with self._lock:
+            if value is None:
+                self.misses[name] += 1
+            else:
+                self.hits[name] += 1
+        if value is not None:
+            return value
+
+        value = compute()
+        try:
+            self.backend.set(cache_key, value, ttl)
+        except Exception as e:
+            print(f"Error writing cache: {e}")
+            with self._lock:
+                self.errors += 1
+        return value
+
+    def invalidate(self, *tags):
+        if self.backend is None:
+            return
+        for tag in tags:
+            try:
+                self.backend.bump(tag)
+            except Exception as e:
+                print(f"Error invalidating cache: {e}")
+                with self._lock:
+                    self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            names = sorted(set(self.hits) | set(self.misses))
+            return {
+                'backend': type(self.backend).__name__ if self.backend is not None else None,
+                'hits': sum(self.hits.values()),
+                'misses': sum(self.misses.values()),
+                'errors': self.errors,
+                'by_name': {name: {'hits': self.hits[name], 'misses': self.misses[name]} for name in names},
+            }
+
+
+def make_cache(backend=settings.CACHE_BACKEND):
+    if backend == 'redis':
+        import db_clients
+        return ResponseCache(RedisBackend(db_clients.redis_client))
+    if backend == 'memory':
+        return ResponseCache(MemoryBackend())
+    return ResponseCache(None)
+
+
+cache = make_cache()
+
+
+def invalidate(*tags):
+    cache.invalidate(*tags)
@@ -0,0 +1,137 @@
+"""
+Per-worker health of the pre-forked server.
+
+Every worker process counts its own requests and errors and, at most every
+WEB_HEALTH_INTERVAL seconds, writes them to `<pid>.json` in WEB_HEALTH_DIR.
+`/healthz` answers for the worker that served it, `/healthz/workers` reads
+the files back so any worker can report on the whole pool. The master
+removes the file of a worker when it exits.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+import settings
+
+
+def health_dir():
+    return settings.WEB_HEALTH_DIR or os.path.join(tempfile.gettempdir(), 'face-geo-tag-health')
+
+
+class WorkerHealth:
+    def __init__(self, directory=None, interval=settings.WEB_HEALTH_INTERVAL):
+        self.directory = directory or health_dir()
+        self.interval = interval
+        # extra fields (gallery size, ...) supplied by the app
+        self.details = None
+        self.reset()
+
+    def reset(self):
+        """
+        fresh counters, called in every forked child
+        """
+        self._lock = threading.Lock()
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self._last_write = 0.0
+
+    def record(self, status_code):
+        now = time.time()
+        with self._lock:
+            self.requests += 1
+            if status_code >= 500:
+                self.errors += 1
+            due = now - self._last_write >= self.interval
+            if due:
+                self._last_write = now
+        if due:
+            self.write()
+
+    def snapshot(self):
+        now = time.time()
+        status = {
+            'pid': self.pid,
+            'started': round(self.started, 3),
+            'uptime_s': round(now - self.started, 1),
+            'requests': self.requests,
+            'errors': self.errors,
+            'updated': round(now, 3),
+        }
+        if self.details is not None:
+            try:
+                status.update(self.details())
+            except Exception as e:
+                status['details_error'] = str(e)
+        return status
+
+    def write(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f'{self.pid}.json')
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing worker health: {e}")
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_all(directory=None):
+    """
+    last reported status of every worker, oldest worker first
+    """
+    directory = directory or health_dir()
+    workers = []
+    if not os.path.isdir(directory):
+        return workers
+    for file_name in os.listdir(directory):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, file_name)) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue
+        status['alive'] = _alive(status['pid'])
+        status['age_s'] = round(time.time() - status['updated'], 1)
+        workers.append(status)
+    return sorted(workers, key=lambda status: status['started'])
+
+
+def remove(pid, directory=None):
+    try:
+        os.remove(os.path.join(directory or health_dir(), f'{pid}.json'))
+    except FileNotFoundError:
+        pass
+
+
+def clear(directory=None):
+    """
+    drop the files left by a previous server
+    """
+    directory = directory or health_dir()
+    if os.path.isdir(directory):
+        for file_name in os.listdir(directory):
+            if file_name.endswith('.json') or file_name.endswith('.tmp'):
+                try:
+                    os.remove(os.path.join(directory, file_name))
+                except FileNotFoundError:
+                    pass
+
+
+health = WorkerHealth()
+os.register_at_fork(after_in_child=health.reset)
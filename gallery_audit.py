@@ -0,0 +1,238 @@
+"""
+Duplicate enrolment detection over the face gallery.
+
+The same face registered under two names splits its attendance and makes
+proxies easy. `find_duplicate_pairs` scans the whole gallery against itself
+with cosine similarity, one block of rows at a time, so memory stays at
+block_size x block_size scores whatever the number of users. `GalleryIndex`
+keeps the L2-normalised embeddings in memory for the enrolment-time check,
+which is then a single matrix-vector product.
+
+    python gallery_audit.py --source redis
+    python gallery_audit.py --source mongo --threshold 0.6 --json
+"""
+import argparse
+import json
+import threading
+
+import numpy as np
+
+import settings
+
+REGISTER_KEY = 'academy:register'
+EMBEDDING_DIM = 512
+
+
+def normalize(embeddings):
+    """
+    L2-normalised float32 rows, so a dot product is the cosine similarity
+    """
+    x = np.asarray(embeddings, dtype=np.float32)
+    if x.ndim == 1:
+        x = x.reshape(1, -1)
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return x / norms
+
+
+def find_duplicate_pairs(embeddings, threshold=settings.DUPLICATE_FACE_THRESHOLD,
+                         block_size=settings.GALLERY_AUDIT_BLOCK_SIZE):
+    """
+    (i, j, similarity) arrays of every pair i < j with cosine similarity
+    >= threshold, highest similarity first. Only the upper triangle of the
+    similarity matrix is computed, block by block.
+    """
+    x = normalize(embeddings)
+    n = len(x)
+    rows, cols, sims = [], [], []
+    for i in range(0, n, block_size):
+        block = x[i:i + block_size]
+        for j in range(i, n, block_size):
+            scores = block @ x[j:j + block_size].T
+            if i == j:
+                # diagonal block: keep each pair once and skip self matches
+                scores = np.triu(scores, k=1)
+            bi, bj = np.nonzero(scores >= threshold)
+            if len(bi):
+                rows.append(bi + i)
+                cols.append(bj + j)
+                sims.append(scores[bi, bj])
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows, cols, sims = np.concatenate(rows), np.concatenate(cols), np.concatenate(sims)
+    order = np.argsort(-sims, kind='stable')
+    return rows[order], cols[order], sims[order]
+
+
+class GalleryIndex:
+    """
+    in-memory gallery of normalised embeddings keyed by person
+    (name@role in redis, user_id or name@role in mongo)
+    """
+    def __init__(self, keys=(), embeddings=None):
+        self._lock = threading.Lock()
+        self.keys = list(keys)
+        self._positions = {key: pos for pos, key in enumerate(self.keys)}
+        if embeddings is None or len(self.keys) == 0:
+            self._matrix = np.empty((16, EMBEDDING_DIM), dtype=np.float32)
+        else:
+            self._matrix = normalize(embeddings)
+        self.source_size = len(self.keys)
+
+    def add(self, key, embedding):
+        """
+        add or replace the embedding of `key`, after it was written to the
+        gallery store
+        """
+        vector = normalize(embedding)[0]
+        with self._lock:
+            pos = self._positions.get(key)
+            if pos is None:
+                pos = len(self.keys)
+                if pos == len(self._matrix):
+                    # grow by doubling, so repeated adds stay amortised O(1)
+                    grown = np.empty((max(2 * pos, 16), vector.shape[0]), dtype=np.float32)
+                    grown[:pos] = self._matrix[:pos]
+                    self._matrix = grown
+                self.keys.append(key)
+                self._positions[key] = pos
+                self.source_size += 1
+            self._matrix[pos] = vector
+
+    def match(self, embedding, threshold=settings.DUPLICATE_FACE_THRESHOLD, exclude=()):
+        """
+        [(key, similarity)] of the gallery entries at least `threshold`
+        similar to `embedding`, best first. Keys in `exclude` (the person
+        being re-enrolled) are ignored.
+        """
+        with self._lock:
+            n = len(self.keys)
+            if n == 0:
+                return []
+            scores = self._matrix[:n] @ normalize(embedding)[0]
+            keys = self.keys
+        found = np.flatnonzero(scores >= threshold)
+        found = found[np.argsort(-scores[found], kind='stable')]
+        return [(keys[pos], float(scores[pos])) for pos in found if keys[pos] not in exclude]
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def load_redis_gallery(r, name=REGISTER_KEY):
+    """
+    (keys, embeddings) of the registration hash; entries that are not a
+    512-d float32 vector are skipped
+    """
+    entries = r.hgetall(name)
+    size = EMBEDDING_DIM * np.dtype(np.float32).itemsize
+    items = [(key.decode(), value) for key, value in entries.items() if len(value) == size]
+    if not items:
+        return [], np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    keys, values = zip(*items)
+    return list(keys), np.frombuffer(b''.join(values), dtype=np.float32).reshape(len(keys), EMBEDDING_DIM)
+
+
+def mongo_gallery_key(doc):
+    return doc.get('user_id') or f"{doc.get('name')}@{doc.get('role')}"
+
+
+def _read_mongo_gallery(users_collection, query=None):
+    """
+    (keys, embeddings, newest created_at) of the users matching `query`
+    """
+    keys, embeddings, latest = [], [], None
+    fields = {'_id': 0, 'user_id': 1, 'name': 1, 'role': 1, 'embedding': 1, 'created_at': 1}
+    for doc in users_collection.find({'embedding': {'$exists': True}, **(query or {})}, fields):
+        if len(doc['embedding']) == EMBEDDING_DIM:
+            keys.append(mongo_gallery_key(doc))
+            embeddings.append(doc['embedding'])
+        created_at = doc.get('created_at')
+        if created_at is not None and (latest is None or created_at > latest):
+            latest = created_at
+    if not keys:
+        return [], np.empty((0, EMBEDDING_DIM), dtype=np.float32), latest
+    return keys, np.asarray(embeddings, dtype=np.float32), latest
+
+
+def load_mongo_gallery(users_collection):
+    """
+    (keys, embeddings) of the registered users
+    """
+    keys, embeddings, _ = _read_mongo_gallery(users_collection)
+    return keys, embeddings
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _cached_index(cache_key, size, load):
+    # rebuild when the gallery size changed behind our back (another process registered)
+    with _indexes_lock:
+        index = _indexes.get(cache_key)
+        if index is None or index.source_size != size:
+            index = _indexes[cache_key] = GalleryIndex(*load())
+            index.source_size = size
+        return index
+
+
+def redis_gallery_index(r, name=REGISTER_KEY):
+    """
+    gallery index of the registration hash, cached per process
+    """
+    return _cached_index(('redis', name), r.hlen(name), lambda: load_redis_gallery(r, name))
+
+
+def mongo_gallery_index(users_collection):
+    """
+    gallery index of the users collection, cached per process. Every
+    registration stamps `created_at`, so after the first load a call only
+    reads the users written since the newest one seen (registered by
+    another worker, or re-enrolled with a new face) and adds them.
+    """
+    cache_key = ('mongo', users_collection.name)
+    with _indexes_lock:
+        index = _indexes.get(cache_key)
+        if index is None:
+            keys, embeddings, latest = _read_mongo_gallery(users_collection)
+            index = _indexes[cache_key] = GalleryIndex(keys, embeddings)
+            index.latest = latest
+            return index
+        # $gte: a write in the same millisecond as the newest one seen is not missed
+        since = {'$exists': True} if index.latest is None else {'$gte': index.latest}
+        keys, embeddings, latest = _read_mongo_gallery(users_collection, {'created_at': since})
+        for key, embedding in zip(keys, embeddings):
+            index.add(key, embedding)
+        if latest is not None:
+            index.latest = latest
+        return index
+
+
+def main():
+    import db_clients
+
+    parser = argparse.ArgumentParser(description='Find faces enrolled more than once in the gallery')
+    parser.add_argument('--source', choices=['redis', 'mongo'], default='redis')
+    parser.add_argument('--threshold', type=float, default=settings.DUPLICATE_FACE_THRESHOLD)
+    parser.add_argument('--block-size', type=int, default=settings.GALLERY_AUDIT_BLOCK_SIZE)
+    parser.add_argument('--json', action='store_true', help='print the pairs as JSON')
+    args = parser.parse_args()
+
+    if args.source == 'redis':
+        keys, embeddings = load_redis_gallery(db_clients.get_redis())
+    else:
+        keys, embeddings = load_mongo_gallery(db_clients.collection('users'))
+    rows, cols, sims = find_duplicate_pairs(embeddings, args.threshold, args.block_size)
+    pairs = [{'first': keys[i], 'second': keys[j], 'similarity': round(float(s), 4)}
+             for i, j, s in zip(rows, cols, sims)]
+    if args.json:
+        print(json.dumps(pairs, indent=2))
+    else:
+        print(f"{len(keys)} faces, {len(pairs)} pairs with similarity >= {args.threshold}")
+        for pair in pairs:
+            print(f"{pair['similarity']:.4f}  {pair['first']}  {pair['second']}")
+
+
+if __name__ == '__main__':
+    main()
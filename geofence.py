@@ -0,0 +1,249 @@
+"""
+Multi-site geofences for the location checks.
+
+Each site is a circle (centre + radius) or a polygon. `SiteRegistry` buckets
+sites into a lat/long grid: a site is registered in every cell its bounding
+box touches, so a check-in only looks at the sites of its own cell, however
+many campuses there are. `check_many` validates whole arrays of check-ins
+against the sites each person is assigned to (or any site when unassigned).
+
+Sites and assignments can be loaded from a JSON file:
+
+    {"sites": [{"site_id": "ITI-VSP", "name": "ITI Visakhapatnam",
+                "lat": 17.6868, "long": 83.2185, "radius_km": 0.5},
+               {"site_id": "ITI-VJA", "name": "ITI Vijayawada",
+                "polygon": [[16.51, 80.61], [16.51, 80.63], [16.53, 80.63], [16.53, 80.61]]}],
+     "assignments": {"Revanth": ["ITI-VSP"], "STU-1A2B3C4D": ["ITI-VJA"]}}
+
+or from the `sites` collection, with assignments in the `sites` field of
+the registered users.
+"""
+import json
+import math
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+import settings
+from anomaly_detection import haversine_km
+
+KM_PER_DEGREE = 111.32
+
+
+def points_in_polygon(lat, long, polygon):
+    """
+    ray casting over every point at once, one numpy pass per polygon edge
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    long = np.asarray(long, dtype=np.float64)
+    poly = np.asarray(polygon, dtype=np.float64)
+    y1, x1 = poly[:, 0], poly[:, 1]
+    y2, x2 = np.roll(y1, -1), np.roll(x1, -1)
+    inside = np.zeros(lat.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for k in range(len(poly)):
+            crosses = (y1[k] > lat) != (y2[k] > lat)
+            x_cross = (x2[k] - x1[k]) * (lat - y1[k]) / (y2[k] - y1[k]) + x1[k]
+            inside ^= crosses & (long < x_cross)
+    return inside
+
+
+def _group_rows(keys, rows):
+    """
+    yield (key, rows having that key) for the selected `rows`, via one sort
+    """
+    if len(rows) == 0:
+        return
+    sub_keys = keys[rows]
+    order = np.argsort(sub_keys, kind='stable')
+    sorted_keys = sub_keys[order]
+    bounds = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1], True])
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        yield sorted_keys[start], rows[order[start:stop]]
+
+
+class Site:
+    def __init__(self, site_id, name=None, lat=None, long=None, radius_km=None, polygon=None):
+        if polygon is None and (lat is None or long is None or radius_km is None):
+            raise ValueError(f"Site '{site_id}' needs lat, long and radius_km, or a polygon")
+        self.site_id = site_id
+        self.name = name or site_id
+        self.polygon = None if polygon is None else np.asarray(polygon, dtype=np.float64)
+        if self.polygon is not None and lat is None:
+            lat, long = self.polygon.mean(axis=0)
+        self.lat = float(lat)
+        self.long = float(long)
+        if self.polygon is not None:
+            # bounding radius: the farthest vertex from the centre
+            radius_km = float(haversine_km(self.lat, self.long, self.polygon[:, 0], self.polygon[:, 1]).max())
+        self.radius_km = float(radius_km)
+
+    def contains(self, lat, long, dist_km=None):
+        """
+        element-wise membership; `dist_km` (distance to the centre) saves a
+        haversine when the caller already has it
+        """
+        if dist_km is None:
+            dist_km = haversine_km(lat, long, self.lat, self.long)
+        if self.polygon is None:
+            return np.asarray(dist_km <= self.radius_km)
+        return points_in_polygon(lat, long, self.polygon)
+
+    def bbox(self):
+        dlat = self.radius_km / KM_PER_DEGREE
+        dlong = self.radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(self.lat)), 1e-6))
+        return self.lat - dlat, self.long - dlong, self.lat + dlat, self.long + dlong
+
+    def to_dict(self):
+        doc = {'site_id': self.site_id, 'name': self.name, 'lat': self.lat, 'long': self.long,
+               'radius_km': self.radius_km}
+        if self.polygon is not None:
+            doc['polygon'] = self.polygon.tolist()
+        return doc
+
+
+class SiteRegistry:
+    def __init__(self, sites=(), cell_km=settings.GEOFENCE_CELL_KM):
+        self.cell_deg = cell_km / KM_PER_DEGREE
+        self.sites = {}
+        self._site_list = []
+        self._index = {}
+        self._grid = defaultdict(list)
+        for site in sites:
+            self.add(site)
+
+    def _cell(self, lat, long):
+        return math.floor(lat / self.cell_deg), math.floor(long / self.cell_deg)
+
+    def add(self, site):
+        if site.site_id in self.sites:
+            raise ValueError(f"Duplicate site id '{site.site_id}'")
+        self.sites[site.site_id] = site
+        self._index[site.site_id] = len(self._site_list)
+        self._site_list.append(site)
+        min_lat, min_long, max_lat, max_long = site.bbox()
+        i0, j0 = self._cell(min_lat, min_long)
+        i1, j1 = self._cell(max_lat, max_long)
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                self._grid[(i, j)].append(site)
+
+    def nearby(self, lat, long):
+        """
+        sites whose geofence may contain the point
+        """
+        return self._grid.get(self._cell(lat, long), [])
+
+    def locate(self, lat, long, site_ids=None):
+        """
+        (site containing the point or None, distance in km to the nearest
+        allowed site centre). `site_ids` restricts the check to the sites a
+        person is assigned to; None means any site.
+        """
+        if site_ids:
+            candidates = [self.sites[s] for s in site_ids if s in self.sites]
+        else:
+            candidates = self.nearby(lat, long)
+        nearest = math.inf
+        for site in candidates:
+            dist = float(haversine_km(lat, long, site.lat, site.long))
+            nearest = min(nearest, dist)
+            if site.contains(lat, long, dist):
+                return site, dist
+        return None, nearest
+
+    def check_many(self, lat, long, groups=None, group_site_ids=None):
+        """
+        vectorized `locate` over arrays of check-ins. `groups` maps every
+        check-in to an entry of `group_site_ids` (the site ids assigned to
+        that person); -1, a missing or an empty entry means any nearby site.
+        Returns (inside, nearest_km); rows with NaN coordinates are inside.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        long = np.asarray(long, dtype=np.float64)
+        n = len(lat)
+        valid = ~(np.isnan(lat) | np.isnan(long))
+
+        # candidate (row, site) pairs, built per person and per grid cell, never per row
+        pair_rows, pair_sites = [], []
+        assigned = np.zeros(n, dtype=bool)
+        if groups is not None:
+            groups = np.asarray(groups)
+            for group, rows in _group_rows(groups, np.flatnonzero(valid & (groups >= 0))):
+                ids = [s for s in (group_site_ids[group] or []) if s in self.sites]
+                if ids:
+                    assigned[rows] = True
+                    for site_id in ids:
+                        pair_rows.append(rows)
+                        pair_sites.append(np.full(len(rows), self._index[site_id]))
+        free = np.flatnonzero(valid & ~assigned)
+        if len(free):
+            ci = np.zeros(n, dtype=np.int64)
+            cj = np.zeros(n, dtype=np.int64)
+            ci[free] = np.floor(lat[free] / self.cell_deg)
+            cj[free] = np.floor(long[free] / self.cell_deg)
+            # hash-based grouping of the (row, column) cell pairs packed in one int64
+            cell_codes = np.zeros(n, dtype=np.int64)
+            cell_codes[free] = pd.factorize(ci[free] * (1 << 32) + cj[free])[0]
+            for _, rows in _group_rows(cell_codes, free):
+                for site in self._grid.get((int(ci[rows[0]]), int(cj[rows[0]])), []):
+                    pair_rows.append(rows)
+                    pair_sites.append(np.full(len(rows), self._index[site.site_id]))
+
+        inside = ~valid
+        nearest = np.full(n, np.inf)
+        if pair_rows:
+            pair_rows = np.concatenate(pair_rows)
+            pair_sites = np.concatenate(pair_sites)
+            pair_inside = np.zeros(len(pair_rows), dtype=bool)
+            pair_dist = np.empty(len(pair_rows))
+            # one vectorized pass per distinct site
+            for site_no, idx in _group_rows(pair_sites, np.arange(len(pair_rows))):
+                site = self._site_list[site_no]
+                rows = pair_rows[idx]
+                dist = haversine_km(lat[rows], long[rows], site.lat, site.long)
+                pair_dist[idx] = dist
+                pair_inside[idx] = site.contains(lat[rows], long[rows], dist)
+            np.logical_or.at(inside, pair_rows, pair_inside)
+            np.minimum.at(nearest, pair_rows, pair_dist)
+        nearest[~valid] = np.nan
+        return inside, nearest
+
+    def __len__(self):
+        return len(self.sites)
+
+
+def load_registry(path):
+    """
+    (SiteRegistry, assignments) from a JSON file
+    """
+    with open(path) as f:
+        config = json.load(f)
+    registry = SiteRegistry(Site(**site) for site in config.get('sites', []))
+    return registry, {key: list(ids) for key, ids in config.get('assignments', {}).items()}
+
+
+def load_registry_from_mongo(sites_collection, users_collection=None):
+    """
+    (SiteRegistry, assignments) from the sites collection; assignments come
+    from the `sites` field of registered users, keyed by user_id and name
+    """
+    fields = {'_id': 0, 'site_id': 1, 'name': 1, 'lat': 1, 'long': 1, 'radius_km': 1, 'polygon': 1}
+    registry = SiteRegistry(Site(**doc) for doc in sites_collection.find({}, fields))
+    assignments = {}
+    if users_collection is not None:
+        for user in users_collection.find({'sites': {'$exists': True}}, {'_id': 0, 'user_id': 1, 'name': 1, 'sites': 1}):
+            for key in (user.get('user_id'), user.get('name')):
+                if key:
+                    assignments[key] = list(user['sites'])
+    return registry, assignments
+
+
+def load_default_registry():
+    """
+    registry configured in settings (SITES_FILE), or (None, {})
+    """
+    if settings.SITES_FILE:
+        return load_registry(settings.SITES_FILE)
+    return None, {}
@@ -0,0 +1,252 @@
+"""
+Attendance from a recorded session:
+
+    python ingest_video.py session.mp4 --start "2026-03-02 09:00" --fps 2
+
+A decoder thread reads the file and hands every `1/fps`-th second of video
+to the main thread, which detects the faces and follows them from one
+sampled frame to the next by box overlap (IoU). Only a new track (or an
+unknown one, every few frames) goes through recognition, so a class sitting
+in front of the camera costs one detection per sampled frame. The known
+faces go through the same cooldown and redis logs as the live page
+(face_rec.RealTimePred), stamped with the wall-clock time of their frame:
+`--start` plus the position in the video.
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import cv2
+import numpy as np
+
+import settings
+
+_END = object()
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    intersection over union of every box of `boxes_a` with every box of `boxes_b` (x1, y1, x2, y2)
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-6), 0.0)
+
+
+class Track:
+    __slots__ = ('box', 'name', 'role', 'missed', 'checked')
+
+    def __init__(self, box):
+        self.box = box
+        self.name = 'Unknown'
+        self.role = 'Unknown'
+        self.missed = 0
+        # sampled frames since the last recognition
+        self.checked = None
+
+
+class IoUTracker:
+    """
+    greedy IoU matching of the detections of a frame with the open tracks
+    """
+    def __init__(self, min_iou=0.3, max_missed=4):
+        self.min_iou = min_iou
+        self.max_missed = max_missed
+        self.tracks = []
+
+    def update(self, boxes):
+        """
+        the track of every box (new tracks for the unmatched ones)
+        """
+        matched = [None] * len(boxes)
+        if self.tracks and len(boxes):
+            overlap = iou_matrix([track.box for track in self.tracks], boxes)
+            # best pairs first
+            for flat in np.argsort(overlap, axis=None)[::-1]:
+                t, b = divmod(int(flat), len(boxes))
+                if overlap[t, b] < self.min_iou:
+                    break
+                if matched[b] is None and self.tracks[t].missed >= 0:
+                    matched[b] = self.tracks[t]
+                    self.tracks[t].missed = -1  # taken in this frame
+
+        for track in self.tracks:
+            track.missed = 0 if track.missed < 0 else track.missed + 1
+        self.tracks = [track for track in self.tracks if track.missed <= self.max_missed]
+        for i, box in enumerate(boxes):
+            if matched[i] is None:
+                matched[i] = Track(box)
+                self.tracks.append(matched[i])
+            else:
+                matched[i].box = box
+        return matched
+
+
+def read_frames(capture, step, frames, stop):
+    """
+    decoder thread: puts (frame index, frame) of every `step`-th frame on `frames`
+    """
+    index = 0
+    try:
+        while not stop.is_set():
+            # grab() demuxes without converting: the skipped frames are cheap
+            if not capture.grab():
+                break
+            if index % step == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                frames.put((index, frame))
+            index += 1
+    finally:
+        frames.put(_END)
+
+
+def default_start(path, duration_s):
+    """
+    the file is written until the recording stops, so it started `duration` before its mtime
+    """
+    return datetime.fromtimestamp(os.path.getmtime(path)) - timedelta(seconds=duration_s)
+
+
+def ingest(path, start=None, sample_fps=2.0, thresh=0.5, lat=0.0, long=0.0,
+           recheck=5, flush_seconds=30.0, dry_run=False, progress_seconds=10.0):
+    """
+    run a video through detection, tracking and recognition and write its
+    attendance events; returns the run statistics
+    """
+    import face_rec
+    from attendance_cooldown import CooldownFilter
+    from insightface.app.common import Face
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f'cannot open video {path}')
+    video_fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    duration_s = frame_count / video_fps
+    start = start or default_start(path, duration_s)
+    step = max(1, int(round(video_fps / sample_fps))) if sample_fps > 0 else 1
+
+    # step-1: gallery and pipeline of the live page; a cooldown of its own, in video time
+    gallery = face_rec.retrive_data(name='academy:register')
+    pred = face_rec.RealTimePred()
+    pred.cooldown = CooldownFilter()
+    detector = face_rec.faceapp.det_model
+    recognizer = face_rec.faceapp.models['recognition']
+    tracker = IoUTracker(max_missed=max(1, int(round(2 * video_fps / step))))
+
+    # step-2: decode on its own thread, a few frames ahead of the detector
+    frames = queue.Queue(maxsize=8)
+    stop = threading.Event()
+    decoder = threading.Thread(target=read_frames, args=(capture, step, frames, stop),
+                               name='video-decoder', daemon=True)
+    stats = dict(video=path, start=str(start), video_seconds=round(duration_s, 1), sampled_frames=0,
+                 faces=0, recognitions=0, events=0)
+    began = time.perf_counter()
+    last_progress = began
+    last_flush = 0.0
+    decoder.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is _END:
+                break
+            index, frame = item
+            video_s = index / video_fps
+            frame_time = start + timedelta(seconds=video_s)
+
+            # step-3: detect, then follow the faces from the previous sampled frame
+            bboxes, kpss = detector.detect(frame, max_num=0, metric='default')
+            tracks = tracker.update(bboxes[:, :4])
+            for i, track in enumerate(tracks):
+                # step-4: recognise new tracks, and unknown ones every `recheck` frames
+                if track.checked is None or (track.name == 'Unknown' and track.checked >= recheck):
+                    face = Face(bbox=bboxes[i, :4], kps=None if kpss is None else kpss[i],
+                                det_score=bboxes[i, 4])
+                    recognizer.get(frame, face)
+                    track.name, track.role = face_rec.ml_search_algorithm(
+                        gallery, 'facial_features', test_vector=face['embedding'],
+                        name_role=['Name', 'Role'], thresh=thresh)
+                    track.checked = 0
+                    stats['recognitions'] += 1
+                else:
+                    track.checked += 1
+                pred.log_person(track.name, track.role, frame_time, lat, long)
+            stats['sampled_frames'] += 1
+            stats['faces'] += len(tracks)
+
+            # step-5: write the events in batches
+            if video_s - last_flush >= flush_seconds:
+                stats['events'] += flush(pred, dry_run)
+                last_flush = video_s
+
+            now = time.perf_counter()
+            if progress_seconds and now - last_progress >= progress_seconds:
+                last_progress = now
+                print(f"{video_s:.0f}/{duration_s:.0f} s of video, "
+                      f"{stats['sampled_frames'] / (now - began):.1f} frames/s")
+        stats['events'] += flush(pred, dry_run)
+    finally:
+        stop.set()
+        # unblock the decoder if it waits on a full queue
+        while decoder.is_alive():
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                decoder.join(0.1)
+        capture.release()
+
+    elapsed = time.perf_counter() - began
+    stats['seconds'] = round(elapsed, 2)
+    stats['frames_per_second'] = round(stats['sampled_frames'] / elapsed, 2) if elapsed else 0.0
+    stats['realtime_factor'] = round(elapsed / duration_s, 4) if duration_s else None
+    return stats
+
+
+def flush(pred, dry_run=False):
+    if not dry_run:
+        return pred.saveLogs_redis()
+    count = sum(name != 'Unknown' for name in set(pred.logs['name']))
+    for name, role, ctime in zip(pred.logs['name'], pred.logs['role'], pred.logs['current_time']):
+        print(f"{ctime}  {name}@{role}")
+    pred.reset_dict()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Take attendance from a recorded session')
+    parser.add_argument('video')
+    parser.add_argument('--start', type=datetime.fromisoformat,
+                        help='wall-clock time of the first frame (default: file mtime minus the video length)')
+    parser.add_argument('--fps', type=float, default=2.0, help='frames per second of video to analyse (0: all)')
+    parser.add_argument('--thresh', type=float, default=0.5)
+    parser.add_argument('--lat', type=float, default=settings.SITE_LAT or 0.0)
+    parser.add_argument('--long', type=float, default=settings.SITE_LONG or 0.0)
+    parser.add_argument('--recheck', type=int, default=5,
+                        help='sampled frames between recognitions of an unknown face')
+    parser.add_argument('--flush-seconds', type=float, default=30.0,
+                        help='seconds of video per batch of events written')
+    parser.add_argument('--dry-run', action='store_true', help='print the events instead of saving them')
+    args = parser.parse_args()
+
+    stats = ingest(args.video, args.start, args.fps, args.thresh, args.lat, args.long,
+                   args.recheck, args.flush_seconds, args.dry_run)
+    print(f"{stats['sampled_frames']} frames in {stats['seconds']} s "
+          f"({stats['frames_per_second']} frames/s, {stats['realtime_factor']} x real time), "
+          f"{stats['recognitions']} recognitions, {stats['events']} events")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Columnar export of attendance logs.
+
+Logs are written as a date-partitioned dataset:
+
+    <out_dir>/date=YYYY-MM-DD/part-<run>-<source>.parquet   (or .arrow)
+
+with typed columns (datetime64 Timestamp, float32 Lat/Long, categorical
+Name/Role/UserId). A small `_state.json` in `out_dir` keeps a watermark per
+source so every run only appends the entries written since the last export.
+
+    python log_export.py --source redis --out exports/attendance
+    python log_export.py --source mongo --format arrow
+"""
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import db_clients
+import settings
+from attendance_logs import fetch_new_entries, parse_logs
+
+EXPORT_DIR = settings.ATTENDANCE_EXPORT_DIR
+EXPORT_COLUMNS = ['Name', 'Role', 'UserId', 'Timestamp', 'Lat', 'Long']
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+STATE_FILE = '_state.json'
+
+
+def typed_logs_frame(df):
+    """
+    cast a raw logs dataframe (Name, Role, Timestamp, Lat, Long[, UserId])
+    into the export schema
+    """
+    out = pd.DataFrame(index=df.index)
+    out['Name'] = df['Name'].astype('category')
+    out['Role'] = df['Role'].astype('category')
+    user_id = df['UserId'] if 'UserId' in df.columns else pd.Series(None, index=df.index, dtype=object)
+    out['UserId'] = user_id.astype('category')
+    out['Timestamp'] = pd.to_datetime(df['Timestamp'], errors='coerce', format='ISO8601')
+    out['Lat'] = pd.to_numeric(df['Lat'], errors='coerce').astype(np.float32)
+    out['Long'] = pd.to_numeric(df['Long'], errors='coerce').astype(np.float32)
+    # rows without a usable timestamp cannot be partitioned
+    return out.dropna(subset=['Timestamp']).reset_index(drop=True)
+
+
+def _mongo_docs_to_frame(docs):
+    frame = pd.DataFrame(docs)
+    return frame.rename(columns={'name': 'Name', 'role': 'Role', 'user_id': 'UserId',
+                                 'timestamp': 'Timestamp', 'lat': 'Lat', 'long': 'Long'})
+
+
+def load_state(out_dir):
+    path = os.path.join(out_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(out_dir, state):
+    # write-then-rename so a crash never leaves a half written watermark
+    path = os.path.join(out_dir, STATE_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def write_partitions(frame, out_dir, source, fmt='parquet', run_id=None):
+    """
+    write one file per calendar day of `frame`, returns the written paths
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}', expected one of {sorted(FORMATS)}")
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    run_id = run_id or datetime.now().strftime('%Y%m%d%H%M%S%f')
+    written = []
+    dates = frame['Timestamp'].dt.strftime('%Y-%m-%d')
+    for date, part in frame.groupby(dates, sort=True):
+        part_dir = os.path.join(out_dir, f'date={date}')
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, f'part-{run_id}-{source}{FORMATS[fmt]}')
+        table = pa.Table.from_pandas(part[EXPORT_COLUMNS].sort_values('Timestamp'), preserve_index=False)
+        if fmt == 'parquet':
+            pq.write_table(table, path, compression='zstd')
+        else:
+            feather.write_feather(table, path, compression='zstd')
+        written.append(path)
+    return written
+
+
+def export_from_redis(r, out_dir=EXPORT_DIR, fmt='parquet', name='attendance:logs'):
+    """
+    export entries pushed to the redis list since the last run.
+    New entries are LPUSHed, so they sit at the head of the list and the
+    number of entries already exported is counted from the tail.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_state(out_dir)
+    source_state = state.get('redis', {})
+    consumed = source_state.get('consumed', 0)
+    last_ts = source_state.get('last_timestamp')
+
+    total, entries = fetch_new_entries(r, consumed, name)
+    if total >= consumed:
+        frame = typed_logs_frame(parse_logs(entries))
+    else:
+        # the list was trimmed or rebuilt: fall back to the timestamp watermark
+        print(f"Redis list '{name}' shrank from {consumed} to {total} entries, re-scanning")
+        total, entries = fetch_new_entries(r, 0, name)
+        frame = typed_logs_frame(parse_logs(entries))
+        if last_ts is not None:
+            frame = frame[frame['Timestamp'] > pd.Timestamp(last_ts)]
+
+    written = write_partitions(frame, out_dir, 'redis', fmt) if not frame.empty else []
+    if not frame.empty:
+        last_ts = str(frame['Timestamp'].max())
+    state['redis'] = {'consumed': total, 'last_timestamp': last_ts}
+    save_state(out_dir, state)
+    return {'rows': len(frame), 'partitions': written}
+
+
+def export_from_mongo(collection, out_dir=EXPORT_DIR, fmt='parquet', batch_size=100000):
+    """
+    export mongo log documents inserted since the last run, using the
+    ObjectId of the last exported document as watermark
+    """
+    from bson.objectid import ObjectId
+
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_state(out_dir)
+    source_state = state.get('mongo', {})
+    last_id = source_state.get('last_id')
+
+    query = {'_id': {'$gt': ObjectId(last_id)}} if last_id else {}
+    projection = {'_id': 1, 'name': 1, 'role': 1, 'user_id': 1, 'timestamp': 1, 'lat': 1, 'long': 1}
+    cursor = collection.find(query, projection).sort('_id', 1).batch_size(batch_size)
+
+    rows = 0
+    written = []
+    run_id = datetime.now().strftime('%Y%m%d%H%M%S%f')
+    batch = []
+    chunk_no = 0
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            frame = typed_logs_frame(_mongo_docs_to_frame(batch))
+            written += write_partitions(frame, out_dir, 'mongo', fmt, run_id=f'{run_id}-{chunk_no}')
+            rows += len(frame)
+            last_id = str(batch[-1]['_id'])
+            batch = []
+            chunk_no += 1
+    if batch:
+        frame = typed_logs_frame(_mongo_docs_to_frame(batch))
+        written += write_partitions(frame, out_dir, 'mongo', fmt, run_id=f'{run_id}-{chunk_no}')
+        rows += len(frame)
+        last_id = str(batch[-1]['_id'])
+
+    state['mongo'] = {'last_id': last_id}
+    save_state(out_dir, state)
+    return {'rows': rows, 'partitions': written}
+
+
+def list_partitions(out_dir=EXPORT_DIR):
+    """
+    dates available in the export directory with their files
+    """
+    if not os.path.isdir(out_dir):
+        return []
+    partitions = []
+    for entry in sorted(os.listdir(out_dir)):
+        if entry.startswith('date='):
+            files = sorted(os.listdir(os.path.join(out_dir, entry)))
+            partitions.append({'date': entry[len('date='):], 'files': files})
+    return partitions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export attendance logs as a date-partitioned columnar dataset')
+    parser.add_argument('--source', choices=['redis', 'mongo'], default='redis')
+    parser.add_argument('--out', default=EXPORT_DIR)
+    parser.add_argument('--format', choices=sorted(FORMATS), default='parquet')
+    args = parser.parse_args()
+
+    if args.source == 'redis':
+        result = export_from_redis(db_clients.get_redis(), args.out, args.format)
+    else:
+        result = export_from_mongo(db_clients.collection('logs'), args.out, args.format)
+
+    print(f"Exported {result['rows']} rows into {len(result['partitions'])} partition files under {args.out}")
+
+
+if __name__ == '__main__':
+    main()
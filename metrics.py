@@ -0,0 +1,255 @@
+"""
+In-process metrics of the recognition pipeline, in the Prometheus text format.
+
+    with metrics.timer('detect', 'snapshot'):
+        ...
+    metrics.inc('face_requests_total', pipeline='snapshot')
+
+Stage timings go to the `face_stage_seconds` histogram, labelled by
+pipeline ('snapshot', 'batch', 'streamlit') and stage (decode, resize,
+detect, embed, match, annotate, log_write, encode, base64, total).
+Counters and gauges take any labels.
+
+Nothing is recorded unless METRICS_ENABLED is set: `timer()` then hands
+back a shared no-op context manager and the other calls return at once.
+The Flask app serves `/metrics` with one series per gunicorn worker
+(labelled `worker`, see `with_labels`); a Streamlit process serves its own
+on METRICS_PORT.
+"""
+import bisect
+import os
+import threading
+import time
+
+import settings
+
+ENABLED = settings.METRICS_ENABLED
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STAGE_METRIC = 'face_stage_seconds'
+
+HELP = {
+    STAGE_METRIC: ('histogram', 'Time spent in each stage of the recognition pipeline'),
+    'face_requests_total': ('counter', 'Images (or frames) run through the pipeline'),
+    'face_faces_total': ('counter', 'Faces detected'),
+    'face_unknown_total': ('counter', 'Faces that matched nobody in the gallery'),
+    'face_gallery_size': ('gauge', 'Faces in the gallery used for matching'),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}  # key -> [bucket counts..., +Inf count, sum]
+
+
+def _reset_after_fork():
+    # a forked worker starts from zero, it has served nothing yet
+    global _lock
+    _lock = threading.Lock()
+    _counters.clear()
+    _gauges.clear()
+    _histograms.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    if not ENABLED:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    index = bisect.bisect_left(BUCKETS, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        histogram[index] += 1
+        histogram[-1] += value
+
+
+class _Timer:
+    __slots__ = ('labels', 'started')
+
+    def __init__(self, stage, pipeline):
+        self.labels = {'stage': stage, 'pipeline': pipeline}
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(STAGE_METRIC, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(stage, pipeline):
+    return _Timer(stage, pipeline) if ENABLED else _NO_TIMER
+
+
+def face_analysis(faceapp, frame, pipeline):
+    """
+    faceapp.get(frame), with detection and embedding timed as two stages
+    """
+    if not ENABLED:
+        return faceapp.get(frame)
+    from insightface.app.common import Face
+
+    with timer('detect', pipeline):
+        bboxes, kpss = faceapp.det_model.detect(frame, max_num=0, metric='default')
+    faces = []
+    with timer('embed', pipeline):
+        for i in range(bboxes.shape[0]):
+            face = Face(bbox=bboxes[i, 0:4], kps=None if kpss is None else kpss[i], det_score=bboxes[i, 4])
+            for taskname, model in faceapp.models.items():
+                if taskname != 'detection':
+                    model.get(frame, face)
+            faces.append(face)
+    return faces
+
+
+def snapshot():
+    """
+    the metrics of this process as plain lists (JSON serialisable)
+    """
+    with _lock:
+        return {
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'gauges': [[name, list(labels), value] for (name, labels), value in _gauges.items()],
+            'histograms': [[name, list(labels), list(values)] for (name, labels), values in _histograms.items()],
+        }
+
+
+def with_labels(snap, **labels):
+    """
+    the snapshot with `labels` added to every series
+    """
+    extra = [[k, v] for k, v in sorted(labels.items())]
+    return {kind: [[name, list(series_labels) + extra, value] for name, series_labels, value in snap.get(kind, [])]
+            for kind in ('counters', 'gauges', 'histograms')}
+
+
+def merge(snapshots):
+    """
+    one snapshot from several processes: counters and histograms are
+    summed, a gauge keeps its largest value
+    """
+    counters, gauges, histograms = {}, {}, {}
+    for snap in snapshots:
+        for name, labels, value in snap.get('counters', []):
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snap.get('gauges', []):
+            key = (name, tuple(map(tuple, labels)))
+            gauges[key] = max(gauges.get(key, value), value)
+        for name, labels, values in snap.get('histograms', []):
+            key = (name, tuple(map(tuple, labels)))
+            total = histograms.get(key)
+            histograms[key] = list(values) if total is None else [a + b for a, b in zip(total, values)]
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'gauges': [[name, list(labels), value] for (name, labels), value in gauges.items()],
+        'histograms': [[name, list(labels), values] for (name, labels), values in histograms.items()],
+    }
+
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def render(snap=None):
+    """
+    Prometheus text exposition of a snapshot (this process by default)
+    """
+    snap = snapshot() if snap is None else snap
+    by_name = {}
+    for kind in ('counters', 'gauges', 'histograms'):
+        for name, labels, value in snap.get(kind, []):
+            by_name.setdefault(name, []).append((kind, labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        kind = by_name[name][0][0]
+        metric_type, help_text = HELP.get(name, (kind[:-1], name))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for _, labels, value in sorted(by_name[name], key=lambda item: item[1]):
+            if kind != 'histograms':
+                lines.append(f'{name}{_labels_text(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_labels_text(labels)} {value[-1]}')
+            lines.append(f'{name}_count{_labels_text(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_server = None
+
+
+def start_server(port=settings.METRICS_PORT):
+    """
+    serve /metrics of this process on `port` from a daemon thread (once per process)
+    """
+    global _server
+    if not ENABLED or not port or _server is not None:
+        return _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    try:
+        _server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    except OSError as e:
+        # another process (a second streamlit server) may hold the port
+        print(f"Error starting metrics server: {e}")
+        return None
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+    return _server
@@ -50,4 +50,7 @@ if st.button('Submit'):
         
     elif return_val == 'file_false':
         st.error('face_embedding.txt is not found. Please refresh the page and execute again.')
-        
+
+    elif isinstance(return_val, tuple) and return_val[0] == 'duplicate':
+        match_key, similarity = return_val[1]
+        st.error(f'This face is already registered as {match_key} (similarity {similarity:.2f})')
@@ -1,16 +1,11 @@
 import streamlit as st 
 import face_rec
 import pandas as pd
+import attendance_logs
 
 st.set_page_config(page_title='Reporting', layout='wide')
 st.subheader('Reporting')
 
-name = 'attendance:logs'
-
-def load_logs(name, end=-1):
-    logs_list = face_rec.r.lrange(name, start=0, end=end)  # extract all data from the redis database
-    return logs_list
-
 # tabs to show the info
 tab1, tab2, tab3 = st.tabs(['Registered Data', 'Logs', 'Attendance Report'])
 
@@ -23,42 +18,16 @@ with tab1:
 
 with tab2:
     if st.button('Refresh Logs'):
-        st.write(load_logs(name=name))
+        # drop the cached logs and read the whole list again
+        attendance_logs.invalidate_logs()
+    st.dataframe(attendance_logs.load_logs(face_rec.r)[attendance_logs.LOG_COLUMNS])
 
 with tab3:
     st.subheader('Attendance Report')
-    logs_list = load_logs(name=name)
+    logs_df = attendance_logs.load_logs(face_rec.r)
     
-    if logs_list:
-        convert_byte_to_string = lambda x: x.decode('utf-8')
-        logs_list_string = list(map(convert_byte_to_string, logs_list))
-        split_string = lambda x: x.split('@')
-        logs_nested_list = list(map(split_string, logs_list_string))
-        
-        # Handle variable column lengths (backward compatibility)
-        processed_logs = []
-        for log in logs_nested_list:
-            if len(log) == 3:
-                processed_logs.append(log + [None, None]) # Add None for Lat, Long
-            elif len(log) == 5:
-                processed_logs.append(log)
-            else:
-                # Handle unexpected format or just skip
-                continue
-                
-        logs_df = pd.DataFrame(processed_logs, columns=['Name', 'Role', 'Timestamp', 'Lat', 'Long'])
-        logs_df['Timestamp'] = pd.to_datetime(logs_df['Timestamp'])
-        logs_df['Date'] = logs_df['Timestamp'].dt.date
-
-        report_df = logs_df.groupby(by=['Date', 'Name', 'Role']).agg(
-            In_Time=pd.NamedAgg('Timestamp', 'min'),
-            Out_Time=pd.NamedAgg('Timestamp', 'max')
-        ).reset_index()
-
-        report_df['in_time'] = pd.to_datetime(report_df['In_Time'])
-        report_df['out_time'] = pd.to_datetime(report_df['Out_Time'])
-
-        report_df['Duration'] = report_df['out_time'] - report_df['in_time']
+    if not logs_df.empty:
+        report_df = attendance_logs.daily_report(logs_df)
 
         # Convert duration to hours and minutes
         report_df['Duration_hours'] = report_df['Duration'].dt.seconds // 3600
@@ -0,0 +1,228 @@
+"""
+On-demand profiling without a redeploy.
+
+A request to a profiled Flask view is profiled when PROFILE_REQUESTS is set
+(every request) or when it carries `X-Profile: <PROFILE_TOKEN>` (a single
+request, for whoever holds the token). PROFILE_MODE picks the profiler:
+
+- 'cprofile' writes `.pstats` (python -m pstats, snakeviz)
+- 'sample' samples the request's thread every PROFILE_SAMPLE_INTERVAL
+  seconds and writes folded stacks (`.folded`, for flamegraph.pl or
+  speedscope)
+
+The response names the file in `X-Profile-File`.
+
+A long-running process (the Streamlit app) can also run a periodic sampler:
+every PROFILE_SAMPLER_EVERY seconds it samples all threads for
+PROFILE_SAMPLER_WINDOW seconds and writes one folded file.
+
+Files go to PROFILE_DIR, where only the newest PROFILE_KEEP are kept.
+"""
+import cProfile
+import hmac
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+
+import settings
+
+# cProfile hooks the interpreter: one profiled request at a time per process
+_cprofile_lock = threading.Lock()
+_rotate_lock = threading.Lock()
+
+
+def profile_dir():
+    return settings.PROFILE_DIR or os.path.join(tempfile.gettempdir(), 'face-geo-tag-profiles')
+
+
+def output_path(name, extension, directory=None):
+    directory = directory or profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    return os.path.join(directory, f'{stamp}-{os.getpid()}-{name}.{extension}')
+
+
+def rotate(directory=None, keep=settings.PROFILE_KEEP):
+    """
+    remove all but the newest `keep` profiles
+    """
+    directory = directory or profile_dir()
+    with _rotate_lock:
+        try:
+            files = [os.path.join(directory, file_name) for file_name in os.listdir(directory)
+                     if file_name.endswith(('.pstats', '.folded'))]
+            files.sort(key=os.path.getmtime)
+        except OSError:
+            return
+        for path in files[:max(0, len(files) - keep)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    # no ';' or ' ' in a folded frame
+    return f'{code.co_name}({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':').replace(' ', '_')
+
+
+def fold(frame):
+    """
+    'outer;...;inner' stack of a frame
+    """
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class StackSampler:
+    """
+    samples the stacks of some threads (all but its own by default) from a
+    background thread and counts the folded stacks
+    """
+    def __init__(self, interval=settings.PROFILE_SAMPLE_INTERVAL, thread_ids=None):
+        self.interval = interval
+        self.thread_ids = thread_ids
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                    continue
+                if thread_id not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                prefix = '' if self.thread_ids is not None else f"{names.get(thread_id, thread_id)};"
+                self.stacks[prefix + fold(frame)] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+
+def profile_call(name, call, mode=settings.PROFILE_MODE, directory=None):
+    """
+    (result of `call()`, profile file) with `call` run under the profiler;
+    the file is None when another request holds the cProfile hook or the
+    profile could not be written
+    """
+    if mode == 'sample':
+        sampler = StackSampler(thread_ids={threading.get_ident()}).start()
+        try:
+            result = call()
+        finally:
+            sampler.stop()
+        write = sampler.write
+        extension = 'folded'
+    else:
+        if not _cprofile_lock.acquire(blocking=False):
+            return call(), None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                result = call()
+            finally:
+                profiler.disable()
+        finally:
+            _cprofile_lock.release()
+        write = profiler.dump_stats
+        extension = 'pstats'
+
+    try:
+        path = output_path(name, extension, directory)
+        write(path)
+        rotate(directory)
+    except OSError as e:
+        print(f"Error writing profile: {e}")
+        return result, None
+    return result, path
+
+
+def wanted(headers):
+    """
+    True if this request should be profiled: PROFILE_REQUESTS, or the admin token in X-Profile
+    """
+    if settings.PROFILE_REQUESTS:
+        return True
+    token = headers.get('X-Profile')
+    return bool(token and settings.PROFILE_TOKEN and hmac.compare_digest(token, settings.PROFILE_TOKEN))
+
+
+def profiled(name):
+    """
+    Flask view decorator: profile the view when `wanted`
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            from flask import make_response, request
+
+            if not wanted(request.headers):
+                return f(*args, **kwargs)
+            started = time.perf_counter()
+            response, path = profile_call(name, lambda: make_response(f(*args, **kwargs)))
+            if path is not None:
+                response.headers['X-Profile-File'] = os.path.basename(path)
+                print(f"Profiled {name} ({(time.perf_counter() - started) * 1000:.0f} ms): {path}")
+            return response
+        return decorated_function
+    return decorator
+
+
+_periodic = None
+
+
+def start_periodic_sampler(every=settings.PROFILE_SAMPLER_EVERY, window=settings.PROFILE_SAMPLER_WINDOW,
+                           interval=settings.PROFILE_SAMPLER_INTERVAL, name='streamlit'):
+    """
+    every `every` seconds, sample all threads for `window` seconds and write
+    one folded file (once per process; off when `every` is 0)
+    """
+    global _periodic
+    if not every or _periodic is not None:
+        return _periodic
+
+    def run():
+        while True:
+            time.sleep(max(0.0, every - window))
+            sampler = StackSampler(interval=interval).start()
+            time.sleep(window)
+            sampler.stop()
+            if not sampler.stacks:
+                continue
+            try:
+                sampler.write(output_path(name, 'folded'))
+                rotate()
+            except OSError as e:
+                print(f"Error writing profile: {e}")
+
+    _periodic = threading.Thread(target=run, name='periodic-sampler', daemon=True)
+    _periodic.start()
+    return _periodic
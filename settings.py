@@ -0,0 +1,170 @@
+"""
+Runtime configuration, read from environment variables with defaults that
+match the original single-box deployment.
+"""
+import os
+
+
+def env_str(name, default):
+    return os.environ.get(name, default)
+
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, '') else int(value)
+
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, '') else float(value)
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Redis (face gallery hash and attendance:logs list)
+REDIS_HOST = env_str('REDIS_HOST', 'localhost')
+REDIS_PORT = env_int('REDIS_PORT', 6379)
+REDIS_PASSWORD = env_str('REDIS_PASSWORD', None) or None  # credentials only ever come from the environment
+REDIS_DB = env_int('REDIS_DB', 0)
+REDIS_MAX_CONNECTIONS = env_int('REDIS_MAX_CONNECTIONS', 20)
+REDIS_POOL_TIMEOUT = env_float('REDIS_POOL_TIMEOUT', 5.0)  # seconds to wait for a free pooled connection
+REDIS_SOCKET_TIMEOUT = env_float('REDIS_SOCKET_TIMEOUT', 10.0)
+REDIS_CONNECT_TIMEOUT = env_float('REDIS_CONNECT_TIMEOUT', 5.0)
+REDIS_RETRIES = env_int('REDIS_RETRIES', 3)
+REDIS_RETRY_BACKOFF = env_float('REDIS_RETRY_BACKOFF', 0.1)  # base of the exponential backoff, seconds
+REDIS_HEALTH_CHECK_INTERVAL = env_int('REDIS_HEALTH_CHECK_INTERVAL', 30)
+
+# MongoDB (flask app)
+MONGO_URI = env_str('MONGO_URI', 'mongodb://localhost:27017/')
+MONGO_DB = env_str('MONGO_DB', 'face_attendance_db')
+MONGO_MAX_POOL_SIZE = env_int('MONGO_MAX_POOL_SIZE', 20)
+MONGO_MIN_POOL_SIZE = env_int('MONGO_MIN_POOL_SIZE', 0)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = env_int('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)
+MONGO_SOCKET_TIMEOUT_MS = env_int('MONGO_SOCKET_TIMEOUT_MS', 30000)
+MONGO_CONNECT_TIMEOUT_MS = env_int('MONGO_CONNECT_TIMEOUT_MS', 5000)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)
+MONGO_RETRY_WRITES = env_bool('MONGO_RETRY_WRITES', True)
+MONGO_RETRY_READS = env_bool('MONGO_RETRY_READS', True)
+
+# Columnar log export
+ATTENDANCE_EXPORT_DIR = env_str('ATTENDANCE_EXPORT_DIR', os.path.join('exports', 'attendance'))
+
+# Capture-time de-duplication of attendance events
+ATTENDANCE_COOLDOWN_SECONDS = env_float('ATTENDANCE_COOLDOWN_SECONDS', 60.0)
+ATTENDANCE_COOLDOWN_MAX_ENTRIES = env_int('ATTENDANCE_COOLDOWN_MAX_ENTRIES', 100000)
+# share the cooldown between workers through redis SET NX EX
+ATTENDANCE_COOLDOWN_SHARED = env_bool('ATTENDANCE_COOLDOWN_SHARED', False)
+
+# Anomaly detection
+ANOMALY_CHECKIN_WINDOW_MINUTES = env_float('ANOMALY_CHECKIN_WINDOW_MINUTES', 5.0)
+ANOMALY_MIN_DURATION_HOURS = env_float('ANOMALY_MIN_DURATION_HOURS', 4.0)
+ANOMALY_LOCATION_THRESHOLD_KM = env_float('ANOMALY_LOCATION_THRESHOLD_KM', 1.0)
+# impossible travel: faster than this between two check-ins, ignoring jumps under ANOMALY_MIN_TRAVEL_KM
+ANOMALY_MAX_SPEED_KMH = env_float('ANOMALY_MAX_SPEED_KMH', 150.0)
+ANOMALY_MIN_TRAVEL_KM = env_float('ANOMALY_MIN_TRAVEL_KM', 2.0)
+# rebuild the online detector from today's logs when a worker starts
+ANOMALY_WARM_START = env_bool('ANOMALY_WARM_START', True)
+# per-user detector state in redis, shared by the workers (unset: on when gunicorn runs several workers)
+ANOMALY_SHARED_STATE = env_bool('ANOMALY_SHARED_STATE', None)
+ANOMALY_CLOSE_BATCH_SIZE = env_int('ANOMALY_CLOSE_BATCH_SIZE', 500)  # users per transaction when a shared day closes
+# single expected site for the location check (unset: no location check)
+SITE_LAT = env_float('SITE_LAT', None)
+SITE_LONG = env_float('SITE_LONG', None)
+
+# Multi-site geofences (see geofence.py); replaces SITE_LAT/SITE_LONG when set
+SITES_FILE = env_str('SITES_FILE', None)
+GEOFENCE_CELL_KM = env_float('GEOFENCE_CELL_KM', 5.0)
+
+# Duplicate enrolment check (see gallery_audit.py); same default as the recognition threshold
+DUPLICATE_FACE_CHECK = env_bool('DUPLICATE_FACE_CHECK', True)
+DUPLICATE_FACE_THRESHOLD = env_float('DUPLICATE_FACE_THRESHOLD', 0.5)
+GALLERY_AUDIT_BLOCK_SIZE = env_int('GALLERY_AUDIT_BLOCK_SIZE', 4096)
+
+# Pre-forked serving (flask_app/gunicorn.conf.py)
+WEB_BIND = env_str('WEB_BIND', '0.0.0.0:5000')
+WEB_WORKERS = env_int('WEB_WORKERS', 0)  # 0: one per CPU core
+WEB_TIMEOUT = env_int('WEB_TIMEOUT', 60)
+WEB_GRACEFUL_TIMEOUT = env_int('WEB_GRACEFUL_TIMEOUT', 30)
+# recycle a worker after this many requests (0: never); cheap, the model is preloaded
+WEB_MAX_REQUESTS = env_int('WEB_MAX_REQUESTS', 0)
+WEB_MAX_REQUESTS_JITTER = env_int('WEB_MAX_REQUESTS_JITTER', 0)
+WEB_HEALTH_DIR = env_str('WEB_HEALTH_DIR', None)  # default: a directory under the system temp dir
+WEB_HEALTH_INTERVAL = env_float('WEB_HEALTH_INTERVAL', 5.0)
+# onnxruntime threads per inference session (0: onnxruntime default, one per core)
+ORT_INTRA_OP_THREADS = env_int('ORT_INTRA_OP_THREADS', 0)
+# threads per gthread worker; every open live page (/api/stream) holds one
+WEB_THREADS = env_int('WEB_THREADS', 16)
+
+# Live dashboard / alerts updates over Server-Sent Events (flask_app/events.py)
+EVENTS_QUEUE_SIZE = env_int('EVENTS_QUEUE_SIZE', 100)  # pending events per open page
+EVENTS_HEARTBEAT_SECONDS = env_float('EVENTS_HEARTBEAT_SECONDS', 15.0)
+EVENTS_STREAM_MAX_SECONDS = env_float('EVENTS_STREAM_MAX_SECONDS', 600.0)
+EVENTS_STATS_MAX_AGE = env_float('EVENTS_STATS_MAX_AGE', 300.0)
+# relay events between worker processes through redis pub/sub
+# (unset: on under gunicorn with more than one worker)
+EVENTS_SHARED = env_bool('EVENTS_SHARED', None)
+EVENTS_CHANNEL = env_str('EVENTS_CHANNEL', 'attendance:events')
+
+# Response cache of the hot read endpoints (flask_app/response_cache.py): memory, redis or none
+CACHE_BACKEND = env_str('CACHE_BACKEND', 'memory')
+CACHE_MAX_ENTRIES = env_int('CACHE_MAX_ENTRIES', 1024)
+CACHE_PREFIX = env_str('CACHE_PREFIX', 'cache:')
+# writes invalidate explicitly; the TTLs bound staleness across workers with the memory backend
+CACHE_TTL_STATS = env_float('CACHE_TTL_STATS', 10.0)
+CACHE_TTL_ALERTS = env_float('CACHE_TTL_ALERTS', 30.0)
+CACHE_TTL_NOTIFICATIONS = env_float('CACHE_TTL_NOTIFICATIONS', 30.0)
+
+# Keyset pagination of /api/get_alerts and /api/my_attendance
+PAGE_SIZE = env_int('PAGE_SIZE', 50)
+PAGE_SIZE_MAX = env_int('PAGE_SIZE_MAX', 200)
+
+# Batch attendance (/api/mark_attendance_batch)
+BATCH_WORKERS = env_int('BATCH_WORKERS', min(4, os.cpu_count() or 1))  # decode + detect threads per worker
+BATCH_MAX_IMAGES = env_int('BATCH_MAX_IMAGES', 64)
+BATCH_MAX_BYTES = env_int('BATCH_MAX_BYTES', 64 * 1024 * 1024)  # total image bytes, archives included
+
+# Bulk enrolment (flask_app/bulk_enroll.py)
+BULK_ENROLL_WORKERS = env_int('BULK_ENROLL_WORKERS', 0)  # 0: one FaceAnalysis process per CPU core
+BULK_ENROLL_BATCH_SIZE = env_int('BULK_ENROLL_BATCH_SIZE', 100)  # users per bulk write
+
+# Notifications: written in the background in batches, expired after NOTIFICATIONS_TTL_DAYS (0: kept)
+NOTIFY_FLUSH_INTERVAL = env_float('NOTIFY_FLUSH_INTERVAL', 0.5)  # seconds a batch waits for more
+NOTIFY_BATCH_SIZE = env_int('NOTIFY_BATCH_SIZE', 500)
+NOTIFY_QUEUE_SIZE = env_int('NOTIFY_QUEUE_SIZE', 10000)
+NOTIFICATIONS_TTL_DAYS = env_float('NOTIFICATIONS_TTL_DAYS', 30.0)
+
+# Admission control of the inference endpoints, per worker (0 in flight: no limit)
+ADMISSION_MAX_IN_FLIGHT = env_int('ADMISSION_MAX_IN_FLIGHT', 2)
+ADMISSION_MAX_QUEUE = env_int('ADMISSION_MAX_QUEUE', 8)
+ADMISSION_QUEUE_TIMEOUT = env_float('ADMISSION_QUEUE_TIMEOUT', 2.0)  # seconds a request may wait for a slot
+
+# Pipeline metrics (metrics.py): /metrics on the Flask app, METRICS_PORT for a streamlit process (0: none)
+METRICS_ENABLED = env_bool('METRICS_ENABLED', False)
+METRICS_PORT = env_int('METRICS_PORT', 0)
+
+# On-demand profiling (profiling.py)
+PROFILE_REQUESTS = env_bool('PROFILE_REQUESTS', False)  # profile every request to a profiled view
+PROFILE_TOKEN = env_str('PROFILE_TOKEN', None)  # or only requests with `X-Profile: <token>`
+PROFILE_MODE = env_str('PROFILE_MODE', 'cprofile')  # 'cprofile' (.pstats) or 'sample' (.folded stacks)
+PROFILE_SAMPLE_INTERVAL = env_float('PROFILE_SAMPLE_INTERVAL', 0.005)
+PROFILE_DIR = env_str('PROFILE_DIR', None)  # default: a directory under the system temp dir
+PROFILE_KEEP = env_int('PROFILE_KEEP', 50)  # newest profiles kept
+# periodic sampler of a long-running (streamlit) process: a window of samples every N seconds (0: off)
+PROFILE_SAMPLER_EVERY = env_float('PROFILE_SAMPLER_EVERY', 0.0)
+PROFILE_SAMPLER_WINDOW = env_float('PROFILE_SAMPLER_WINDOW', 10.0)
+PROFILE_SAMPLER_INTERVAL = env_float('PROFILE_SAMPLER_INTERVAL', 0.01)
+
+# Offline-first edge mode (edge_store.py): logs and registrations go to a local SQLite database and are uploaded in the background
+EDGE_MODE = env_bool('EDGE_MODE', False)
+EDGE_DB_PATH = env_str('EDGE_DB_PATH', os.path.join('data', 'edge.sqlite3'))
+EDGE_SYNC_INTERVAL = env_float('EDGE_SYNC_INTERVAL', 2.0)  # seconds between uploads (sooner after a write)
+EDGE_SYNC_MAX_BACKOFF = env_float('EDGE_SYNC_MAX_BACKOFF', 60.0)  # while the central store is unreachable
+EDGE_SYNC_BATCH_SIZE = env_int('EDGE_SYNC_BATCH_SIZE', 500)  # rows per upload request
+EDGE_GALLERY_REFRESH = env_float('EDGE_GALLERY_REFRESH', 300.0)  # seconds between pulls of the central gallery
+EDGE_KEEP_SYNCED_HOURS = env_float('EDGE_KEEP_SYNCED_HOURS', 24.0)  # uploaded rows kept locally
+EDGE_COMPACT_INTERVAL = env_float('EDGE_COMPACT_INTERVAL', 3600.0)
@@ -0,0 +1,244 @@
+"""
+Seeded generator of realistic attendance logs, for benchmarks and load tests.
+
+Every user has a home site and attends most days: a check-in around 09:00,
+a check-out around 17:00 and evenly spaced sightings in between, each with
+GPS jitter around the site. A fraction of the user-days gets exactly one
+injected anomaly, recorded in the ground truth:
+
+- 'Multiple Check-in': an extra sighting 30 s to 4 min after another one
+- 'Short Duration': the whole day lasts 0.5 to 3.5 hours
+- 'Location Mismatch': one sighting 3 to 20 km away from the home site
+- 'Impossible Travel': an extra sighting at another site 6 to 20 min later
+
+The frame has the columns of `attendance_logs.parse_logs` plus UserId and
+converts to redis entries or mongo log documents:
+
+    python synthetic_logs.py --users 2000 --days 30 --format redis --out logs.txt
+    python synthetic_logs.py --users 200 --days 5 --format mongo --push
+"""
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from attendance_logs import LOG_COLUMNS
+
+KM_PER_DEGREE = 111.32
+ANOMALY_TYPES = ['Multiple Check-in', 'Short Duration', 'Location Mismatch', 'Impossible Travel']
+# sites sit on a grid this far apart, far beyond any injected mismatch
+SITE_SPACING_KM = 60.0
+BASE_SITE = (17.6868, 83.2185)
+
+
+def make_sites(n_sites, radius_km=0.5):
+    """
+    site dicts (geofence.Site keyword arguments) on a square grid
+    """
+    side = int(np.ceil(np.sqrt(n_sites)))
+    sites = []
+    for k in range(n_sites):
+        lat = BASE_SITE[0] + (k // side) * SITE_SPACING_KM / KM_PER_DEGREE
+        long = BASE_SITE[1] + (k % side) * SITE_SPACING_KM / (KM_PER_DEGREE * np.cos(np.radians(lat)))
+        sites.append({'site_id': f'SITE-{k:03d}', 'name': f'Campus {k}', 'lat': round(lat, 6),
+                      'long': round(long, 6), 'radius_km': radius_km})
+    return sites
+
+
+def _offset(lat, long, dist_km, bearing):
+    # small-distance move on the local tangent plane, good to a few metres at these ranges
+    dlat = dist_km * np.cos(bearing) / KM_PER_DEGREE
+    dlong = dist_km * np.sin(bearing) / (KM_PER_DEGREE * np.cos(np.radians(lat)))
+    return lat + dlat, long + dlong
+
+
+def generate(users=1000, days=30, sites=1, events_per_day=4, attendance_rate=0.9,
+             jitter_km=0.05, anomaly_rate=0.02, legacy_rate=0.0, start='2024-01-01', seed=0):
+    """
+    (logs_df, truth_df, sites, assignments)
+
+    logs_df:     Name, Role, Timestamp, Lat, Long, Date, UserId in time order
+    truth_df:    Name, Date, Type of every injected anomaly
+    sites:       site dicts, see `make_sites`
+    assignments: name -> [home site id]
+    `anomaly_rate` is the share of attended user-days with an injected
+    anomaly, split evenly across the four types. `legacy_rate` drops the
+    coordinates of that share of rows (old 3-field entries).
+    """
+    rng = np.random.default_rng(seed)
+    k = max(int(events_per_day), 2)
+    site_list = make_sites(sites)
+    site_lat = np.array([s['lat'] for s in site_list])
+    site_long = np.array([s['long'] for s in site_list])
+
+    names = np.array([f'User{u:05d}' for u in range(users)], dtype=object)
+    roles = np.where(np.arange(users) % 10 == 0, 'Teacher', 'Student').astype(object)
+    user_ids = np.array([f"{'TEA' if u % 10 == 0 else 'STU'}-{u:08X}" for u in range(users)], dtype=object)
+    home = rng.integers(0, sites, users)
+
+    # attended user-days and their injected anomaly (-1: none)
+    user = np.repeat(np.arange(users), days)
+    day = np.tile(np.arange(days), users)
+    present = rng.random(len(user)) < attendance_rate
+    user, day = user[present], day[present]
+    m = len(user)
+    kind = np.where(rng.random(m) < anomaly_rate, rng.integers(0, len(ANOMALY_TYPES), m), -1)
+
+    # regular sightings: in, evenly spaced middle ones, out
+    hour = 3600.0
+    t_in = 9 * hour + rng.normal(0, 20 * 60, m)
+    t_out = 17 * hour + rng.normal(0, 30 * 60, m)
+    short = kind == 1
+    t_out[short] = t_in[short] + rng.uniform(0.5, 3.5, short.sum()) * hour
+    frac = np.broadcast_to(np.linspace(0, 1, k), (m, k)).copy()
+    if k > 2:
+        # middle sightings wobble by at most 10% of the gap, so they never bunch up
+        frac[:, 1:-1] += rng.uniform(-0.1, 0.1, (m, k - 2)) / (k - 1)
+    seconds = t_in[:, None] + frac * (t_out - t_in)[:, None]
+
+    bearing = rng.uniform(0, 2 * np.pi, (m, k))
+    jitter = np.abs(rng.normal(0, jitter_km, (m, k)))
+    lat, long = _offset(site_lat[home[user]][:, None], site_long[home[user]][:, None], jitter, bearing)
+
+    # one sighting of a 'Location Mismatch' day moves 3-20 km away
+    rows = np.flatnonzero(kind == 2)
+    col = rng.integers(1, k - 1, len(rows)) if k > 2 else np.full(len(rows), k - 1)
+    lat[rows, col], long[rows, col] = _offset(lat[rows, col], long[rows, col],
+                                              rng.uniform(3, 20, len(rows)), rng.uniform(0, 2 * np.pi, len(rows)))
+
+    ev_user = np.repeat(user, k)
+    ev_day = np.repeat(day, k)
+    ev_sec, ev_lat, ev_long = seconds.ravel(), lat.ravel(), long.ravel()
+
+    # extra sightings: a quick repeat, or a hop to another site
+    extra_rows = np.flatnonzero(kind == 0)
+    src = extra_rows * k + rng.integers(0, k, len(extra_rows))
+    extra = [(src, ev_sec[src] + rng.uniform(30, 240, len(src)), ev_lat[src], ev_long[src])]
+    hop_rows = np.flatnonzero(kind == 3) if sites > 1 else np.empty(0, dtype=np.int64)
+    if len(hop_rows):
+        src = hop_rows * k + rng.integers(0, k, len(hop_rows))
+        other = (home[user[hop_rows]] + rng.integers(1, sites, len(hop_rows))) % sites
+        hop_lat, hop_long = _offset(site_lat[other], site_long[other], np.abs(rng.normal(0, jitter_km, len(src))),
+                                    rng.uniform(0, 2 * np.pi, len(src)))
+        extra.append((src, ev_sec[src] + rng.uniform(6, 20, len(src)) * 60, hop_lat, hop_long))
+    for src, sec, la, lo in extra:
+        ev_user = np.concatenate([ev_user, ev_user[src]])
+        ev_day = np.concatenate([ev_day, ev_day[src]])
+        ev_sec = np.concatenate([ev_sec, sec])
+        ev_lat = np.concatenate([ev_lat, la])
+        ev_long = np.concatenate([ev_long, lo])
+
+    start = np.datetime64(start, 'D')
+    timestamp = (start + ev_day.astype('timedelta64[D]')).astype('datetime64[us]') \
+        + np.round(ev_sec * 1e6).astype('timedelta64[us]')
+    order = np.argsort(timestamp, kind='stable')
+    if legacy_rate > 0:
+        legacy = rng.random(len(ev_lat)) < legacy_rate
+        ev_lat[legacy] = np.nan
+        ev_long[legacy] = np.nan
+
+    ev_user = ev_user[order]
+    timestamp = pd.to_datetime(timestamp[order])
+    logs_df = pd.DataFrame({
+        'Name': pd.Categorical.from_codes(ev_user, names),
+        'Role': pd.Categorical(roles[ev_user]),
+        'Timestamp': timestamp,
+        'Lat': np.round(ev_lat[order], 6).astype(np.float32),
+        'Long': np.round(ev_long[order], 6).astype(np.float32),
+        'Date': timestamp.normalize(),
+        'UserId': pd.Categorical.from_codes(ev_user, user_ids),
+    })
+    if sites == 1:
+        # no other site to hop to
+        kind[kind == 3] = -1
+    injected = kind >= 0
+    truth_df = pd.DataFrame({
+        'Name': names[user[injected]],
+        'Date': pd.to_datetime(start + day[injected].astype('timedelta64[D]')),
+        'Type': np.asarray(ANOMALY_TYPES, dtype=object)[kind[injected]],
+    })
+    assignments = {names[u]: [site_list[home[u]]['site_id']] for u in range(users)}
+    return logs_df, truth_df, site_list, assignments
+
+
+def to_redis_entries(logs_df):
+    """
+    name@role@timestamp[@lat@long] bytes, newest first like LRANGE 0 -1
+    """
+    logs_df = logs_df.iloc[::-1]
+    stamps = logs_df['Timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S.%f').tolist()
+    lat = logs_df['Lat'].astype(np.float64).round(6).tolist()
+    long = logs_df['Long'].astype(np.float64).round(6).tolist()
+    return [(f'{name}@{role}@{ts}' if la != la else f'{name}@{role}@{ts}@{la}@{lo}').encode()
+            for name, role, ts, la, lo in zip(logs_df['Name'].tolist(), logs_df['Role'].tolist(), stamps, lat, long)]
+
+
+def to_mongo_docs(logs_df):
+    """
+    documents shaped like the ones `RealTimePred.saveLogs_mongo` inserts
+    """
+    stamps = logs_df['Timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S.%f').tolist()
+    lat = logs_df['Lat'].astype(np.float64).round(6).tolist()
+    long = logs_df['Long'].astype(np.float64).round(6).tolist()
+    return [{'user_id': user_id, 'name': name, 'role': role, 'timestamp': ts,
+             'lat': None if la != la else la, 'long': None if lo != lo else lo}
+            for user_id, name, role, ts, la, lo in zip(logs_df['UserId'].tolist(), logs_df['Name'].tolist(),
+                                                       logs_df['Role'].tolist(), stamps, lat, long)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic attendance logs')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--sites', type=int, default=1)
+    parser.add_argument('--events-per-day', type=int, default=4)
+    parser.add_argument('--jitter-km', type=float, default=0.05)
+    parser.add_argument('--anomaly-rate', type=float, default=0.02)
+    parser.add_argument('--legacy-rate', type=float, default=0.0)
+    parser.add_argument('--start', default='2024-01-01')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['redis', 'mongo'], default='redis')
+    parser.add_argument('--out', help='write the entries (redis) or JSON lines (mongo) to this file')
+    parser.add_argument('--truth', help='write the injected anomalies to this CSV file')
+    parser.add_argument('--push', action='store_true', help='load the logs into the configured database')
+    parser.add_argument('--target', help="redis list or mongo collection to push to (default: 'synthetic:logs' / 'synthetic_logs')")
+    args = parser.parse_args()
+
+    logs_df, truth_df, _, _ = generate(args.users, args.days, args.sites, args.events_per_day,
+                                       jitter_km=args.jitter_km, anomaly_rate=args.anomaly_rate,
+                                       legacy_rate=args.legacy_rate, start=args.start, seed=args.seed)
+    print(f"Generated {len(logs_df)} logs, {len(truth_df)} injected anomalies")
+    if args.truth:
+        truth_df.to_csv(args.truth, index=False)
+
+    if args.format == 'redis':
+        entries = to_redis_entries(logs_df)
+        if args.out:
+            with open(args.out, 'wb') as f:
+                f.write(b'\n'.join(entries) + b'\n')
+        if args.push:
+            import db_clients
+            r = db_clients.get_redis()
+            target = args.target or 'synthetic:logs'
+            # oldest first, so the list ends up newest first like the live one
+            for i in range(len(entries), 0, -10000):
+                r.lpush(target, *entries[max(i - 10000, 0):i][::-1])
+            print(f"Pushed {len(entries)} entries to {target}")
+    else:
+        docs = to_mongo_docs(logs_df)
+        if args.out:
+            with open(args.out, 'w') as f:
+                for doc in docs:
+                    f.write(json.dumps(doc) + '\n')
+        if args.push:
+            import db_clients
+            target = args.target or 'synthetic_logs'
+            collection = db_clients.collection(target)
+            for i in range(0, len(docs), 10000):
+                collection.insert_many(docs[i:i + 10000])
+            print(f"Inserted {len(docs)} documents into {target}")
+
+
+if __name__ == '__main__':
+    main()
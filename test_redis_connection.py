@@ -1,14 +1,16 @@
 import redis
 import sys
 
-# Credentials from face_rec.py
-hostname = 'redis-13246.c267.us-east-1-4.ec2.cloud.redislabs.com'
-portnumber = 13246
-password = 'aRkbqXJx1Dea2K6TbebfBUeJJrDJ6TZJ'
+import settings
+import db_clients
+
+# Connection settings from settings.py / environment variables
+hostname = settings.REDIS_HOST
+portnumber = settings.REDIS_PORT
 
 try:
     print(f"Attempting to connect to Redis at {hostname}:{portnumber}...")
-    r = redis.StrictRedis(host=hostname, port=portnumber, password=password, socket_timeout=5)
+    r = db_clients.get_redis()
     
     # Try a simple ping
     if r.ping():